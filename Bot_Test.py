@@ -1,20 +1,50 @@
+import asyncio
 import logging
 import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultsButton, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
+    ApplicationHandlerStop,
     filters
 )
 
+from antiflood import ANTIFLOOD_GROUP, AntiFlood
+from broadcast import Broadcaster
+from capture import UpdateCapture
+from catalog_search import CATALOG_START, CatalogSearch
+from cluster import run_cluster
+from drafts import OrderDraft
+from handler_utils import answer_in_background, run_in_background, timed, timings
+from http_client import make_request, warm_connections
+from keyboards import KeyboardRegistry
+from logging_setup import parse_sampling, setup_logging
+from media import MediaRegistry
+from metrics import metrics
+from orders import OrderStore, OrdersCsvHandler
+from outbox import Outbox
+from persistence import PRELOAD_GROUP, SQLitePersistence
+from router import CallbackRouter
+from server import run_webhook
+from update_processor import PerUserUpdateProcessor
+
+load_dotenv()
+
 # === Логирование ===
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+# Пишет отдельный поток; LOG_FORMAT=text — прежний текстовый формат вместо JSON
+setup_logging(
+    logging.INFO,
+    json_format=os.getenv("LOG_FORMAT", "json") == "json",
+    # Не больше N одинаковых предупреждений в минуту от логгера: при флуде лог не разрастается
+    sampling=parse_sampling(os.getenv("LOG_SAMPLING", "handler_utils=20,media=20,http_client=20")),
 )
 logger = logging.getLogger(__name__)
 logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -34,11 +64,115 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
     CONFIRMING
 ) = range(11)
 
-load_dotenv()
+# Имена состояний для меток метрик
+STATE_NAMES = {
+    CHOOSING_CATEGORY: "CHOOSING_CATEGORY",
+    CHOOSING_ITEM: "CHOOSING_ITEM",
+    CHOOSING_WRAP_COLOR: "CHOOSING_WRAP_COLOR",
+    CHOOSING_FILLING: "CHOOSING_FILLING",
+    CHOOSING_RIBBON_COLOR_BOUQUET: "CHOOSING_RIBBON_COLOR_BOUQUET",
+    TYPING_COLOR_PREFERENCES: "TYPING_COLOR_PREFERENCES",
+    TYPING_PRICE_BOUQUET: "TYPING_PRICE_BOUQUET",
+    CHOOSING_SET_FILLING: "CHOOSING_SET_FILLING",
+    CHOOSING_RIBBON_COLOR_SET: "CHOOSING_RIBBON_COLOR_SET",
+    TYPING_PRICE_SET: "TYPING_PRICE_SET",
+    CONFIRMING: "CONFIRMING",
+}
 
 # === Настройки ===
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MANAGER_CHAT_ID = int(os.getenv("MANAGER_CHAT_ID"))
+MEDIA_CACHE_PATH = os.getenv("MEDIA_CACHE_PATH", "media_cache.json")
+PHOTOS_DIR = os.getenv("PHOTOS_DIR", "Photos")
+# Как часто проверять каталог с фото на изменения, секунды (0 — не следить)
+MEDIA_POLL_INTERVAL = float(os.getenv("MEDIA_POLL_INTERVAL", 10))
+# Фото уменьшаются до этой длинной стороны (нужен Pillow)
+MEDIA_MAX_SIDE = int(os.getenv("MEDIA_MAX_SIDE", 1280))
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка из benchmarks/)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.sqlite3")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 5))
+# Через сколько секунд тишины брошенный заказ забывается (0 — никогда)
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", 6 * 3600)) or None
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH", STATE_DB_PATH)
+ORDERS_DB_PATH = os.getenv("ORDERS_DB_PATH", STATE_DB_PATH)
+BROADCAST_DB_PATH = os.getenv("BROADCAST_DB_PATH", STATE_DB_PATH)
+# Если задан, заказы выгружаются в CSV по GET /orders.csv с заголовком «Authorization: Bearer <токен>»
+ORDERS_EXPORT_TOKEN = os.getenv("ORDERS_EXPORT_TOKEN")
+# Telegram пропускает в одну группу около 20 сообщений в минуту
+MANAGER_RATE_PER_MINUTE = float(os.getenv("MANAGER_RATE_PER_MINUTE", 20))
+# Рассылка /broadcast: Telegram пропускает около 30 сообщений в секунду на бота — часть оставляем обычным ответам
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+# Получателей в пачке; после каждой пачки прогресс сохраняется в базу
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", 50))
+# Весь мастер заказа живёт в одном сообщении, которое редактируется на каждом шаге
+SINGLE_MESSAGE_FLOW = os.getenv("SINGLE_MESSAGE_FLOW", "1") == "1"
+# Сколько апдейтов разных пользователей обрабатывается одновременно
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 32))
+# Сколько апдейтов может ждать в очереди; сверх этого вебхук отвечает 503 и Telegram повторяет позже
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+# Если задан, /metrics отдаётся только с заголовком «Authorization: Bearer <токен>»
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+# Больше одного — входной процесс раздаёт апдейты воркерам по id пользователя (см. cluster.py)
+WORKERS = int(os.getenv("WORKERS", 1))
+# Воркер N отдаёт свои /metrics на порту WORKER_METRICS_PORT + N
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0)) or None
+# Соединения с Bot API: основной пул и отдельный для загрузки фото (см. http_client.py)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 128))
+MEDIA_POOL_SIZE = int(os.getenv("MEDIA_POOL_SIZE", 8))
+# Сколько секунд простаивающее соединение остаётся открытым для следующих запросов
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 5))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", 5))
+# Сколько запрос ждёт свободного соединения, прежде чем упасть с TimedOut
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", 3))
+MEDIA_WRITE_TIMEOUT = float(os.getenv("MEDIA_WRITE_TIMEOUT", 30))
+# HTTP/2 требует пакет h2 (pip install "httpx[http2]"), без него остаётся HTTP/1.1
+HTTP2 = os.getenv("HTTP2", "0") == "1"
+# Сколько соединений с Bot API открыть заранее, до приёма первых апдейтов
+WARM_CONNECTIONS = int(os.getenv("WARM_CONNECTIONS", 8))
+# Антифлуд: повтор той же кнопки в течение окна отбрасывается, на пользователя — не больше FLOOD_RATE апдейтов в секунду
+DUPLICATE_TAP_WINDOW = float(os.getenv("DUPLICATE_TAP_WINDOW", 3))
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 3))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", 10))
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+# Отпечаток секрета вебхука: по нему видно, нужно ли вызывать setWebhook при запуске
+WEBHOOK_STATE_PATH = os.getenv("WEBHOOK_STATE_PATH", "webhook_state")
+# Если задан, принятые апдейты обезличиваются и дописываются в этот файл (.gz — сжатый) для benchmarks/replay.py
+CAPTURE_PATH = os.getenv("CAPTURE_PATH")
+# Соль псевдонимов id в записи; без неё псевдонимы меняются при каждом запуске
+CAPTURE_SALT = os.getenv("CAPTURE_SALT")
+# Сколько секунд Telegram кеширует ответ на инлайн-запрос у себя (инлайн-режим включается в BotFather: /setinline)
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))
+
+# === Медиа ===
+WRAPS_PHOTO_PATH = os.path.join(PHOTOS_DIR, "wraps_overview.jpg")
+RIBBON_PHOTO_PATH = os.path.join(PHOTOS_DIR, "ribbon_overview.png")
+
+# Фото живут в памяти: загружаются при прогреве, дальше обработчики диск не трогают
+media_registry = MediaRegistry(MEDIA_CACHE_PATH, PHOTOS_DIR, max_side=MEDIA_MAX_SIDE)
+
+# === Очередь уведомлений менеджеру ===
+# В кластере очередь общая, а отправляет её только воркер 0 — опрашивая базу
+outbox = Outbox(
+    OUTBOX_DB_PATH, rate_per_minute=MANAGER_RATE_PER_MINUTE, poll_interval=1.0 if WORKERS > 1 else None
+)
+
+# === Журнал заказов ===
+order_store = OrderStore(ORDERS_DB_PATH)
+# Кнопки листания /orders: "o:<направление><id>:<фильтр>"
+ORDERS_CALLBACK_PREFIX = "o:"
+
+# === Рассылка ===
+# Как и очередь уведомлений, в кластере её отправляет только воркер 0
+broadcaster = Broadcaster(
+    BROADCAST_DB_PATH, order_store, rate=BROADCAST_RATE, batch_size=BROADCAST_BATCH,
+    poll_interval=1.0 if WORKERS > 1 else None, notify=lambda text: outbox.put(MANAGER_CHAT_ID, text),
+)
+# Кнопки подтверждения рассылки: "b:<go|no>:<id>"
+BROADCAST_CALLBACK_PREFIX = "b:"
 
 # === Каталог ===
 CATEGORIES = {
@@ -114,387 +248,374 @@ RIBBON_COLORS = {
     "nepurplegold": "Новогодняя фиолетовое золото"
 }
 
-# === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
+# === Клавиатуры ===
+# Собираются один раз при старте; после изменения каталога вызовите keyboards.rebuild()
+callback_router = CallbackRouter(CATEGORIES, WRAP_COLORS, FILLINGS, SET_FILLINGS, RIBBON_COLORS)
+callback_router.reserve(ORDERS_CALLBACK_PREFIX)
+callback_router.reserve(BROADCAST_CALLBACK_PREFIX)
+keyboards = KeyboardRegistry(
+    callback_router, CATEGORIES, WRAP_COLORS, FILLINGS, SET_FILLINGS, SET_FILLING_RULES, RIBBON_COLORS
+)
+# Инлайн-поиск «@бот запрос»: индекс и готовые ответы; после изменения каталога — catalog_search.rebuild()
+catalog_search = CatalogSearch(
+    callback_router, CATEGORIES, FILLINGS, SET_FILLINGS, SET_FILLING_RULES, RIBBON_COLORS
+)
 
-def build_category_keyboard():
-    return [
-        [InlineKeyboardButton("Букеты💐", callback_data="category_bouquets"),
-         InlineKeyboardButton("Наборы🎁", callback_data="category_sets")]
-    ]
+# === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
-def build_back_to_categories_button():
-    return [InlineKeyboardButton("← Назад к категориям", callback_data="back_to_categories")]
+async def show_step(update: Update, context: ContextTypes.DEFAULT_TYPE, text, reply_markup=None, photo_path=None):
+    """Показывает следующий шаг заказа, по возможности редактируя текущее сообщение.
 
-def build_back_to_bouquets_button():
-    return [InlineKeyboardButton("← Назад к букетам", callback_data="back_to_bouquets")]
+    Текст поверх текста — edit_message_text. В режиме SINGLE_MESSAGE_FLOW шаг
+    с тем же фото меняет только подпись, а с другим — само фото. Шаг без фото
+    (или с недоступным фото) под чужой картинкой не показывается, а превратить
+    текстовое сообщение в фото Telegram не умеет, поэтому тогда (и при любой
+    ошибке редактирования) отправляется новое сообщение, а старое удаляется.
+    """
+    message = update.callback_query.message
+    if photo_path is not None and not media_registry.available(photo_path):
+        photo_path = None
 
-def build_back_to_sets_button():
-    return [InlineKeyboardButton("← Назад к наборам", callback_data="back_to_sets")]
+    try:
+        if message.photo and SINGLE_MESSAGE_FLOW and photo_path is not None:
+            if media_registry.shows(message, photo_path):
+                await message.edit_caption(text, reply_markup=reply_markup)
+            else:
+                await media_registry.edit_photo(message, photo_path, caption=text, reply_markup=reply_markup)
+            return
+        if not message.photo and photo_path is None:
+            await message.edit_text(text, reply_markup=reply_markup)
+            return
+    except BadRequest as e:
+        if "not modified" in str(e):
+            return
+        logger.warning("Не удалось отредактировать сообщение, отправляем новое: %s", e)
+
+    await send_step(update, context, text, reply_markup, photo_path)
+    # Старое сообщение пользователь не ждёт — удаляем его вне критического пути
+    run_in_background(context, message.delete(), "удаление сообщения")
+
+async def send_step(update: Update, context: ContextTypes.DEFAULT_TYPE, text, reply_markup=None, photo_path=None):
+    """Показывает шаг заказа новым сообщением: с фото, если оно есть, иначе текстом."""
+    sent = None
+    if photo_path is not None:
+        sent = await media_registry.send_photo(
+            context.bot, update.effective_chat.id, photo_path, caption=text, reply_markup=reply_markup
+        )
+    if sent is None:
+        await update.effective_chat.send_message(text, reply_markup=reply_markup)
+
+def item_step(category_key, item_key):
+    """Шаг после выбора позиции: (текст, клавиатура, фото, состояние); None — продолжить нечем."""
+    if category_key == "bouquets":
+        return "🎀 Выберите цвет обёртки:", keyboards.wraps, WRAPS_PHOTO_PATH, CHOOSING_WRAP_COLOR
+    if category_key == "sets":
+        reply_markup = keyboards.set_fillings(item_key)
+        if reply_markup is not None:
+            return "🍬 Выберите наполнение набора:", reply_markup, None, CHOOSING_SET_FILLING
+    return None
+
+def order_draft(context: ContextTypes.DEFAULT_TYPE):
+    # Черновика нет, если диалог начат до их появления — начинаем новый
+    draft = context.user_data.get("draft")
+    if draft is None:
+        draft = context.user_data["draft"] = OrderDraft()
+    return draft
+
+def describe_draft(draft):
+    """Черновик с названиями из каталога — для сводки, менеджера и журнала заказов."""
+    category = CATEGORIES.get(draft.category, {})
+    return {
+        "category": draft.category,
+        "item_key": draft.item_key,
+        "item_name": category.get("items", {}).get(draft.item_key),
+        "wrap_color": WRAP_COLORS.get(draft.wrap),
+        "filling": FILLINGS.get(draft.filling),
+        "set_filling": SET_FILLINGS.get(draft.set_filling),
+        "ribbon_color": RIBBON_COLORS.get(draft.ribbon),
+        "color_preferences": draft.color_preferences,
+        "price": draft.price,
+    }
 
-def build_item_keyboard(category_key):
-    items = CATEGORIES[category_key]["items"]
-    keyboard = [[InlineKeyboardButton(name, callback_data=f"item_{key}")] for key, name in items.items()]
-    keyboard.append(build_back_to_categories_button())
-    return keyboard
+def finish_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Диалог закончен — черновик больше не нужен ни в памяти, ни в базе
+    context.application.drop_user_data(update.effective_user.id)
+    return ConversationHandler.END
 
 # === ОБРАБОТЧИКИ ===
 
+async def reject_stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Кнопка из старой версии каталога или подделанные данные: дальше не пускаем,
+    # даже если ответить на нажатие не удалось (запрос слишком старый, сеть, RetryAfter)
+    try:
+        await update.callback_query.answer("Эта кнопка устарела. Отправьте /start, чтобы начать заново.")
+    except Exception as e:
+        logger.warning("Не удалось ответить на устаревшую кнопку: %s", e)
+    raise ApplicationHandlerStop
+
+async def expired_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Кнопка живая, но диалога уже нет: заказ завершён или вытеснен по CONVERSATION_TTL
+    await update.callback_query.answer("Время оформления заказа истекло. Отправьте /start, чтобы начать заново.")
+
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()
+    draft = context.user_data["draft"] = OrderDraft()
     await update.message.reply_text("Здравствуйте!")
-    reply_markup = InlineKeyboardMarkup(build_category_keyboard())
-    await update.message.reply_text("Выберите, что вас интересует:", reply_markup=reply_markup)
+
+    # «/start <данные кнопки>» — переход из инлайн-поиска: сразу к выбранной категории или позиции.
+    # Устаревшие данные (каталог с тех пор менялся) и CATALOG_START ведут в начало каталога
+    route = callback_router.resolve(context.args[0]) if context.args else None
+    if route is not None and route.action == "category":
+        draft.category = route.key
+        await update.message.reply_text("Выберите позицию:", reply_markup=keyboards.items(route.key))
+        return CHOOSING_ITEM
+    if route is not None and route.action == "item":
+        step = item_step(route.parent, route.key)
+        if step is not None:
+            draft.category, draft.item_key = route.parent, route.key
+            text, reply_markup, photo_path, state = step
+            await send_step(update, context, text, reply_markup, photo_path)
+            return state
+
+    await update.message.reply_text("Выберите, что вас интересует:", reply_markup=keyboards.categories)
     return CHOOSING_CATEGORY
 
+@timed
 async def choose_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    # Устаревшие кнопки отсекает reject_stale_callback; сюда они доходят, только если он не сработал
+    if route is None:
+        return CHOOSING_CATEGORY
 
-    if data == "back_to_categories":
-        reply_markup = InlineKeyboardMarkup(build_category_keyboard())
-        await query.edit_message_text("Выберите, что вас интересует:", reply_markup=reply_markup)
+    if route.action == "back_to_categories":
+        await show_step(update, context, "Выберите, что вас интересует:", keyboards.categories)
         return CHOOSING_CATEGORY
 
-    if data.startswith("category_"):
-        category_key = data.split("_", 1)[1]
-        context.user_data["category"] = category_key
-        keyboard = build_item_keyboard(category_key)
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("Выберите позицию:", reply_markup=reply_markup)
+    if route.action == "category":
+        category_key = route.key
+        order_draft(context).category = category_key
+        await show_step(update, context, "Выберите позицию:", keyboards.items(category_key))
         return CHOOSING_ITEM
 
     return CHOOSING_CATEGORY
 
+@timed
 async def choose_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CHOOSING_ITEM
 
-    if data == "back_to_categories":
-        reply_markup = InlineKeyboardMarkup(build_category_keyboard())
-        await query.edit_message_text("Выберите, что вас интересует:", reply_markup=reply_markup)
+    if route.action == "back_to_categories":
+        await show_step(update, context, "Выберите, что вас интересует:", keyboards.categories)
         return CHOOSING_CATEGORY
 
-    if data.startswith("item_"):
-        item_key = data.split("_", 1)[1]
-        category_key = context.user_data.get("category")
-        if not category_key or category_key not in CATEGORIES:
-            await query.edit_message_text("Ошибка. Начните с /start.")
-            return ConversationHandler.END
-
-        item_name = CATEGORIES[category_key]["items"][item_key]
-        context.user_data.update({"item_key": item_key, "item_name": item_name})
-
-        if category_key == "bouquets":
-            photo_path = "Photos/wraps_overview.jpg"
-            if os.path.exists(photo_path):
-                with open(photo_path, "rb") as photo:
-                    await context.bot.send_photo(
-                        chat_id=update.effective_chat.id,
-                        photo=photo,
-                        caption="🎀 Выберите цвет обёртки:",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton(name, callback_data=f"wrap_{key}")]
-                            for key, name in WRAP_COLORS.items()
-                        ] + [build_back_to_bouquets_button()])
-                    )
-            else:
-                await update.effective_message.reply_text(
-                    "🎀 Выберите цвет обёртки:",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton(name, callback_data=f"wrap_{key}")]
-                        for key, name in WRAP_COLORS.items()
-                    ] + [build_back_to_bouquets_button()])
-                )
-            try:
-                await query.message.delete()
-            except:
-                pass
-            return CHOOSING_WRAP_COLOR
-
-        elif category_key == "sets":
-            allowed_fills = SET_FILLING_RULES.get(item_key, list(SET_FILLINGS.keys()))
-            keyboard = [
-                [InlineKeyboardButton(SET_FILLINGS[key], callback_data=f"setfill_{key}")]
-                for key in allowed_fills if key in SET_FILLINGS
-            ]
-            if not keyboard:
-                await query.edit_message_text("❌ Нет доступных вариантов наполнения.")
-                return ConversationHandler.END
-            keyboard.append(build_back_to_sets_button())
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("🍬 Выберите наполнение набора:", reply_markup=reply_markup)
-            return CHOOSING_SET_FILLING
+    if route.action == "item":
+        item_key = route.key
+        draft = order_draft(context)
+        category_key = draft.category
+        if category_key != route.parent:
+            await show_step(update, context, "Ошибка. Начните с /start.")
+            return finish_order(update, context)
+
+        draft.item_key = item_key
+
+        step = item_step(category_key, item_key)
+        if step is None:
+            await show_step(update, context, "❌ Нет доступных вариантов наполнения.")
+            return finish_order(update, context)
+        text, reply_markup, photo_path, state = step
+        await show_step(update, context, text, reply_markup, photo_path=photo_path)
+        return state
 
     return CHOOSING_ITEM
 
 # --- ПУТЬ ДЛЯ БУКЕТОВ ---
+@timed
 async def choose_wrap_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-
-    try:
-        await query.message.delete()
-    except Exception as e:
-        logger.warning(f"Не удалось удалить сообщение с обёрткой: {e}")
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CHOOSING_WRAP_COLOR
 
-    if query.data == "back_to_bouquets":
-        keyboard = build_item_keyboard("bouquets")
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.effective_chat.send_message("Выберите букет:", reply_markup=reply_markup)
+    if route.action == "back_to_bouquets":
+        await show_step(update, context, "Выберите букет:", keyboards.items("bouquets"))
         return CHOOSING_ITEM
 
-    if query.data.startswith("wrap_"):
-        key = query.data.split("_", 1)[1]
-        if key not in WRAP_COLORS:
-            return CHOOSING_WRAP_COLOR
-        context.user_data["wrap_color"] = WRAP_COLORS[key]
-        keyboard = [
-            [InlineKeyboardButton(name, callback_data=f"fillb_{k}")]
-            for k, name in FILLINGS.items()
-        ]
-        keyboard.append(build_back_to_bouquets_button())
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.effective_chat.send_message("🌿 Выберите наполнение букета:", reply_markup=reply_markup)
+    if route.action == "wrap":
+        order_draft(context).wrap = route.key
+        await show_step(update, context, "🌿 Выберите наполнение букета:", keyboards.fillings)
         return CHOOSING_FILLING
 
     return CHOOSING_WRAP_COLOR
 
+@timed
 async def choose_filling(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CHOOSING_FILLING
 
-    if data == "back_to_bouquets":
-        keyboard = build_item_keyboard("bouquets")
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            await query.message.delete()
-        except:
-            pass
-        await update.effective_chat.send_message("Выберите букет:", reply_markup=reply_markup)
+    if route.action == "back_to_bouquets":
+        await show_step(update, context, "Выберите букет:", keyboards.items("bouquets"))
         return CHOOSING_ITEM
 
-    if data.startswith("fillb_"):
-        key = data.split("_", 1)[1]
-        if key not in FILLINGS:
-            return CHOOSING_FILLING
-        context.user_data["filling"] = FILLINGS[key]
-        keyboard = [
-            [InlineKeyboardButton(name, callback_data=f"ribbonb_{k}")]
-            for k, name in RIBBON_COLORS.items()
-        ]
-        keyboard.append(build_back_to_bouquets_button())
-
-        photo_path = "Photos/ribbon_overview.png"
-        if os.path.exists(photo_path):
-            with open(photo_path, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo,
-                    caption="🎀 Выберите цвет подарочной ленты:",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-        else:
-            await update.effective_chat.send_message(
-                "🎀 Выберите цвет подарочной ленты:",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-
-        try:
-            await query.message.delete()
-        except:
-            pass
+    if route.action == "fillb":
+        order_draft(context).filling = route.key
+        await show_step(
+            update, context, "🎀 Выберите цвет подарочной ленты:", keyboards.ribbons_bouquet,
+            photo_path=RIBBON_PHOTO_PATH
+        )
         return CHOOSING_RIBBON_COLOR_BOUQUET
 
     return CHOOSING_FILLING
 
+@timed
 async def choose_ribbon_color_bouquet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-
-    try:
-        await query.message.delete()
-    except Exception as e:
-        logger.warning(f"Не удалось удалить сообщение с лентой: {e}")
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CHOOSING_RIBBON_COLOR_BOUQUET
 
-    if query.data == "back_to_bouquets":
-        keyboard = build_item_keyboard("bouquets")
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.effective_chat.send_message("Выберите букет:", reply_markup=reply_markup)
+    if route.action == "back_to_bouquets":
+        await show_step(update, context, "Выберите букет:", keyboards.items("bouquets"))
         return CHOOSING_ITEM
 
-    if query.data.startswith("ribbonb_"):
-        key = query.data.split("_", 1)[1]
-        if key not in RIBBON_COLORS:
-            return CHOOSING_RIBBON_COLOR_BOUQUET
-        context.user_data["ribbon_color"] = RIBBON_COLORS[key]
-        await update.effective_chat.send_message("🎨 Напишите пожелания по цветовой палитре (например: «Нежные пастельные тона»):")
+    if route.action == "ribbonb":
+        order_draft(context).ribbon = route.key
+        await show_step(update, context, "🎨 Напишите пожелания по цветовой палитре (например: «Нежные пастельные тона»):")
         return TYPING_COLOR_PREFERENCES
 
     return CHOOSING_RIBBON_COLOR_BOUQUET
 
+@timed
 async def receive_color_preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    color_pref = update.message.text
-    context.user_data["color_preferences"] = color_pref
+    order_draft(context).color_preferences = update.message.text
     await update.message.reply_text("💰 Укажите желаемую цену букета (не менее 1000руб!):")
     return TYPING_PRICE_BOUQUET
 
+@timed
 async def receive_price_bouquet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    price = update.message.text.strip()
-    context.user_data["price"] = price
+    draft = order_draft(context)
+    draft.price = update.message.text.strip()
 
-    item = context.user_data["item_name"]
+    order = describe_draft(draft)
     summary = (
         f"📦 Вы выбрали:\n\n"
-        f"• Товар: {item}\n"
-        f"• Обёртка: {context.user_data['wrap_color']}\n"
-        f"• Наполнение: {context.user_data['filling']}\n"
-        f"• Лента: {context.user_data['ribbon_color']}\n"
-        f"• Палитра: _{context.user_data['color_preferences']}_\n"
-        f"• Желаемая цена: {price}\n\n"
+        f"• Товар: {order['item_name']}\n"
+        f"• Обёртка: {order['wrap_color']}\n"
+        f"• Наполнение: {order['filling']}\n"
+        f"• Лента: {order['ribbon_color']}\n"
+        f"• Палитра: _{order['color_preferences']}_\n"
+        f"• Желаемая цена: {order['price']}\n\n"
         f"✅ Подтвердить заказ?"
     )
 
-    keyboard = [
-        [InlineKeyboardButton("✅ Да, всё верно", callback_data="confirm_final")],
-        [InlineKeyboardButton("❌ Начать заново", callback_data="restart")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(summary, reply_markup=reply_markup, parse_mode="Markdown")
+    await update.message.reply_text(summary, reply_markup=keyboards.confirm, parse_mode="Markdown")
     return CONFIRMING
 
 # --- ПУТЬ ДЛЯ НАБОРОВ ---
+@timed
 async def choose_set_filling(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CHOOSING_SET_FILLING
 
-    try:
-        await query.message.delete()
-    except Exception as e:
-        logger.warning(f"Не удалось удалить сообщение с наполнением набора: {e}")
-
-    if query.data == "back_to_sets":
-        keyboard = build_item_keyboard("sets")
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.effective_chat.send_message("Выберите набор:", reply_markup=reply_markup)
+    if route.action == "back_to_sets":
+        await show_step(update, context, "Выберите набор:", keyboards.items("sets"))
         return CHOOSING_ITEM
 
-    if query.data.startswith("setfill_"):
-        key = query.data.split("_", 1)[1]
-        if key not in SET_FILLINGS:
-            return CHOOSING_SET_FILLING
-        context.user_data["set_filling"] = SET_FILLINGS[key]
-
-        # ИСПРАВЛЕНО: путь к фото — без Jarvis/
-        photo_path = "Photos/ribbon_overview.png"
-        if os.path.exists(photo_path):
-            with open(photo_path, "rb") as photo:
-                keyboard = [
-                    [InlineKeyboardButton(name, callback_data=f"ribbons_{key}")]
-                    for key, name in RIBBON_COLORS.items()
-                ]
-                keyboard.append(build_back_to_sets_button())
-                reply_markup = InlineKeyboardMarkup(keyboard)
-
-                await context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo,
-                    caption="🎀 Выберите цвет подарочной ленты:",
-                    reply_markup=reply_markup
-                )
-        else:
-            keyboard = [
-                [InlineKeyboardButton(name, callback_data=f"ribbons_{key}")]
-                for key, name in RIBBON_COLORS.items()
-            ]
-            keyboard.append(build_back_to_sets_button())
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.effective_chat.send_message(
-                "🎀 Выберите цвет подарочной ленты:",
-                reply_markup=reply_markup
-            )
+    if route.action == "setfill":
+        order_draft(context).set_filling = route.key
+        await show_step(
+            update, context, "🎀 Выберите цвет подарочной ленты:", keyboards.ribbons_set,
+            photo_path=RIBBON_PHOTO_PATH
+        )
         return CHOOSING_RIBBON_COLOR_SET
 
     return CHOOSING_SET_FILLING
 
+@timed
 async def choose_ribbon_color_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-
-    try:
-        await query.message.delete()
-    except Exception as e:
-        logger.warning(f"Не удалось удалить сообщение с лентой: {e}")
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CHOOSING_RIBBON_COLOR_SET
 
-    if query.data == "back_to_sets":
-        keyboard = build_item_keyboard("sets")
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.effective_chat.send_message("Выберите набор:", reply_markup=reply_markup)
+    if route.action == "back_to_sets":
+        await show_step(update, context, "Выберите набор:", keyboards.items("sets"))
         return CHOOSING_ITEM
 
-    if query.data.startswith("ribbons_"):
-        key = query.data.split("_", 1)[1]
-        if key not in RIBBON_COLORS:
-            return CHOOSING_RIBBON_COLOR_SET
-        context.user_data["ribbon_color"] = RIBBON_COLORS[key]
-        await update.effective_chat.send_message("💰 Укажите желаемую цену набора (не менее 500 руб):")
+    if route.action == "ribbons":
+        order_draft(context).ribbon = route.key
+        await show_step(update, context, "💰 Укажите желаемую цену набора (не менее 500 руб):")
         return TYPING_PRICE_SET
 
     return CHOOSING_RIBBON_COLOR_SET
 
+@timed
 async def receive_price_set(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    price = update.message.text.strip()
-    context.user_data["price"] = price
+    draft = order_draft(context)
+    draft.price = update.message.text.strip()
 
-    item = context.user_data["item_name"]
+    order = describe_draft(draft)
     summary = (
         f"📦 Вы выбрали:\n\n"
-        f"• Товар: {item}\n"
-        f"• Наполнение: {context.user_data['set_filling']}\n"
-        f"• Лента: {context.user_data['ribbon_color']}\n"
-        f"• Желаемая цена: {price}\n\n"
+        f"• Товар: {order['item_name']}\n"
+        f"• Наполнение: {order['set_filling']}\n"
+        f"• Лента: {order['ribbon_color']}\n"
+        f"• Желаемая цена: {order['price']}\n\n"
         f"✅ Подтвердить заказ?"
     )
 
-    keyboard = [
-        [InlineKeyboardButton("✅ Да, всё верно", callback_data="confirm_final")],
-        [InlineKeyboardButton("❌ Начать заново", callback_data="restart")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(summary, reply_markup=reply_markup, parse_mode="Markdown")
+    await update.message.reply_text(summary, reply_markup=keyboards.confirm, parse_mode="Markdown")
     return CONFIRMING
 
 # --- ПОДТВЕРЖДЕНИЕ ---
+@timed
 async def confirm_final(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
+    answer_in_background(context, query)
+    route = callback_router.resolve(query.data)
+    if route is None:
+        return CONFIRMING
 
-    if data == "restart":
+    if route.action == "restart":
         await query.edit_message_text("Чтобы начать заново, отправьте команду /start.")
-        return ConversationHandler.END
+        return finish_order(update, context)
 
-    if data == "confirm_final":
+    if route.action == "confirm_final":
         user = update.effective_user
-        ud = context.user_data
-        category = ud["category"]
+        order = describe_draft(order_draft(context))
+        if order["item_name"] is None:
+            await query.edit_message_text("Ошибка. Начните с /start.")
+            return finish_order(update, context)
 
-        if category == "bouquets":
+        if order["category"] == "bouquets":
             details = (
-                f"Товар: {ud['item_name']}\n"
-                f"Обёртка: {ud['wrap_color']}\n"
-                f"Наполнение: {ud['filling']}\n"
-                f"Лента: {ud['ribbon_color']}\n"
-                f"Палитра: _{ud['color_preferences']}_\n"
-                f"Желаемая цена: {ud['price']}\n"
+                f"Товар: {order['item_name']}\n"
+                f"Обёртка: {order['wrap_color']}\n"
+                f"Наполнение: {order['filling']}\n"
+                f"Лента: {order['ribbon_color']}\n"
+                f"Палитра: _{order['color_preferences']}_\n"
+                f"Желаемая цена: {order['price']}\n"
             )
         else:
             details = (
-                f"Товар: {ud['item_name']}\n"
-                f"Наполнение: {ud['set_filling']}\n"
-                f"Лента: {ud['ribbon_color']}\n"
-                f"Желаемая цена: {ud['price']}\n"
+                f"Товар: {order['item_name']}\n"
+                f"Наполнение: {order['set_filling']}\n"
+                f"Лента: {order['ribbon_color']}\n"
+                f"Желаемая цена: {order['price']}\n"
             )
 
         order_info = (
@@ -504,24 +625,275 @@ async def confirm_final(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"{details}"
         )
 
-        await query.edit_message_text("✅ Ваш заказ принят!\nМенеджер свяжется с вами в ближайшее время.")
+        try:
+            await order_store.add(user, order)
+        except Exception as e:
+            logger.error("Не удалось записать заказ в журнал: %s", e)
 
+        # Сначала сохраняем заказ локально: менеджеру он уйдёт из очереди в фоне
         try:
-            await context.bot.send_message(chat_id=MANAGER_CHAT_ID, text=order_info, parse_mode="Markdown")
+            await outbox.put(MANAGER_CHAT_ID, order_info, parse_mode="Markdown")
         except Exception as e:
-            logger.error(f"Ошибка отправки менеджеру: {e}")
+            logger.error("Не удалось поставить заказ в очередь, отправляем напрямую: %s", e)
+            try:
+                await context.bot.send_message(chat_id=MANAGER_CHAT_ID, text=order_info, parse_mode="Markdown")
+            except Exception as e:
+                logger.error("Ошибка отправки менеджеру: %s", e)
+
+        metrics.orders.inc()
+        await query.edit_message_text("✅ Ваш заказ принят!\nМенеджер свяжется с вами в ближайшее время.")
 
-        return ConversationHandler.END
+        return finish_order(update, context)
 
     return CONFIRMING
 
+@timed
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Заказ отменён. Отправьте /start, чтобы начать заново.")
-    return ConversationHandler.END
+    return finish_order(update, context)
+
+# --- ИНЛАЙН-ПОИСК ---
+@timed
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Ответ одинаков для всех: Telegram кеширует его на INLINE_CACHE_TIME, а мы — готовые результаты в LRU
+    query = update.inline_query
+    await query.answer(
+        catalog_search.results(query.query, context.bot.username),
+        cache_time=INLINE_CACHE_TIME,
+        button=InlineQueryResultsButton("Открыть каталог", start_parameter=CATALOG_START),
+    )
+
+# --- ДЛЯ МЕНЕДЖЕРА ---
+async def outbox_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await outbox.refresh_depth()
+    stats = outbox.stats()
+
+    def fmt(seconds):
+        return "—" if seconds is None else f"{seconds:.1f} с"
+
+    await update.message.reply_text(
+        f"📬 Очередь уведомлений\n\n"
+        f"В очереди: {stats['depth']}\n"
+        f"Доставлено: {stats['delivered']}\n"
+        f"Неудачных попыток: {stats['failed_attempts']}\n"
+        f"Задержка доставки: последняя {fmt(stats['latency_last'])}, "
+        f"медиана {fmt(stats['latency_p50'])}, максимум {fmt(stats['latency_max'])}"
+    )
+
+async def handler_timings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    rows = timings.summary()
+    if not rows:
+        await update.message.reply_text("⏱ Замеров пока нет.")
+        return
+
+    lines = [
+        f"{row['handler']}: {row['count']} шт., p50 {row['p50'] * 1000:.0f} мс, "
+        f"p95 {row['p95'] * 1000:.0f} мс, макс {row['max'] * 1000:.0f} мс"
+        for row in rows
+    ]
+    first = f"\n\nПервый ответ после запуска: через {timings.first_response:.1f} с" if timings.first_response else ""
+    await update.message.reply_text("⏱ Время обработчиков\n\n" + "\n".join(lines) + first)
+
+def parse_order_filter(argument):
+    """Фильтр /orders: категория, ключ товара, id пользователя или дата ГГГГ-ММ-ДД. None — не разобрали."""
+    if not argument:
+        return {}
+    if argument in CATEGORIES:
+        return {"category": argument}
+    if any(argument in category["items"] for category in CATEGORIES.values()):
+        return {"item_key": argument}
+    if argument.lstrip("-").isdigit():
+        return {"user_id": int(argument)}
+    try:
+        day = datetime.strptime(argument, "%Y-%m-%d")
+    except ValueError:
+        return None
+    return {"since": day.timestamp(), "until": (day + timedelta(days=1)).timestamp()}
+
+async def orders_view(argument, order_filter, before=None, after=None):
+    rows, has_newer, has_older = await order_store.page(order_filter, before=before, after=after)
+    if not rows:
+        return "🗂 Заказов не найдено.", None
+
+    lines = [
+        f"#{order.id} · {datetime.fromtimestamp(order.created_at):%d.%m.%Y %H:%M} · {order.item_name} · "
+        f"{order.price} · {order.full_name} (@{order.username or 'нет'}, {order.user_id})"
+        for order in rows
+    ]
+    # В данных кнопки — курсор (id крайнего заказа на странице) и исходный фильтр
+    buttons = []
+    if has_newer:
+        newer = f"{ORDERS_CALLBACK_PREFIX}>{rows[0].id}:{argument}"
+        buttons.append(InlineKeyboardButton("← Новее", callback_data=newer))
+    if has_older:
+        older = f"{ORDERS_CALLBACK_PREFIX}<{rows[-1].id}:{argument}"
+        buttons.append(InlineKeyboardButton("Старше →", callback_data=older))
+    title = f"🗂 Заказы{f' ({argument})' if argument else ''}"
+    return title + "\n\n" + "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    argument = context.args[0] if context.args else ""
+    order_filter = parse_order_filter(argument)
+    if order_filter is None:
+        await update.message.reply_text(
+            "Использование: /orders [bouquets | sets | ключ товара | id пользователя | ГГГГ-ММ-ДД]"
+        )
+        return
+    text, reply_markup = await orders_view(argument, order_filter)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def orders_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    answer_in_background(context, query)
+    if update.effective_chat.id != MANAGER_CHAT_ID:
+        return
+
+    cursor, _, argument = query.data[len(ORDERS_CALLBACK_PREFIX):].partition(":")
+    order_filter = parse_order_filter(argument)
+    if order_filter is None or cursor[:1] not in ("<", ">") or not cursor[1:].isdigit():
+        return
+    order_id = int(cursor[1:])
+    if cursor[0] == "<":
+        text, reply_markup = await orders_view(argument, order_filter, before=order_id)
+    else:
+        text, reply_markup = await orders_view(argument, order_filter, after=order_id)
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+BROADCAST_STATUSES = {"draft": "ждёт подтверждения", "running": "идёт", "done": "завершена", "cancelled": "отменена"}
+
+def format_duration(seconds):
+    minutes = round(seconds / 60)
+    if minutes < 1:
+        return "меньше минуты"
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60} мин"
+
+def broadcast_report(broadcast):
+    lines = [
+        f"📣 Рассылка #{broadcast.id}: {BROADCAST_STATUSES.get(broadcast.status, broadcast.status)}",
+        f"Получателей: {broadcast.total}",
+        f"Отправлено: {broadcast.sent}, ошибок: {broadcast.failed}, заблокировали бота: {broadcast.blocked}",
+    ]
+    if broadcast.status == "running":
+        eta = broadcast.eta()
+        lines.append(f"Осталось: {format_duration(eta) if eta is not None else 'оцениваем…'}")
+    return "\n".join(lines)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Текст берём целиком, с переносами строк, а не из context.args
+    parts = update.message.text.split(maxsplit=1)
+    argument = parts[1].strip() if len(parts) > 1 else ""
+
+    if not argument:
+        broadcast = await broadcaster.latest()
+        await update.message.reply_text(
+            broadcast_report(broadcast) if broadcast else
+            "Рассылок ещё не было.\n\n"
+            "/broadcast <текст> — разослать всем, кто заказывал\n/broadcast cancel — остановить"
+        )
+        return
+
+    if argument == "cancel":
+        broadcast = await broadcaster.latest()
+        if broadcast is not None and await broadcaster.cancel(broadcast.id):
+            await update.message.reply_text(broadcast_report(await broadcaster.get(broadcast.id)))
+        else:
+            await update.message.reply_text("Нет рассылки, которую можно остановить.")
+        return
+
+    broadcast = await broadcaster.create(argument)
+    # Сначала само сообщение — ровно так, как его увидят покупатели
+    await update.message.reply_text(argument)
+    buttons = [[
+        InlineKeyboardButton("Отправить", callback_data=f"{BROADCAST_CALLBACK_PREFIX}go:{broadcast.id}"),
+        InlineKeyboardButton("Отмена", callback_data=f"{BROADCAST_CALLBACK_PREFIX}no:{broadcast.id}"),
+    ]]
+    await update.message.reply_text(
+        f"📣 Рассылка #{broadcast.id}\n\nПолучателей: {broadcast.total}\n"
+        f"Займёт около: {format_duration(broadcast.total / BROADCAST_RATE)}\n\nОтправить сообщение выше?",
+        reply_markup=InlineKeyboardMarkup(buttons),
+    )
+
+async def broadcast_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    answer_in_background(context, query)
+    if update.effective_chat.id != MANAGER_CHAT_ID:
+        return
+
+    action, _, broadcast_id = query.data[len(BROADCAST_CALLBACK_PREFIX):].partition(":")
+    if not broadcast_id.isdigit():
+        return
+    broadcast_id = int(broadcast_id)
+    if action == "go":
+        if await broadcaster.launch(broadcast_id):
+            text = f"🚀 Рассылка #{broadcast_id} запущена. Прогресс — /broadcast"
+        else:
+            text = f"Рассылка #{broadcast_id} уже запущена или отменена."
+    elif action == "no":
+        await broadcaster.cancel(broadcast_id)
+        text = f"Рассылка #{broadcast_id} отменена."
+    else:
+        return
+    await query.edit_message_text(text)
+
+# === ЖИЗНЕННЫЙ ЦИКЛ ===
+async def post_init(application: Application) -> None:
+    await outbox.start(application.bot, drain=application.bot_data["worker"] == 0)
+    await broadcaster.start(application.bot, run=application.bot_data["worker"] == 0)
+    application.persistence.start_eviction(application)
+
+async def warm_up(application: Application) -> None:
+    # Каталог и клавиатуры собраны при импорте модуля; здесь — соединения и фото
+    await asyncio.gather(
+        warm_connections(application.bot, min(WARM_CONNECTIONS, HTTP_POOL_SIZE)),
+        media_registry.start(MEDIA_POLL_INTERVAL),
+    )
+    for path in (WRAPS_PHOTO_PATH, RIBBON_PHOTO_PATH):
+        if not media_registry.available(path):
+            logger.warning("Фото %s не найдено, шаг покажется без него", path)
+
+async def post_stop(application: Application) -> None:
+    await application.persistence.stop_eviction()
+    # До Application.shutdown(): после него HTTP-клиент бота уже закрыт
+    # Рассылка — первой: о её завершении сообщается через outbox, а получатели читаются из order_store
+    await broadcaster.stop()
+    await outbox.stop()
+    await order_store.close()
+    await media_registry.stop()
 
 # === ЗАПУСК ===
-def main() -> None:
-    application = Application.builder().token(BOT_TOKEN).build()
+def base_builder():
+    builder = Application.builder()
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+    # Вебхук принимает свой сервер (server.py или cluster.py), Updater не нужен
+    request = make_request(
+        HTTP_POOL_SIZE, MEDIA_POOL_SIZE, HTTP_KEEPALIVE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,
+        HTTP_WRITE_TIMEOUT, HTTP_POOL_TIMEOUT, MEDIA_WRITE_TIMEOUT, http2=HTTP2,
+    )
+    return builder.token(BOT_TOKEN).request(request).updater(None)
+
+def build_application(worker=0):
+    # Незаконченные заказы переживают деплой и падения
+    persistence = SQLitePersistence(STATE_DB_PATH, update_interval=STATE_FLUSH_INTERVAL, ttl=CONVERSATION_TTL)
+    # Разные пользователи обрабатываются параллельно, апдейты одного — строго по очереди
+    update_processor = PerUserUpdateProcessor(CONCURRENT_UPDATES)
+    application = (
+        base_builder()
+        .persistence(persistence)
+        .concurrent_updates(update_processor)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
+    update_processor.bind(application)
+    application.bot_data["worker"] = worker
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -539,20 +911,84 @@ def main() -> None:
             CONFIRMING: [CallbackQueryHandler(confirm_final)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        # /start из инлайн-поиска должен сработать и посреди незаконченного заказа
+        allow_reentry=True,
         per_message=False,
+        name="order",
+        persistent=True,
     )
 
+    metrics.register_conversation(conv_handler, STATE_NAMES)
+    metrics.gauge("update_queue_depth", "Апдейты, ждущие в update_queue", application.update_queue.qsize)
+    metrics.gauge("updates_in_flight", "Апдейты в обработке", lambda: update_processor.in_flight)
+    # Диалоги, загруженные в память и не завершённые
+    metrics.gauge(
+        "active_conversations", "Незавершённые диалоги в памяти",
+        lambda: sum(len(c) for c in application._conversation_handler_conversations.values())
+    )
+    metrics.gauge("outbox_depth", "Уведомления менеджеру в очереди", lambda: outbox.depth)
+
+    # Двойные нажатия и флуд отсекаются раньше всего остального
+    anti_flood = AntiFlood(DUPLICATE_TAP_WINDOW, FLOOD_RATE, FLOOD_BURST)
+    application.add_handler(anti_flood.handler(), group=ANTIFLOOD_GROUP)
+    application.add_handler(persistence.preload_handler(), group=PRELOAD_GROUP)
+    # Все неизвестные callback_data отсекаются здесь, обработчики получают только валидные маршруты
+    application.add_handler(CallbackQueryHandler(reject_stale_callback, pattern=callback_router.is_stale), group=-1)
+    # Листание /orders и кнопки рассылки — раньше диалога: его CallbackQueryHandler принимает любые данные
+    application.add_handler(CallbackQueryHandler(orders_page, pattern=f"^{ORDERS_CALLBACK_PREFIX}"))
+    application.add_handler(CallbackQueryHandler(broadcast_button, pattern=f"^{BROADCAST_CALLBACK_PREFIX}"))
     application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(expired_callback))
+    application.add_handler(InlineQueryHandler(inline_search))
+    application.add_handler(CommandHandler("orders", orders_command, filters=filters.Chat(MANAGER_CHAT_ID)))
+    application.add_handler(CommandHandler("outbox", outbox_status, filters=filters.Chat(MANAGER_CHAT_ID)))
+    application.add_handler(CommandHandler("timings", handler_timings, filters=filters.Chat(MANAGER_CHAT_ID)))
+    application.add_handler(CommandHandler("broadcast", broadcast_command, filters=filters.Chat(MANAGER_CHAT_ID)))
+    return application
 
+def main() -> None:
     # === ЗАПУСК ТОЛЬКО WEBHOOK ===
     WEBHOOK_URL = os.getenv("WEBHOOK_URL")
     PORT = int(os.environ.get("PORT", 8000))
 
-    application.run_webhook(
+    # Выгрузка заказов живёт рядом с вебхуком; в кластере её отдаёт входной процесс
+    extra_routes = [(r"/orders\.csv", OrdersCsvHandler, {"store": order_store, "token": ORDERS_EXPORT_TOKEN})]
+    # Запись трафика для benchmarks/replay.py; в кластере пишет входной процесс
+    capture = UpdateCapture(CAPTURE_PATH, CAPTURE_SALT, MANAGER_CHAT_ID) if CAPTURE_PATH else None
+
+    if WORKERS > 1:
+        run_cluster(
+            build_application,
+            WORKERS,
+            bot=base_builder().build().bot,
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            metrics_port=WORKER_METRICS_PORT,
+            metrics_token=METRICS_TOKEN,
+            extra_routes=extra_routes,
+            warm_up=warm_up,
+            secret_token=WEBHOOK_SECRET,
+            webhook_state_path=WEBHOOK_STATE_PATH,
+            pending_limit=UPDATE_QUEUE_SIZE,
+            capture=capture,
+        )
+        return
+
+    # Свой сервер вместо application.run_webhook: рядом с вебхуком отдаётся /metrics
+    run_webhook(
+        build_application(),
         listen="0.0.0.0",
         port=PORT,
         url_path=BOT_TOKEN,
-        webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}"
+        webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        metrics_token=METRICS_TOKEN,
+        extra_routes=extra_routes,
+        warm_up=warm_up,
+        secret_token=WEBHOOK_SECRET,
+        webhook_state_path=WEBHOOK_STATE_PATH,
+        capture=capture,
     )
     # ← НИКАКОГО run_polling() НЕТ! ←
 
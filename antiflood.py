@@ -0,0 +1,123 @@
+import logging
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+from handler_utils import run_in_background
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Раньше PRELOAD_GROUP: отброшенный апдейт не поднимает из базы диалоги пользователя.
+# user_data при этом уже загружен: перед вызовом любого подошедшего обработчика, и этого тоже,
+# PTB собирает контекст и вызывает persistence.refresh_user_data — до проверки на флуд
+ANTIFLOOD_GROUP = -200
+
+RATE_LIMIT_TEXT = "Слишком много нажатий, подождите пару секунд 🙂"
+
+
+class _UserState:
+    __slots__ = ("tokens", "updated_at", "last_tap", "last_tap_at")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        self.last_tap = None
+        self.last_tap_at = 0.0
+
+
+class AntiFlood:
+    """Отсекает повторные нажатия и флуд до того, как апдейт дойдёт до обработчиков.
+
+    Повтор — нажатие той же кнопки того же сообщения, что и последнее
+    принятое от пользователя, не позже duplicate_window секунд после него.
+    Апдейты пользователя обрабатываются по очереди, поэтому двойной тап
+    проверяется уже после того, как первый отработал, — сравнение идёт с
+    последним принятым апдейтом, а не только по времени. Кроме того, у каждого
+    пользователя свой token bucket: rate апдейтов в секунду, burst подряд.
+
+    Отброшенный колбэк получает только answerCallbackQuery — вместо удаления
+    и отправки сообщений, которые сделал бы обработчик.
+    """
+
+    def __init__(self, duplicate_window=3.0, rate=3.0, burst=10):
+        self.duplicate_window = duplicate_window
+        self.rate = rate
+        self.burst = burst
+        # Пользователи в порядке последнего апдейта: простаивающие вычищаются с начала
+        self._users = OrderedDict()
+        # Через столько секунд тишины bucket снова полон, а старый тап уже не повтор
+        self._idle_after = max(duplicate_window, burst / rate)
+        self.dropped = metrics.counter("flood_dropped_total", "Апдейты, отброшенные антифлудом", ("reason",))
+        self.answers = metrics.counter("flood_answers_total", "Ответы на отброшенные нажатия")
+        metrics.gauge(
+            "flood_api_calls_saved", "Оценка сэкономленных вызовов Bot API: отброшенные апдейты × "
+            "вызовов на апдейт минус ответы на отброшенные нажатия", self.calls_saved,
+        )
+        self._dropped_total = 0
+        self._answers_total = 0
+
+    def calls_saved(self):
+        return max(0.0, self._dropped_total * metrics.calls_per_update() - self._answers_total)
+
+    def _prune(self, now):
+        while self._users:
+            user_id, state = next(iter(self._users.items()))
+            if now - state.updated_at < self._idle_after:
+                return
+            del self._users[user_id]
+
+    def _state(self, user_id, now):
+        self._prune(now)
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(self.burst, now)
+            return state
+        self._users.move_to_end(user_id)
+        state.tokens = min(self.burst, state.tokens + (now - state.updated_at) * self.rate)
+        state.updated_at = now
+        return state
+
+    def check(self, user_id, tap=None, now=None):
+        """Причина отбросить апдейт ("duplicate" или "rate") или None, если его надо обработать.
+
+        tap — (message_id, data) для нажатия кнопки.
+        """
+        now = time.monotonic() if now is None else now
+        state = self._state(user_id, now)
+        if tap is not None and tap == state.last_tap and now - state.last_tap_at < self.duplicate_window:
+            return "duplicate"
+        if state.tokens < 1:
+            return "rate"
+        state.tokens -= 1
+        state.last_tap = tap
+        state.last_tap_at = now
+        return None
+
+    async def _filter(self, update, context):
+        user = update.effective_user
+        # Инлайн-запрос клиент шлёт на каждый набранный символ: отброшенный последний оставил бы пустой список
+        if user is None or update.inline_query is not None:
+            return
+        query = update.callback_query
+        tap = (query.message.message_id if query.message else query.inline_message_id, query.data) if query else None
+        reason = self.check(user.id, tap)
+        if reason is None:
+            return
+
+        self.dropped.inc(reason)
+        self._dropped_total += 1
+        if query is not None:
+            # «Часики» на кнопке надо убрать в любом случае; текст — только когда жмут слишком часто
+            text = RATE_LIMIT_TEXT if reason == "rate" else None
+            run_in_background(context, query.answer(text), "ответ на отброшенное нажатие")
+            self.answers.inc()
+            self._answers_total += 1
+        logger.debug("Антифлуд отбросил апдейт пользователя %s: %s", user.id, reason)
+        raise ApplicationHandlerStop
+
+    def handler(self):
+        """Обработчик для группы ANTIFLOOD_GROUP."""
+        return TypeHandler(Update, self._filter)
@@ -0,0 +1,148 @@
+"""Рассылка по журналу заказов: наивный цикл send_message против Broadcaster.
+
+Заглушка Bot API ведёт себя как Telegram: больше --limit sendMessage в
+секунду — 429 с retry_after, часть получателей (--blocked) заблокировала
+бота — 403. Наивный цикл шлёт подряд, без пауз: на каждом 429 сообщение
+теряется. Broadcaster идёт через token bucket (--rate) и на RetryAfter
+сам сбавляет скорость; задайте --rate выше --limit, чтобы это увидеть.
+
+Затем рассылка прерывается на середине и запускается заново новым
+экземпляром Broadcaster на той же базе: каждый получатель должен получить
+сообщение ровно один раз.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_broadcast.py --customers 1000 --rate 25
+    python benchmarks/bench_broadcast.py --customers 1000 --rate 45   # выше лимита
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Bot  # noqa: E402
+from telegram.error import Forbidden, RetryAfter  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+from broadcast import Broadcaster  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+from orders import OrderStore  # noqa: E402
+
+BOT_TOKEN = "123456:bench"
+TEXT = "Новогодняя коллекция уже в каталоге: букет «Зимняя сказка» и набор «Ёлочка» 🎄"
+
+
+def fill_orders(store, customers):
+    rows = [
+        (time.time(), 10_000 + index, None, f"Клиент {index}", "bouquets", "b1", "Зимняя сказка")
+        for index in range(customers)
+    ]
+    store._connect().executemany(
+        "INSERT INTO orders (created_at, user_id, username, full_name, category, item_key, item_name) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)", rows,
+    )
+
+
+async def make_bot(api):
+    bot = Bot(BOT_TOKEN, base_url=f"{api.base_url}/bot", request=HTTPXRequest(connection_pool_size=64))
+    await bot.initialize()
+    return bot
+
+
+async def naive(bot, store):
+    sent = throttled = blocked = 0
+    after = 0
+    started = time.perf_counter()
+    while True:
+        customers = await store.customers(after=after)
+        if not customers:
+            break
+        for user_id in customers:
+            try:
+                await bot.send_message(chat_id=user_id, text=TEXT)
+                sent += 1
+            except RetryAfter:
+                throttled += 1
+            except Forbidden:
+                blocked += 1
+        after = customers[-1]
+    return time.perf_counter() - started, sent, throttled, blocked
+
+
+async def run_broadcast(bot, store, path, args, interrupt_after=None):
+    """Рассылка до конца; с interrupt_after — остановка через столько секунд и запуск заново."""
+    broadcaster = Broadcaster(path, store, rate=args.rate, batch_size=args.batch)
+    broadcast = await broadcaster.create(TEXT)
+    await broadcaster.launch(broadcast.id)
+    started = time.perf_counter()
+    await broadcaster.start(bot)
+    retry_after = 0
+    if interrupt_after is not None:
+        await asyncio.sleep(interrupt_after)
+        await broadcaster.stop()
+        retry_after += broadcaster.throttled
+        broadcaster = Broadcaster(path, store, rate=args.rate, batch_size=args.batch)
+        progress = await broadcaster.get(broadcast.id)
+        print(f"  остановлена на {progress.processed} из {progress.total}, перезапуск")
+        await broadcaster.start(bot)
+    while True:
+        current = await broadcaster.get(broadcast.id)
+        if current.status == "done":
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    retry_after += broadcaster.throttled
+    await broadcaster.stop()
+    return elapsed, current, retry_after
+
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="marmeladysh-broadcast-")
+    store = OrderStore(os.path.join(workdir, "orders.sqlite3"))
+    fill_orders(store, args.customers)
+    # Журнал доступа заглушки и предупреждения о каждом 429 заглушили бы таблицу
+    logging.basicConfig(level=logging.ERROR)
+    customers = range(10_000, 10_000 + args.customers)
+    blocked = set(random.Random(1).sample(customers, int(args.customers * args.blocked)))
+    print(f"получателей: {args.customers}, заблокировали бота: {len(blocked)}, лимит заглушки: {args.limit}/с, "
+          f"задержка Bot API: {args.api_latency:.0f} мс\n")
+
+    print(f"{'вариант':<26} {'время, с':>9} {'отправлено':>11} {'потеряно':>9} {'429':>6} {'сообщ./с':>9}")
+    for title in ("наивный цикл", "Broadcaster", "Broadcaster с перезапуском"):
+        api = FakeBotApi(latency=args.api_latency / 1000, send_limit=args.limit)
+        await api.start()
+        api.blocked_chats = blocked
+        bot = await make_bot(api)
+        if title == "наивный цикл":
+            elapsed, sent, throttled, _ = await naive(bot, store)
+            lost = throttled
+        else:
+            path = os.path.join(workdir, f"broadcast-{title}.sqlite3")
+            interrupt = None if title == "Broadcaster" else args.customers / args.rate / 2
+            elapsed, result, throttled = await run_broadcast(bot, store, path, args, interrupt)
+            sent = result.sent
+            lost = args.customers - len(blocked) - len(api.sent_to)
+            duplicates = sum(count - 1 for count in api.sent_to.values() if count > 1)
+            if duplicates:
+                print(f"  повторных сообщений: {duplicates}")
+        print(f"{title:<26} {elapsed:>9.1f} {sent:>11} {lost:>9} {throttled:>6} {sent / elapsed:>9.1f}")
+        await bot.shutdown()
+        await api.stop()
+    await store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=1000)
+    parser.add_argument("--blocked", type=float, default=0.05, help="доля получателей, заблокировавших бота")
+    parser.add_argument("--rate", type=float, default=25, help="скорость Broadcaster, сообщений в секунду")
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=30, help="лимит заглушки, sendMessage в секунду")
+    parser.add_argument("--api-latency", type=float, default=30, help="задержка ответа заглушки Bot API, мс")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,124 @@
+"""Память на пользователя: россыпь ключей в user_data против OrderDraft, и вытеснение по TTL.
+
+Черновики прогоняются через pickle, как при ленивой загрузке из SQLite:
+после неё у каждого пользователя свои копии строк, а не ссылки на каталог.
+Затем 100k незаконченных диалогов кладутся в настоящий Application с
+SQLitePersistence, и evict_idle освобождает их.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_drafts.py --users 100000
+"""
+import argparse
+import asyncio
+import gc
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("MANAGER_CHAT_ID", "0")
+
+from telegram.ext import Application, CommandHandler, ConversationHandler  # noqa: E402
+
+import Bot_Test as bot  # noqa: E402
+from bench_update_processor import OfflineRequest  # noqa: E402
+from drafts import OrderDraft  # noqa: E402
+from persistence import SQLitePersistence  # noqa: E402
+
+
+def legacy_user_data(index):
+    # Так user_data выглядел до черновиков: ключи и копии названий из каталога
+    return {
+        "category": "bouquets",
+        "item_key": "b2",
+        "item_name": bot.CATEGORIES["bouquets"]["items"]["b2"],
+        "wrap_color": bot.WRAP_COLORS["pink"],
+        "filling": bot.FILLINGS["sweetB"],
+        "ribbon_color": bot.RIBBON_COLORS["wblue"],
+        "color_preferences": f"Нежные пастельные тона {index}",
+        "price": str(1000 + index),
+    }
+
+
+def draft_user_data(index):
+    draft = OrderDraft("bouquets")
+    draft.item_key = "b2"
+    draft.wrap = "pink"
+    draft.filling = "sweetB"
+    draft.ribbon = "wblue"
+    draft.color_preferences = f"Нежные пастельные тона {index}"
+    draft.price = str(1000 + index)
+    return {"draft": draft}
+
+
+def measure(factory, users):
+    blobs = [pickle.dumps(factory(index)) for index in range(users)]
+    pickled = sum(map(len, blobs)) / users
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loaded = [pickle.loads(blob) for blob in blobs]
+    in_memory = (tracemalloc.get_traced_memory()[0] - before) / users
+    tracemalloc.stop()
+    del loaded
+    return in_memory, pickled
+
+
+async def eviction(users):
+    workdir = tempfile.mkdtemp(prefix="marmeladysh-bench-")
+    persistence = SQLitePersistence(os.path.join(workdir, "state.sqlite3"), ttl=60)
+    application = Application.builder().token("1:bench").request(OfflineRequest()).persistence(persistence).build()
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("start", bot.start)], states={}, fallbacks=[], name="order", persistent=True,
+    ))
+    await application.initialize()
+    conversations = application._conversation_handler_conversations["order"]
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    long_ago = time.monotonic() - 3600
+    for user_id in range(1, users + 1):
+        # Состояние так же попадает в память при ленивой загрузке из базы
+        application.user_data[user_id].update(pickle.loads(pickle.dumps(draft_user_data(user_id))))
+        conversations.update_no_track({(user_id, user_id): bot.CHOOSING_FILLING})
+        persistence._last_seen[user_id] = long_ago
+    loaded = tracemalloc.get_traced_memory()[0] - baseline
+
+    started = time.perf_counter()
+    evicted = persistence.evict_idle(application)
+    elapsed = time.perf_counter() - started
+    # Пакет удалений копится до записи в базу — это тоже память, отдаём её
+    await persistence._write_task
+    gc.collect()
+    remaining = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    await application.shutdown()
+    return loaded, remaining, evicted, elapsed
+
+
+async def main(args):
+    users = args.users
+    print(f"пользователей: {users}\n")
+    print(f"{'user_data':<22} {'память, Б/польз.':>17} {'pickle, Б/польз.':>17}")
+    for title, factory in (("ключи в user_data", legacy_user_data), ("OrderDraft", draft_user_data)):
+        in_memory, pickled = measure(factory, users)
+        print(f"{title:<22} {in_memory:>17.0f} {pickled:>17.0f}")
+
+    loaded, remaining, evicted, elapsed = await eviction(users)
+    print(f"\nнезаконченные диалоги в Application: {loaded / users:.0f} Б на пользователя, "
+          f"{loaded / 2 ** 20:.1f} МиБ всего")
+    print(f"evict_idle: вытеснено {evicted} за {elapsed * 1000:.0f} мс, "
+          f"осталось {max(remaining, 0) / 2 ** 20:.2f} МиБ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,182 @@
+"""Пропускная способность приёма вебхука: запросов в секунду до update_queue.
+
+Сервер из server.py (WebhookHandler с проверкой секрета) запускается в
+отдельном процессе. Вместо бота из очереди апдейты забирает потребитель с
+заданной скоростью: при 0 — сразу, иначе очередь заполняется и лишнее
+получает 503. Клиенты держат keep-alive соединения и шлют апдейты без пауз.
+Сравниваются разбор через json и через orjson (если установлен).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_ingress.py --connections 32 --duration 5
+    python benchmarks/bench_ingress.py --drain-rate 500 --queue-size 1000   # перегрузка
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from loadtest import free_port, percentile  # noqa: E402
+
+BOT_TOKEN = "123456:ingress"
+SECRET = "ingress-secret"
+
+
+def make_body(update_id, user_id):
+    # Нажатие кнопки — самый частый апдейт в диалоге заказа
+    return json.dumps({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": "1",
+            "data": "w:pink",
+            "from": {"id": user_id, "is_bot": False, "first_name": "Клиент", "language_code": "ru"},
+            "message": {
+                "message_id": 1,
+                "date": 0,
+                "chat": {"id": user_id, "type": "private", "first_name": "Клиент"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"},
+                "text": "🎀 Выберите цвет обёртки:",
+            },
+        },
+    }).encode()
+
+
+def serve(port, parser, queue_size, drain_rate, ready):
+    from types import SimpleNamespace
+
+    from telegram import Bot
+    from tornado.httpserver import HTTPServer
+    from tornado.web import RequestHandler
+
+    import server
+
+    if parser == "json":
+        server.json_loads = json.loads
+
+    async def main():
+        application = SimpleNamespace(bot=Bot(BOT_TOKEN), update_queue=asyncio.Queue(maxsize=queue_size))
+        stats = {"consumed": 0, "max_depth": 0}
+
+        async def consume():
+            while True:
+                await application.update_queue.get()
+                stats["consumed"] += 1
+                if drain_rate:
+                    await asyncio.sleep(1 / drain_rate)
+
+        async def watch_depth():
+            while True:
+                stats["max_depth"] = max(stats["max_depth"], application.update_queue.qsize())
+                await asyncio.sleep(0.01)
+
+        class StatsHandler(RequestHandler):
+            def get(self):
+                self.write(stats)
+
+        app = server.make_app(
+            BOT_TOKEN, webhook_kwargs={"bot_application": application, "secret_token": SECRET},
+            extra_routes=[(r"/stats", StatsHandler)],
+        )
+        HTTPServer(app).listen(port, "127.0.0.1")
+        # Ссылки на задачи держим до конца процесса, иначе их может собрать сборщик мусора
+        background = [asyncio.create_task(consume()), asyncio.create_task(watch_depth())]
+        ready.set()
+        await asyncio.gather(*background)
+
+    asyncio.run(main())
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def client(port, index, deadline, statuses, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    update_id = index * 10_000_000
+    while time.perf_counter() < deadline:
+        update_id += 1
+        body = make_body(update_id, 10_000 + update_id % 1000)
+        writer.write(
+            f"POST /{BOT_TOKEN} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+        )
+        started = time.perf_counter()
+        statuses[await read_response(reader)] += 1
+        latencies.append(time.perf_counter() - started)
+    writer.close()
+
+
+async def stats(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /stats HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+    raw = await reader.read()
+    writer.close()
+    return json.loads(raw.split(b"\r\n\r\n", 1)[1])
+
+
+async def measure(args, parser):
+    port = free_port()
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    process = context.Process(target=serve, args=(port, parser, args.queue_size, args.drain_rate, ready))
+    process.start()
+    try:
+        if not await asyncio.get_running_loop().run_in_executor(None, ready.wait, 30):
+            raise RuntimeError("сервер не запустился")
+        statuses, latencies = Counter(), []
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*(client(port, index, deadline, statuses, latencies) for index in range(args.connections)))
+        elapsed = time.perf_counter() - started
+        return statuses, latencies, elapsed, await stats(port)
+    finally:
+        process.terminate()
+        process.join()
+
+
+async def main(args):
+    parsers = ["json"]
+    try:
+        import orjson  # noqa: F401
+        parsers.append("orjson")
+    except ImportError:
+        print("orjson не установлен — сравнение только с json")
+    print(f"соединений: {args.connections}, длительность: {args.duration:.0f} с, очередь: {args.queue_size}, "
+          f"потребитель: {args.drain_rate or 'без ограничения'} апдейтов/с")
+    print(f"\n{'парсер':<8} {'запросов/с':>11} {'200':>8} {'503':>8} {'p50, мс':>9} {'p99, мс':>9} {'макс. очередь':>14}")
+    for parser in parsers:
+        statuses, latencies, elapsed, server_stats = await measure(args, parser)
+        total = sum(statuses.values())
+        print(f"{parser:<8} {total / elapsed:>11.0f} {statuses[200]:>8} {statuses[503]:>8} "
+              f"{percentile(latencies, 0.50) * 1000:>9.2f} {percentile(latencies, 0.99) * 1000:>9.2f} "
+              f"{server_stats['max_depth']:>14}")
+        other = {status: count for status, count in statuses.items() if status not in (200, 503)}
+        if other:
+            print(f"  неожиданные ответы: {other}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--drain-rate", type=float, default=0, help="апдейтов в секунду, 0 — без ограничения")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,68 @@
+"""Микробенчмарк инлайн-поиска: линейный перебор каталога против CatalogSearch.
+
+Заодно проверяет, что разные формы одного слова («новогодний» —
+«новогодняя») находят одно и то же; при расхождении завершается с кодом 1.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_inline_search.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("MANAGER_CHAT_ID", "0")
+
+import Bot_Test as bot  # noqa: E402
+from catalog_search import normalize  # noqa: E402
+
+ITERATIONS = 2000
+# Набранные пользователем запросы — по символу, как их шлёт клиент
+QUERIES = ["н", "но", "нов", "новог", "новогодний", "лак", "лакрица", "букет день", "сиреневая", ""]
+# Формы одного слова, которые должны находить одно и то же
+WORD_FORMS = [
+    ("новогодний", "новогодняя", "новогоднего"),
+    ("лакрица", "лакрицей", "лакрицы"),
+    ("острый", "острая", "острого"),
+    ("розовая", "розовый"),
+]
+
+
+# --- «До»: подстрока в названии каждой записи каталога ---
+def linear_search(query):
+    words = normalize(query).split()
+    names = [category["name"] for category in bot.CATEGORIES.values()]
+    names += [name for category in bot.CATEGORIES.values() for name in category["items"].values()]
+    names += [*bot.FILLINGS.values(), *bot.SET_FILLINGS.values(), *bot.RIBBON_COLORS.values()]
+    return [name for name in names if all(word in normalize(name) for word in words)]
+
+
+def measure(name, func):
+    seconds = timeit.timeit(lambda: [func(query) for query in QUERIES], number=ITERATIONS)
+    print(f"{name:<22} {seconds / (ITERATIONS * len(QUERIES)) * 1e6:>10.2f} мкс/запрос")
+
+
+def check_word_forms(search):
+    mismatches = 0
+    for forms in WORD_FORMS:
+        found = {form: {entry.id for entry in search.search(form)} for form in forms}
+        if len({frozenset(ids) for ids in found.values()}) > 1:
+            mismatches += 1
+            print("расходятся: " + ", ".join(f"{form} — {len(ids)}" for form, ids in found.items()))
+    return mismatches
+
+
+def main():
+    search = bot.catalog_search
+    print(f"{ITERATIONS} прогонов по {len(QUERIES)} запросов, записей в индексе: {len(search.entries)}\n")
+    measure("перебор", linear_search)
+    measure("индекс", search.search)
+    measure("индекс + LRU ответов", lambda query: search.results(query, "bench_bot"))
+    if check_word_forms(search):
+        sys.exit(1)
+    print("\nформы слов находят одно и то же")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Микробенчмарк: сборка клавиатур на каждый колбэк против KeyboardRegistry.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_keyboards.py
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("MANAGER_CHAT_ID", "0")
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+import Bot_Test as bot  # noqa: E402
+
+ITERATIONS = 2000
+
+
+# --- «До»: так клавиатуры собирались в обработчиках раньше ---
+def _back(text, data):
+    return [InlineKeyboardButton(text, callback_data=data)]
+
+
+def _items(category_key):
+    items = bot.CATEGORIES[category_key]["items"]
+    keyboard = [[InlineKeyboardButton(name, callback_data=f"item_{key}")] for key, name in items.items()]
+    keyboard.append(_back("← Назад к категориям", "back_to_categories"))
+    return InlineKeyboardMarkup(keyboard)
+
+
+def legacy_bouquet_flow():
+    _items("bouquets")
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(name, callback_data=f"wrap_{key}")] for key, name in bot.WRAP_COLORS.items()]
+        + [_back("← Назад к букетам", "back_to_bouquets")]
+    )
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(name, callback_data=f"fillb_{k}")] for k, name in bot.FILLINGS.items()]
+        + [_back("← Назад к букетам", "back_to_bouquets")]
+    )
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(name, callback_data=f"ribbonb_{k}")] for k, name in bot.RIBBON_COLORS.items()]
+        + [_back("← Назад к букетам", "back_to_bouquets")]
+    )
+
+
+def legacy_set_flow():
+    _items("sets")
+    allowed = bot.SET_FILLING_RULES.get("s1", list(bot.SET_FILLINGS))
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(bot.SET_FILLINGS[key], callback_data=f"setfill_{key}")] for key in allowed]
+        + [_back("← Назад к наборам", "back_to_sets")]
+    )
+    InlineKeyboardMarkup(
+        [[InlineKeyboardButton(name, callback_data=f"ribbons_{key}")] for key, name in bot.RIBBON_COLORS.items()]
+        + [_back("← Назад к наборам", "back_to_sets")]
+    )
+
+
+# --- «После»: готовые разделяемые экземпляры ---
+def registry_bouquet_flow():
+    kb = bot.keyboards
+    kb.items("bouquets")
+    kb.wraps
+    kb.fillings
+    kb.ribbons_bouquet
+
+
+def registry_set_flow():
+    kb = bot.keyboards
+    kb.items("sets")
+    kb.set_fillings("s1")
+    kb.ribbons_set
+
+
+def measure(name, func, callbacks_per_call):
+    seconds = timeit.timeit(func, number=ITERATIONS)
+    per_callback_us = seconds / (ITERATIONS * callbacks_per_call) * 1e6
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name:<16} {per_callback_us:>10.2f} мкс/колбэк {peak / callbacks_per_call:>10.0f} Б пик/колбэк")
+
+
+def main():
+    print(f"{ITERATIONS} прогонов каждого сценария\n")
+    measure("букет: до", legacy_bouquet_flow, 4)
+    measure("букет: после", registry_bouquet_flow, 4)
+    measure("набор: до", legacy_set_flow, 3)
+    measure("набор: после", registry_set_flow, 3)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Сколько стоит вызов logger.* для цикла событий: прямой StreamHandler против очереди.
+
+Приёмник лога нарочно медленный (как stderr, который не успевает читать
+journald или docker): каждая запись в него ждёт --sink-latency мс. С прямым
+StreamHandler это ожидание достаётся обработчику апдейта, с QueueHandler —
+отдельному потоку. Заодно сравнивается выключенный уровень: f-строка
+собирается всегда, %-форматирование — только если запись пойдёт в лог.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_logging.py --records 2000 --sink-latency 0.2
+"""
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logging_setup import TextFormatter, log_context, setup_logging  # noqa: E402
+
+
+class SlowSink(io.TextIOBase):
+    def __init__(self, latency):
+        self.latency = latency
+        self.lines = 0
+
+    def write(self, text):
+        time.sleep(self.latency)
+        self.lines += text.count("\n")
+        return len(text)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def emit(logger, records):
+    costs = []
+    with log_context(user_id=42, handler="choose_wrap_color", state="CHOOSING_WRAP_COLOR"):
+        for index in range(records):
+            started = time.perf_counter()
+            logger.info("Заказ %s: пользователь выбрал обёртку %s", index, "pink")
+            costs.append(time.perf_counter() - started)
+    return costs
+
+
+def direct(records, latency):
+    sink = SlowSink(latency)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(sink)
+    handler.setFormatter(TextFormatter())
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    return emit(logging.getLogger("bench"), records), sink
+
+
+def queued(records, latency, json_format):
+    sink = SlowSink(latency)
+    listener = setup_logging(logging.INFO, json_format=json_format, stream=sink)
+    costs = emit(logging.getLogger("bench"), records)
+    started = time.perf_counter()
+    listener.stop()
+    return costs, sink, time.perf_counter() - started
+
+
+def disabled_level(records):
+    logger = logging.getLogger("bench")
+    user = {"id": 42, "first_name": "Клиент", "username": "client"}
+    started = time.perf_counter()
+    for _ in range(records):
+        logger.debug(f"Апдейт от {user}: {user['first_name']}")
+    formatted = time.perf_counter() - started
+    started = time.perf_counter()
+    for _ in range(records):
+        logger.debug("Апдейт от %s: %s", user, user["first_name"])
+    deferred = time.perf_counter() - started
+    return formatted / records, deferred / records
+
+
+def main(args):
+    latency = args.sink_latency / 1000
+    print(f"записей: {args.records}, задержка приёмника: {args.sink_latency} мс на запись\n")
+    print(f"{'вариант':<24} {'среднее, мкс':>13} {'p99, мкс':>10} {'всего, мс':>10}")
+    rows = [("StreamHandler напрямую", *direct(args.records, latency))]
+    for title, json_format in (("очередь, текст", False), ("очередь, JSON", True)):
+        costs, sink, drain = queued(args.records, latency, json_format)
+        rows.append((title, costs, sink))
+    for title, costs, sink in rows:
+        print(f"{title:<24} {sum(costs) / len(costs) * 1e6:>13.1f} {percentile(costs, 0.99) * 1e6:>10.1f} "
+              f"{sum(costs) * 1000:>10.1f}")
+    print(f"\nпоток очереди дописал последние записи за {drain * 1000:.0f} мс после остановки")
+
+    formatted, deferred = disabled_level(args.records * 10)
+    print(f"\nвыключенный DEBUG: f-строка {formatted * 1e6:.2f} мкс, %-форматирование {deferred * 1e6:.2f} мкс на вызов")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--sink-latency", type=float, default=0.2, help="задержка записи в приёмник, мс")
+    main(parser.parse_args())
@@ -0,0 +1,114 @@
+"""Бенчмарк: пропускная способность PerUserUpdateProcessor в зависимости от числа пользователей.
+
+Каждый апдейт «обрабатывается» HANDLER_LATENCY секунд — как медленный
+send_photo. Для сравнения тот же поток прогоняется последовательно
+(поведение Application по умолчанию). Заодно проверяется, что апдейты
+каждого пользователя обработаны строго в порядке поступления.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_update_processor.py
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from update_processor import PerUserUpdateProcessor  # noqa: E402
+
+HANDLER_LATENCY = 0.02
+UPDATES_PER_USER = 20
+LIMIT = 64
+
+
+class OfflineRequest(BaseRequest):
+    """Отвечает на getMe без сети — больше бенчмарку от Bot API ничего не нужно."""
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def make_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": str(update_id),
+        },
+    }
+
+
+async def run(users, concurrent):
+    builder = Application.builder().token("1:bench").request(OfflineRequest())
+    processor = None
+    if concurrent:
+        processor = PerUserUpdateProcessor(LIMIT)
+        builder = builder.concurrent_updates(processor)
+    application = builder.build()
+    if processor:
+        processor.bind(application)
+
+    seen = {}
+
+    async def handle(update, context):
+        await asyncio.sleep(HANDLER_LATENCY)
+        seen.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    application.add_handler(TypeHandler(Update, handle))
+
+    updates = []
+    update_id = 0
+    for _ in range(UPDATES_PER_USER):
+        for user_id in range(1, users + 1):
+            update_id += 1
+            updates.append(Update.de_json(make_update(update_id, user_id), application.bot))
+
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        for update in updates:
+            await application.update_queue.put(update)
+        while sum(len(ids) for ids in seen.values()) < len(updates):
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    ordered = all(ids == sorted(ids) for ids in seen.values())
+    return len(updates) / elapsed, ordered
+
+
+async def main():
+    print(f"задержка обработчика {HANDLER_LATENCY * 1000:.0f} мс, {UPDATES_PER_USER} апдейтов на пользователя, "
+          f"limit={LIMIT}\n")
+    print(f"{'пользователей':>14} {'последовательно':>18} {'PerUser':>12} {'порядок':>8}")
+    for users in (1, 2, 4, 8, 16, 32, 64, 128):
+        # Последовательный режим от числа пользователей не зависит — хватит пары точек
+        sequential, _ = await run(users, concurrent=False) if users <= 2 else (None, None)
+        concurrent, ordered = await run(users, concurrent=True)
+        sequential_text = f"{sequential:>12.0f} апд/с" if sequential else f"{'—':>17}"
+        print(f"{users:>14} {sequential_text} {concurrent:>7.0f} апд/с {'да' if ordered else 'НЕТ':>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,48 @@
+"""Пропускная способность бота в зависимости от числа процессов (WORKERS).
+
+Для каждого числа воркеров прогоняет benchmarks/loadtest.py с одинаковой
+нагрузкой и печатает заказов в секунду и задержку шагов. Упирается бот в
+процессор только при небольшой задержке заглушки Bot API, поэтому по
+умолчанию она нулевая. Генератор нагрузки и заглушка работают в процессе
+бенчмарка и сами занимают ядро — на машине с N ядрами рост имеет смысл
+смотреть примерно до N - 1 воркеров.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_workers.py --workers 1 2 4 --customers 400 --concurrency 100
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import loadtest  # noqa: E402
+
+
+async def main(args):
+    print(f"ядер: {os.cpu_count()}, клиентов: {args.customers}, параллельно: {args.concurrency}, "
+          f"задержка Bot API: {args.api_latency:.0f} мс")
+    print(f"\n{'воркеров':>8} {'заказов/с':>10} {'ошибок':>7} {'p50, мс':>9} {'p95, мс':>9} {'ускорение':>10}")
+    baseline = None
+    for workers in args.workers:
+        run_args = argparse.Namespace(
+            customers=args.customers, concurrency=args.concurrency, api_latency=args.api_latency, workers=workers
+        )
+        result = await loadtest.run(run_args)
+        throughput = result["completed"] / result["elapsed"]
+        baseline = baseline or throughput
+        steps = [value for values in result["latencies"].values() for value in values]
+        p50 = loadtest.percentile(steps, 0.50) * 1000 if steps else float("nan")
+        p95 = loadtest.percentile(steps, 0.95) * 1000 if steps else float("nan")
+        print(f"{workers:>8} {throughput:>10.1f} {result['failed']:>7} {p50:>9.1f} {p95:>9.1f} "
+              f"{throughput / baseline:>9.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа заглушки Bot API, мс")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="числа воркеров для сравнения")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,234 @@
+"""Локальная заглушка Bot API для нагрузочных тестов.
+
+Отвечает на методы, которыми пользуется бот (getMe, setWebhook, sendMessage,
+sendPhoto, editMessage*, deleteMessage, answerCallbackQuery и т.д.), помнит,
+какие сообщения текстовые, а какие с фото, и возвращает те же ошибки, что и
+Telegram, если бот пытается, например, поменять текст у фото.
+
+Каждый «видимый» вызов (то, что пользователь увидит в чате) складывается в
+очередь соответствующего чата — так симулятор клиента узнаёт, что бот ответил.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, defaultdict
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+VISIBLE_METHODS = {
+    "sendMessage", "sendPhoto", "editMessageText", "editMessageCaption", "editMessageMedia",
+    "editMessageReplyMarkup", "sendDocument",
+}
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Мармеладыш", "username": "marmeladysh_test_bot"}
+
+
+class BotApiError(Exception):
+    def __init__(self, description, error_code=400, parameters=None):
+        super().__init__(description)
+        self.description = description
+        self.error_code = error_code
+        self.parameters = parameters
+
+
+class FakeBotApi:
+    def __init__(self, latency=0.0, send_limit=None):
+        # Искусственная задержка ответа, чтобы имитировать сеть до api.telegram.org
+        self.latency = latency
+        # Как Telegram: больше send_limit sendMessage в секунду — 429 с retry_after
+        self.send_limit = send_limit
+        self._send_window = [0.0, 0]
+        # Чаты, заблокировавшие бота: sendMessage в них — 403
+        self.blocked_chats = set()
+        self.calls = Counter()
+        # Вызовы, на которые заглушка ответила ошибкой, по методам
+        self.errors = Counter()
+        self.sent_to = Counter()
+        self.messages = {}
+        self.webhook = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        self.webhook_set = asyncio.Event()
+        self._message_ids = itertools.count(1_000_000)
+        self._file_ids = itertools.count(1)
+        self._visible = defaultdict(asyncio.Queue)
+        self._server = None
+
+    # --- то, чем пользуется симулятор ---
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.errors.clear()
+        self.sent_to.clear()
+
+    async def next_visible(self, chat_id, timeout=10):
+        return await asyncio.wait_for(self._visible[chat_id].get(), timeout)
+
+    def drain_visible(self, chat_id):
+        queue = self._visible[chat_id]
+        while not queue.empty():
+            queue.get_nowait()
+
+    def message(self, chat_id, message_id):
+        return self.messages.get((chat_id, message_id))
+
+    async def start(self, port=0, address="127.0.0.1"):
+        app = Application([(r"/bot(?P<token>[^/]+)/(?P<method>\w+)", _MethodHandler, {"api": self})])
+        self._server = HTTPServer(app)
+        sockets = bind_sockets(port, address)
+        self._server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        self.base_url = f"http://{address}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+
+    # --- реализация методов ---
+
+    def _message_dict(self, chat_id, message_id, kind, text, reply_markup, file_id=None):
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group", "title": "chat"},
+            "from": BOT_USER,
+        }
+        if kind == "photo":
+            # Отправленное по file_id фото — тот же файл, как и в Telegram (совпадает file_unique_id)
+            if not (isinstance(file_id, str) and file_id.startswith("fake-photo-")):
+                file_id = f"fake-photo-{next(self._file_ids)}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 1280}]
+            if text:
+                message["caption"] = text
+        elif kind == "document":
+            message["document"] = {"file_id": "fake-doc", "file_unique_id": "fake-doc"}
+        else:
+            message["text"] = text or ""
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+        return message
+
+    def _store(self, chat_id, kind, text, reply_markup, message_id=None, file_id=None):
+        message_id = message_id or next(self._message_ids)
+        message = self._message_dict(chat_id, message_id, kind, text, reply_markup, file_id)
+        self.messages[(chat_id, message_id)] = message
+        return message
+
+    def _check_send_limit(self):
+        if self.send_limit is None:
+            return
+        now = time.monotonic()
+        if now - self._send_window[0] >= 1:
+            self._send_window = [now, 0]
+        self._send_window[1] += 1
+        if self._send_window[1] > self.send_limit:
+            retry_after = 1
+            raise BotApiError(f"Too Many Requests: retry after {retry_after}", 429, {"retry_after": retry_after})
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id is not None else None
+        markup = params.get("reply_markup")
+
+        if method == "getMe":
+            return BOT_USER
+        if method == "getWebhookInfo":
+            return self.webhook
+        if method == "setWebhook":
+            self.webhook = {**self.webhook, "url": params.get("url", "")}
+            self.webhook_set.set()
+            return True
+        if method == "deleteWebhook":
+            self.webhook = {**self.webhook, "url": ""}
+            return True
+        if method in ("answerCallbackQuery", "answerInlineQuery", "setMyCommands"):
+            return True
+        if method == "sendMessage":
+            if chat_id in self.blocked_chats:
+                raise BotApiError("Forbidden: bot was blocked by the user", error_code=403)
+            self._check_send_limit()
+            self.sent_to[chat_id] += 1
+            return self._store(chat_id, "text", params.get("text"), markup)
+        if method == "sendPhoto":
+            return self._store(chat_id, "photo", params.get("caption"), markup, file_id=params.get("photo"))
+        if method == "sendDocument":
+            return self._store(chat_id, "document", params.get("caption"), markup)
+        if method == "deleteMessage":
+            if self.messages.pop((chat_id, int(params["message_id"])), None) is None:
+                raise BotApiError("Bad Request: message to delete not found")
+            return True
+
+        if method.startswith("editMessage"):
+            key = (chat_id, int(params["message_id"]))
+            current = self.messages.get(key)
+            if current is None:
+                raise BotApiError("Bad Request: message to edit not found")
+            has_photo = "photo" in current
+            if method == "editMessageText":
+                if has_photo:
+                    raise BotApiError("Bad Request: there is no text in the message to edit")
+                return self._store(chat_id, "text", params.get("text"), markup, key[1])
+            if method == "editMessageCaption":
+                if not has_photo:
+                    raise BotApiError("Bad Request: there is no caption in the message to edit")
+                return self._store(
+                    chat_id, "photo", params.get("caption"), markup, key[1], current["photo"][-1]["file_id"]
+                )
+            if method == "editMessageMedia":
+                if not has_photo:
+                    raise BotApiError("Bad Request: message can't be edited")
+                media = params.get("media") or {}
+                return self._store(chat_id, "photo", media.get("caption"), markup, key[1], media.get("media"))
+            if method == "editMessageReplyMarkup":
+                current = {**current}
+                if markup:
+                    current["reply_markup"] = markup
+                else:
+                    current.pop("reply_markup", None)
+                self.messages[key] = current
+                return current
+
+        raise BotApiError(f"Not Found: method {method} is not supported by the fake", error_code=404)
+
+    def publish(self, method, params, result):
+        if method in VISIBLE_METHODS and isinstance(result, dict):
+            self._visible[result["chat"]["id"]].put_nowait((method, result))
+
+
+class _MethodHandler(RequestHandler):
+    def initialize(self, api):
+        self.api = api
+
+    def _params(self):
+        params = {}
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(self.request.body or b"{}")
+        else:
+            for name in self.request.arguments:
+                raw = self.get_argument(name)
+                # Строки PTB передаёт как есть, а объекты (reply_markup, media) — в JSON
+                params[name] = json.loads(raw) if raw[:1] in ("{", "[") else raw
+        return params
+
+    async def post(self, token, method):
+        params = self._params()
+        if self.api.latency:
+            await asyncio.sleep(self.api.latency)
+        try:
+            result = self.api.call(method, params)
+        except BotApiError as e:
+            self.api.errors[method] += 1
+            self.set_status(e.error_code)
+            response = {"ok": False, "error_code": e.error_code, "description": e.description}
+            if e.parameters:
+                response["parameters"] = e.parameters
+            self.write(response)
+            return
+        self.api.publish(method, params, result)
+        self.write({"ok": True, "result": result})
+
+    get = post
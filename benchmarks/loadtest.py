@@ -0,0 +1,306 @@
+"""Нагрузочный тест бота целиком, без Telegram.
+
+Поднимает заглушку Bot API (fake_bot_api.py), запускает Bot_Test.py отдельным
+процессом с BOT_API_BASE_URL на заглушку и гоняет N клиентов через полные
+сценарии заказа букета и набора, отправляя апдейты POST-запросами на вебхук.
+
+Задержка шага — время от POST апдейта до момента, когда бот сделал видимый
+пользователю вызов (sendMessage, sendPhoto, editMessage*) в чат клиента.
+
+Запуск из корня репозитория:
+    python benchmarks/loadtest.py --customers 200 --concurrency 50
+    python benchmarks/loadtest.py --workers 4   # бот в режиме кластера
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:loadtest"
+WEBHOOK_SECRET = "loadtest-secret"
+MANAGER_CHAT_ID = -1000
+
+# Сценарии: (шаг, действие, аргумент). Кнопки выбираются по позиции (строка, столбец),
+# а не по callback_data, чтобы тест не зависел от формата данных кнопок.
+BOUQUET_FLOW = [
+    ("start", "text", "/start"),
+    ("category", "tap", (0, 0)),
+    ("item", "tap", (0, 0)),
+    ("wrap", "tap", (0, 0)),
+    ("filling", "tap", (0, 0)),
+    ("ribbon", "tap", (0, 0)),
+    ("color_preferences", "text", "Нежные пастельные тона"),
+    ("price", "text", "1500"),
+    ("confirm", "tap", (0, 0)),
+]
+SET_FLOW = [
+    ("start", "text", "/start"),
+    ("category", "tap", (0, 1)),
+    ("item", "tap", (0, 0)),
+    ("set_filling", "tap", (0, 0)),
+    ("ribbon", "tap", (0, 0)),
+    ("price", "text", "700"),
+    ("confirm", "tap", (0, 0)),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def pool_stats(metrics_text):
+    """Из /metrics бота: по каждому пулу соединений — запросов, доля открытых заново, среднее ожидание."""
+    values = {}
+    for line in metrics_text.splitlines():
+        if line.startswith(("marmeladysh_http_pool_requests_total{", "marmeladysh_http_pool_wait_seconds_sum{",
+                            "marmeladysh_http_pool_wait_seconds_count{")):
+            series, value = line.rsplit(" ", 1)
+            values[series] = float(value)
+    stats = {}
+    for pool in ("api", "media"):
+        new = values.get(f'marmeladysh_http_pool_requests_total{{pool="{pool}",connection="new"}}', 0)
+        reused = values.get(f'marmeladysh_http_pool_requests_total{{pool="{pool}",connection="reused"}}', 0)
+        count = values.get(f'marmeladysh_http_pool_wait_seconds_count{{pool="{pool}"}}', 0)
+        wait = values.get(f'marmeladysh_http_pool_wait_seconds_sum{{pool="{pool}"}}', 0)
+        if new + reused:
+            stats[pool] = (int(new + reused), reused / (new + reused), wait / count if count else 0.0)
+    return stats
+
+
+def flood_stats(metrics_text):
+    """Из /metrics бота: сколько апдейтов отбросил антифлуд и оценка сэкономленных вызовов."""
+    dropped = saved = 0.0
+    for line in metrics_text.splitlines():
+        if line.startswith("marmeladysh_flood_dropped_total{"):
+            dropped += float(line.rsplit(" ", 1)[1])
+        elif line.startswith("marmeladysh_flood_api_calls_saved "):
+            saved = float(line.rsplit(" ", 1)[1])
+    return dropped, saved
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Customer:
+    _update_ids = itertools.count(1)
+
+    def __init__(self, user_id, client, webhook_url, api, latencies, double_tap=0.0):
+        self.user_id = user_id
+        self.double_tap = double_tap
+        self.client = client
+        self.webhook_url = webhook_url
+        self.api = api
+        self.latencies = latencies
+        self.message = None
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"Клиент {self.user_id}", "username": None}
+
+    async def _post(self, step, payload, expected, duplicate=None):
+        started = time.perf_counter()
+        response = await self.client.post(self.webhook_url, json={"update_id": next(self._update_ids), **payload})
+        response.raise_for_status()
+        if duplicate is not None:
+            # Второй тап вдогонку: бот должен его отбросить, иначе лишнее сообщение собьёт сценарий
+            response = await self.client.post(self.webhook_url, json={"update_id": next(self._update_ids), **duplicate})
+            response.raise_for_status()
+        for _ in range(expected):
+            method, self.message = await self.api.next_visible(self.user_id)
+        self.latencies[step].append(time.perf_counter() - started)
+
+    async def text(self, step, text):
+        message = {
+            "message_id": next(self._update_ids),
+            "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"},
+            "from": self._user(),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        # /start отвечает приветствием и меню — ждём оба сообщения
+        await self._post(step, {"message": message}, expected=2 if text == "/start" else 1)
+
+    async def tap(self, step, position):
+        row, column = position
+        current = self.api.message(self.user_id, self.message["message_id"])
+        button = current["reply_markup"]["inline_keyboard"][row][column]
+        callback_query = {
+            "id": str(next(self._update_ids)),
+            "from": self._user(),
+            "chat_instance": str(self.user_id),
+            "message": current,
+            "data": button["callback_data"],
+        }
+        duplicate = None
+        if random.random() < self.double_tap:
+            duplicate = {"callback_query": {**callback_query, "id": str(next(self._update_ids))}}
+        await self._post(step, {"callback_query": callback_query}, expected=1, duplicate=duplicate)
+
+    async def run(self, flow):
+        for step, action, argument in flow:
+            await getattr(self, action)(step, argument)
+
+
+async def wait_for_webhook(api, process, timeout, port=None):
+    waiter = asyncio.ensure_future(api.webhook_set.wait())
+    exited = asyncio.ensure_future(process.wait())
+    done, _ = await asyncio.wait({waiter, exited}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+    exited.cancel()
+    if waiter not in done:
+        raise RuntimeError("бот не зарегистрировал вебхук — см. лог процесса")
+    if port is None:
+        return
+    # До конца прогрева вебхук отвечает 503 — ждём /ready (у старых ревизий его нет: 404)
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while (await client.get(f"http://127.0.0.1:{port}/ready")).status_code == 503:
+            if time.monotonic() > deadline:
+                raise RuntimeError("бот не прогрелся вовремя — см. лог процесса")
+            await asyncio.sleep(0.05)
+
+
+async def run(args):
+    api = FakeBotApi(latency=args.api_latency / 1000)
+    base_url = await api.start()
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="marmeladysh-loadtest-")
+    log_path = os.path.join(workdir, "bot.log")
+
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "MANAGER_CHAT_ID": str(MANAGER_CHAT_ID),
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "PORT": str(port),
+        "BOT_API_BASE_URL": base_url,
+        "STATE_DB_PATH": os.path.join(workdir, "state.sqlite3"),
+        "MEDIA_CACHE_PATH": os.path.join(workdir, "media_cache.json"),
+        "WEBHOOK_STATE_PATH": os.path.join(workdir, "webhook_state"),
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        # Лимит группы менеджера здесь только мешал бы считать вызовы на заказ
+        "MANAGER_RATE_PER_MINUTE": "1000000",
+        "WORKERS": str(args.workers),
+    }
+    with open(log_path, "w") as log:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "Bot_Test.py", cwd=REPO_ROOT, env=env, stdout=log, stderr=log
+        )
+    try:
+        await wait_for_webhook(api, process, timeout=30, port=port)
+        api.reset_counters()
+
+        latencies = defaultdict(list)
+        completed = 0
+        failed = 0
+        semaphore = asyncio.Semaphore(args.concurrency)
+        webhook_url = f"http://127.0.0.1:{port}/{BOT_TOKEN}"
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+        headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+        async with httpx.AsyncClient(limits=limits, timeout=30, headers=headers) as client:
+            async def one(index):
+                nonlocal completed, failed
+                flow = BOUQUET_FLOW if index % 2 == 0 else SET_FLOW
+                customer = Customer(
+                    10_000 + index, client, webhook_url, api, latencies, getattr(args, "double_tap", 0.0)
+                )
+                async with semaphore:
+                    try:
+                        await customer.run(flow)
+                        completed += 1
+                    except Exception as e:
+                        failed += 1
+                        if failed <= 5:
+                            print(f"клиент {customer.user_id}: {type(e).__name__}: {e}")
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(index) for index in range(args.customers)))
+            elapsed = time.perf_counter() - started
+
+        # Даём очереди уведомлений менеджеру доотправить заказы
+        deadline = time.monotonic() + 5
+        while api.sent_to[MANAGER_CHAT_ID] < completed and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        # В режиме кластера у входного процесса нет метрик воркеров — пулы смотрим только в одиночном
+        pools, flood = {}, None
+        if args.workers == 1:
+            async with httpx.AsyncClient() as client:
+                metrics_text = (await client.get(f"http://127.0.0.1:{port}/metrics")).text
+            pools, flood = pool_stats(metrics_text), flood_stats(metrics_text)
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            await process.wait()
+        await api.stop()
+
+    return {
+        "completed": completed,
+        "failed": failed,
+        "elapsed": elapsed,
+        "calls": api.calls,
+        "latencies": latencies,
+        "pools": pools,
+        "flood": flood,
+        "log_path": log_path,
+    }
+
+
+def report(args, result):
+    completed, elapsed = result["completed"], result["elapsed"]
+    total_calls = sum(result["calls"].values())
+    print(f"\nклиентов: {args.customers}, параллельно: {args.concurrency}, "
+          f"задержка Bot API: {args.api_latency:.0f} мс, воркеров: {args.workers}")
+    print(f"заказов: {completed} за {elapsed:.2f} с — {completed / elapsed:.1f} заказов/с, ошибок: {result['failed']}")
+    if completed:
+        print(f"вызовов Bot API на заказ: {total_calls / completed:.2f}")
+        print("  " + ", ".join(
+            f"{method} {count / completed:.2f}" for method, count in result["calls"].most_common()
+        ))
+    print(f"\n{'шаг':<20} {'n':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}")
+    for step, values in result["latencies"].items():
+        print(f"{step:<20} {len(values):>6} {percentile(values, 0.50) * 1000:>9.1f} "
+              f"{percentile(values, 0.95) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}")
+    if result.get("flood") and result["flood"][0]:
+        dropped, saved = result["flood"]
+        print(f"\nантифлуд: отброшено апдейтов {dropped:.0f}, сэкономлено вызовов Bot API ≈ {saved:.0f}")
+    if result["pools"]:
+        print(f"\n{'пул':<8} {'запросов':>9} {'повторно':>9} {'ожидание, мс':>13}")
+        for pool, (requests, reuse, wait) in result["pools"].items():
+            print(f"{pool:<8} {requests:>9} {reuse:>8.1%} {wait * 1000:>13.2f}")
+    print(f"\nлог бота: {result['log_path']}")
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=30, help="задержка ответа заглушки Bot API, мс")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов бота (WORKERS)")
+    parser.add_argument("--double-tap", type=float, default=0.0, help="доля нажатий, повторённых вдогонку")
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = make_parser().parse_args()
+    report(arguments, asyncio.run(run(arguments)))
@@ -0,0 +1,268 @@
+"""Воспроизведение записанного трафика (CAPTURE_PATH) против заглушки Bot API.
+
+Запись делает сам бот: с CAPTURE_PATH=updates.jsonl.gz он дописывает туда
+обезличенные апдейты с временем прихода (см. capture.py). Этот скрипт
+поднимает fake_bot_api.py, запускает Bot_Test.py и подаёт ему апдейты из
+файла: апдейты одного пользователя — по порядку, разных — параллельно,
+с исходными интервалами (--speed 1), ускоренно (--speed 10) или подряд
+(--speed 0).
+
+Перед нажатием кнопки заглушке подкладывается сообщение, к которому она
+была прикреплена, — как оно записано, — чтобы правки этого сообщения вели
+себя как в Telegram, а не падали с «message to edit not found».
+
+Итог — время обработчиков по /metrics бота и число вызовов Bot API по
+методам. С --baseline то же самое прогоняется на другой ревизии (через
+git worktree) и печатается разница: так видно, что изменение сделало с
+задержками и с числом вызовов на реальном трафике.
+
+Запуск из корня репозитория:
+    python benchmarks/replay.py updates.jsonl.gz --speed 0
+    python benchmarks/replay.py updates.jsonl.gz --speed 0 --baseline HEAD~3
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture import read_capture  # noqa: E402
+from cluster import update_owner  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+from loadtest import BOT_TOKEN, REPO_ROOT, WEBHOOK_SECRET, free_port, wait_for_webhook  # noqa: E402
+
+# Бот закончил работу, если столько секунд не было ни одного вызова Bot API
+QUIET_PERIOD = 1.0
+
+
+def load_capture(filepath, limit=None):
+    """(псевдоним чата менеджера, [(время, апдейт), ...]) из файла записи."""
+    managers = []
+    updates = []
+    for kind, entry in read_capture(filepath):
+        if kind == "session":
+            if entry.get("manager_chat_id") not in (None, *managers):
+                managers.append(entry["manager_chat_id"])
+        else:
+            updates.append(entry)
+            if limit and len(updates) >= limit:
+                break
+    if len(managers) > 1:
+        # Без CAPTURE_SALT у каждого запуска свои псевдонимы — команды менеджера узнают только один из них
+        print(f"в записи несколько псевдонимов чата менеджера ({len(managers)}), берём первый")
+    return (managers[0] if managers else None), updates
+
+
+def handler_stats(metrics_text):
+    """Из /metrics бота: по обработчику — (вызовов, среднее время, граница корзины p95), состояния суммируются."""
+    buckets = defaultdict(Counter)
+    totals = defaultdict(float)
+    counts = Counter()
+    prefix = "marmeladysh_handler_duration_seconds"
+    for line in metrics_text.splitlines():
+        if not line.startswith(prefix):
+            continue
+        series, value = line.rsplit(" ", 1)
+        labels = dict(item.split("=", 1) for item in series[series.index("{") + 1:-1].split(","))
+        handler = labels["handler"].strip('"')
+        if series.startswith(prefix + "_bucket"):
+            buckets[handler][float(labels["le"].strip('"'))] += float(value)
+        elif series.startswith(prefix + "_sum"):
+            totals[handler] += float(value)
+        elif series.startswith(prefix + "_count"):
+            counts[handler] += float(value)
+    stats = {}
+    for handler, count in counts.items():
+        if not count:
+            continue
+        p95 = next(bound for bound, cumulative in sorted(buckets[handler].items()) if cumulative >= count * 0.95)
+        stats[handler] = (int(count), totals[handler] / count, p95)
+    return stats
+
+
+async def replay(args, source_dir, manager_chat_id, updates):
+    """Один прогон записи на коде из source_dir."""
+    api = FakeBotApi(latency=args.api_latency / 1000)
+    base_url = await api.start()
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix="marmeladysh-replay-")
+    log_path = os.path.join(workdir, "bot.log")
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        # Бот без MANAGER_CHAT_ID не запускается; без заголовка в записи — любой чат не из неё
+        "MANAGER_CHAT_ID": str(manager_chat_id if manager_chat_id is not None else -1),
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "PORT": str(port),
+        "BOT_API_BASE_URL": base_url,
+        "STATE_DB_PATH": os.path.join(workdir, "state.sqlite3"),
+        "MEDIA_CACHE_PATH": os.path.join(workdir, "media_cache.json"),
+        "WEBHOOK_STATE_PATH": os.path.join(workdir, "webhook_state"),
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "MANAGER_RATE_PER_MINUTE": "1000000",
+        "WORKERS": "1",
+    }
+    # Воспроизведение не должно само себя записывать
+    env.pop("CAPTURE_PATH", None)
+    with open(log_path, "w") as log:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "Bot_Test.py", cwd=source_dir, env=env, stdout=log, stderr=log
+        )
+    rejected = Counter()
+    try:
+        await wait_for_webhook(api, process, timeout=30, port=port)
+        api.reset_counters()
+
+        by_user = defaultdict(list)
+        for received_at, update in updates:
+            by_user[update_owner(update)].append((received_at, update))
+        first = updates[0][0]
+        semaphore = asyncio.Semaphore(args.concurrency)
+        webhook_url = f"http://127.0.0.1:{port}/{BOT_TOKEN}"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+        async with httpx.AsyncClient(limits=limits, timeout=30, headers=headers) as client:
+            async def post(update):
+                message = (update.get("callback_query") or {}).get("message")
+                if message is not None:
+                    api.messages[(message["chat"]["id"], message["message_id"])] = message
+                async with semaphore:
+                    response = await client.post(webhook_url, json=update)
+                if response.status_code != 200:
+                    rejected[response.status_code] += 1
+
+            async def user_stream(stream):
+                for received_at, update in stream:
+                    if args.speed:
+                        delay = started + (received_at - first) / args.speed - time.perf_counter()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    await post(update)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(user_stream(stream) for stream in by_user.values()))
+            posted = time.perf_counter() - started
+
+        # Вебхук отвечает сразу — ждём, пока бот доделает очередь
+        total = -1
+        while total != sum(api.calls.values()):
+            total = sum(api.calls.values())
+            await asyncio.sleep(QUIET_PERIOD)
+        elapsed = time.perf_counter() - started - QUIET_PERIOD
+
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"http://127.0.0.1:{port}/metrics")
+        # У старых ревизий /metrics может не быть
+        handlers = handler_stats(response.text) if response.status_code == 200 else {}
+    finally:
+        if process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            await process.wait()
+        await api.stop()
+
+    return {
+        "posted": posted,
+        "elapsed": elapsed,
+        "calls": api.calls,
+        "errors": api.errors,
+        "rejected": rejected,
+        "handlers": handlers,
+        "log_path": log_path,
+    }
+
+
+def _delta(current, baseline, scale=1.0, digits=1):
+    if baseline is None:
+        return ""
+    difference = (current - baseline) * scale
+    return f"{difference:+.{digits}f}"
+
+
+def report(args, updates, result, baseline=None):
+    count = len(updates)
+    print(f"\nапдейтов: {count}, пользователей: {len({update_owner(u) for _, u in updates})}, "
+          f"скорость: {'подряд' if not args.speed else f'×{args.speed:g}'}, "
+          f"задержка Bot API: {args.api_latency:.0f} мс")
+    for title, run in (("текущий код", result), ("база", baseline)):
+        if run is None:
+            continue
+        print(f"{title}: подано за {run['posted']:.2f} с, обработано за {run['elapsed']:.2f} с, "
+              f"вызовов Bot API {sum(run['calls'].values())}, ошибок Bot API {sum(run['errors'].values())}"
+              + (f", отклонено вебхуком {dict(run['rejected'])}" if run["rejected"] else ""))
+
+    base_handlers = baseline["handlers"] if baseline else {}
+    if result["handlers"] or base_handlers:
+        print(f"\n{'обработчик':<28} {'n':>6} {'среднее, мс':>12} {'p95 ≤, мс':>10} {'Δ среднее':>10} {'Δ p95':>8}")
+        for handler in sorted(set(result["handlers"]) | set(base_handlers)):
+            n, mean, p95 = result["handlers"].get(handler, (0, 0.0, 0.0))
+            base = base_handlers.get(handler)
+            print(f"{handler:<28} {n:>6} {mean * 1000:>12.1f} {p95 * 1000:>10.0f} "
+                  f"{_delta(mean, base and base[1], 1000):>10} {_delta(p95, base and base[2], 1000, 0):>8}")
+    elif baseline is not None:
+        print("\nни одна из версий не отдаёт /metrics — время обработчиков недоступно")
+
+    base_calls = baseline["calls"] if baseline else Counter()
+    print(f"\n{'метод Bot API':<28} {'вызовов':>8} {'на апдейт':>10} {'Δ вызовов':>10} {'ошибок':>7}")
+    for method in sorted(set(result["calls"]) | set(base_calls)):
+        calls = result["calls"][method]
+        print(f"{method:<28} {calls:>8} {calls / count:>10.3f} "
+              f"{_delta(calls, base_calls[method] if baseline else None, digits=0):>10} {result['errors'][method]:>7}")
+    for title, run in (("текущий код", result), ("база", baseline)):
+        if run is not None:
+            print(f"лог бота ({title}): {run['log_path']}")
+
+
+def checkout(revision):
+    """Временное рабочее дерево с ревизией revision; удалить — remove_checkout."""
+    path = tempfile.mkdtemp(prefix="marmeladysh-baseline-")
+    subprocess.run(["git", "worktree", "add", "--detach", path, revision], cwd=REPO_ROOT, check=True,
+                   stdout=subprocess.DEVNULL)
+    return path
+
+
+def remove_checkout(path):
+    subprocess.run(["git", "worktree", "remove", "--force", path], cwd=REPO_ROOT, check=False)
+
+
+async def main(args):
+    manager_chat_id, updates = load_capture(args.capture, args.limit)
+    if not updates:
+        print("в записи нет апдейтов")
+        return
+    baseline_dir = args.baseline_dir
+    if args.baseline and not baseline_dir:
+        baseline_dir = checkout(args.baseline)
+    try:
+        result = await replay(args, REPO_ROOT, manager_chat_id, updates)
+        baseline = await replay(args, baseline_dir, manager_chat_id, updates) if baseline_dir else None
+    finally:
+        if args.baseline and not args.baseline_dir:
+            remove_checkout(baseline_dir)
+    report(args, updates, result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"current": result, "baseline": baseline}, f, ensure_ascii=False, indent=2, default=dict)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", help="файл записи (CAPTURE_PATH бота)")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 — исходные интервалы, 0 — без пауз")
+    parser.add_argument("--limit", type=int, default=None, help="воспроизвести только первые N апдейтов")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных POST на вебхук")
+    parser.add_argument("--api-latency", type=float, default=30, help="задержка ответа заглушки Bot API, мс")
+    parser.add_argument("--baseline", help="ревизия git для сравнения (поднимается через git worktree)")
+    parser.add_argument("--baseline-dir", help="готовый каталог с другой версией бота для сравнения")
+    parser.add_argument("--json", help="сохранить результаты в JSON")
+    asyncio.run(main(parser.parse_args()))
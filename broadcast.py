@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from metrics import metrics
+from outbox import TokenBucket, retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    text TEXT NOT NULL,
+    -- draft → running → done; draft и running можно перевести в cancelled
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    total INTEGER NOT NULL DEFAULT 0,
+    -- Получатели идут по возрастанию user_id: всё, что не больше last_user_id, уже обработано
+    last_user_id INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    -- Время собственно отправки, без простоев между запусками бота: по нему считается скорость
+    sending_seconds REAL NOT NULL DEFAULT 0
+);
+"""
+
+BROADCAST_COLUMNS = (
+    "id", "text", "status", "created_at", "started_at", "finished_at", "total", "last_user_id",
+    "sent", "failed", "blocked", "sending_seconds",
+)
+_Broadcast = namedtuple("_Broadcast", BROADCAST_COLUMNS)
+
+
+class Broadcast(_Broadcast):
+    __slots__ = ()
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    def eta(self):
+        """Оценка оставшегося времени в секундах по средней скорости рассылки; None, если мерить ещё не по чему."""
+        if not self.processed or not self.sending_seconds:
+            return None
+        return max(0, self.total - self.processed) * self.sending_seconds / self.processed
+
+
+# Сетевые ошибки повторяются столько раз, потом получатель считается неудачным
+MAX_ATTEMPTS = 3
+# Ниже этой скорости рассылка не замедляется даже после череды RetryAfter
+MIN_RATE = 1.0
+# Сколько stop() ждёт, пока допишется текущая пачка, прежде чем прервать её
+STOP_TIMEOUT = 10
+# Пауза перед новой попыткой после сбоя рассылки; stop() её прерывает
+RETRY_DELAY = 60
+
+
+class Broadcaster:
+    """Рассылка менеджера всем, кто когда-либо заказывал.
+
+    Получатели читаются из журнала заказов пачками по batch_size, по
+    возрастанию user_id, — в памяти никогда не больше одной пачки. Сообщения
+    идут через общий token bucket: не больше rate в секунду (Telegram
+    пропускает около 30 сообщений в секунду на бота, часть оставляем обычным
+    ответам). RetryAfter приостанавливает всю рассылку и вдвое снижает
+    скорость, которая затем плавно возвращается — но не выше 90% той, на
+    которой пришёл RetryAfter.
+
+    После каждой пачки прогресс (последний user_id и счётчики) записывается в
+    SQLite, поэтому после перезапуска рассылка продолжается с того же места;
+    при падении процесса повторно получит сообщение не больше одной пачки.
+
+    Рассылку создаёт любой процесс (create, launch, cancel — только записи в
+    базе), а отправляет один — start(bot, run=True); в кластере он раз в
+    poll_interval секунд проверяет, не появилась ли новая.
+    """
+
+    def __init__(self, filepath, order_store, rate=25.0, batch_size=50, poll_interval=None, notify=None):
+        self.filepath = filepath
+        self.order_store = order_store
+        # Потолок, к которому скорость возвращается после RetryAfter; опускается при каждом RetryAfter
+        self.ceiling = rate
+        self.bucket = TokenBucket(rate)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        # notify(text) — корутина, которой сообщается о завершении рассылки
+        self.notify = notify
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast")
+        self._conn = None
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        # Сколько раз Telegram ответил RetryAfter за время работы процесса
+        self.throttled = 0
+        self.messages = metrics.counter("broadcast_messages_total", "Сообщения рассылки по результату", ("result",))
+        metrics.gauge(
+            "broadcast_rate", "Текущий лимит скорости рассылки, сообщений в секунду", lambda: self.bucket.rate
+        )
+
+    # --- работа с базой (в отдельном потоке) ---
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _insert(self, text, total, now):
+        cursor = self._connect().execute(
+            "INSERT INTO broadcasts (text, status, created_at, total) VALUES (?, 'draft', ?, ?)", (text, now, total)
+        )
+        return cursor.lastrowid
+
+    def _get(self, broadcast_id):
+        row = self._connect().execute(
+            f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone()
+        return Broadcast(*row) if row else None
+
+    def _latest(self, status=None):
+        where, params = (" WHERE status = ?", (status,)) if status else ("", ())
+        # Идущая рассылка — самая старая из запущенных; для отчёта — последняя созданная
+        order = "ASC" if status else "DESC"
+        row = self._connect().execute(
+            f"SELECT {', '.join(BROADCAST_COLUMNS)} FROM broadcasts{where} ORDER BY id {order} LIMIT 1", params
+        ).fetchone()
+        return Broadcast(*row) if row else None
+
+    def _set_status(self, broadcast_id, status, allowed, column, now):
+        """Переводит рассылку в status, если она сейчас в одном из allowed; column — отметка времени перехода."""
+        placeholders = ", ".join("?" * len(allowed))
+        cursor = self._connect().execute(
+            f"UPDATE broadcasts SET status = ?, {column} = ? WHERE id = ? AND status IN ({placeholders})",
+            (status, now, broadcast_id, *allowed),
+        )
+        return cursor.rowcount > 0
+
+    def _checkpoint(self, broadcast_id, last_user_id, sent, failed, blocked, seconds):
+        self._connect().execute(
+            "UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?, "
+            "sending_seconds = sending_seconds + ? WHERE id = ?",
+            (last_user_id, sent, failed, blocked, seconds, broadcast_id),
+        )
+
+    # --- публичный интерфейс ---
+
+    async def create(self, text):
+        """Черновик рассылки на всех заказывавших; отправка начнётся после launch()."""
+        total = await self.order_store.customer_count()
+        broadcast_id = await self._run(self._insert, text, total, time.time())
+        return await self._run(self._get, broadcast_id)
+
+    async def launch(self, broadcast_id):
+        """Запускает черновик; False, если он уже запущен или отменён."""
+        launched = await self._run(self._set_status, broadcast_id, "running", ("draft",), "started_at", time.time())
+        if launched:
+            self._wakeup.set()
+        return launched
+
+    async def cancel(self, broadcast_id):
+        return await self._run(
+            self._set_status, broadcast_id, "cancelled", ("draft", "running"), "finished_at", time.time()
+        )
+
+    async def get(self, broadcast_id):
+        return await self._run(self._get, broadcast_id)
+
+    async def latest(self):
+        return await self._run(self._latest)
+
+    async def start(self, bot, run=True):
+        if not run:
+            return
+        running = await self._run(self._latest, "running")
+        if running is not None:
+            logger.info("Продолжаем рассылку %s: обработано %s из %s", running.id, running.processed, running.total)
+        self._task = asyncio.get_running_loop().create_task(self._loop(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            # Даём дописать пачку и сохранить прогресс: иначе после перезапуска она уйдёт второй раз
+            self._stopping = True
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(self._task, STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Рассылка не успела дописать пачку, часть получателей получит сообщение повторно")
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    # --- фоновая отправка ---
+
+    def _slow_down(self, seconds):
+        self.bucket.pause(seconds)
+        # На этой скорости Telegram уже ограничил — выше неё больше не поднимаемся
+        self.ceiling = max(MIN_RATE, min(self.ceiling, self.bucket.rate * 0.9))
+        self.bucket.rate = max(MIN_RATE, self.bucket.rate / 2)
+        self.messages.inc("retry_after")
+        self.throttled += 1
+        logger.warning("RetryAfter в рассылке: пауза %s с, скорость снижена до %.1f/с", seconds, self.bucket.rate)
+
+    def _speed_up(self):
+        # Скорость, сниженная после RetryAfter, возвращается к потолку примерно за сотню успешных отправок
+        if self.bucket.rate < self.ceiling:
+            self.bucket.rate = min(self.ceiling, self.bucket.rate + self.ceiling / 100)
+
+    async def _send(self, bot, chat_id, text):
+        """Отправляет одному получателю; результат — "sent", "blocked" или "failed"."""
+        attempts = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+            except RetryAfter as e:
+                self._slow_down(retry_after_seconds(e))
+                continue
+            except Forbidden:
+                # Бот заблокирован или пользователь удалён — повторять бесполезно
+                return "blocked"
+            except BadRequest as e:
+                logger.info("Рассылка: сообщение пользователю %s отклонено: %s", chat_id, e)
+                return "failed"
+            except TelegramError as e:
+                attempts += 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.warning("Рассылка: не удалось отправить пользователю %s: %s", chat_id, e)
+                    return "failed"
+                await asyncio.sleep(2 ** attempts)
+                continue
+            self._speed_up()
+            return "sent"
+
+    async def _deliver(self, bot, broadcast):
+        last_user_id = broadcast.last_user_id
+        while not self._stopping:
+            current = await self._run(self._get, broadcast.id)
+            if current is None or current.status != "running":
+                logger.info("Рассылка %s остановлена: %s", broadcast.id, current.status if current else "удалена")
+                return
+            recipients = await self.order_store.customers(after=last_user_id, limit=self.batch_size)
+            if not recipients:
+                await self._finish(broadcast.id)
+                return
+            started = time.monotonic()
+            results = await asyncio.gather(*(self._send(bot, user_id, broadcast.text) for user_id in recipients))
+            for result in results:
+                self.messages.inc(result)
+            last_user_id = recipients[-1]
+            await self._run(
+                self._checkpoint, broadcast.id, last_user_id, results.count("sent"), results.count("failed"),
+                results.count("blocked"), time.monotonic() - started,
+            )
+
+    async def _finish(self, broadcast_id):
+        await self._run(self._set_status, broadcast_id, "done", ("running",), "finished_at", time.time())
+        finished = await self._run(self._get, broadcast_id)
+        logger.info("Рассылка %s завершена: отправлено %s, ошибок %s, заблокировали бота %s",
+                    finished.id, finished.sent, finished.failed, finished.blocked)
+        if self.notify is not None:
+            await self.notify(
+                f"📣 Рассылка #{finished.id} завершена\n\n"
+                f"Отправлено: {finished.sent}\nОшибок: {finished.failed}\nЗаблокировали бота: {finished.blocked}"
+            )
+
+    async def _loop(self, bot):
+        while not self._stopping:
+            self._wakeup.clear()
+            broadcast = await self._run(self._latest, "running")
+            if broadcast is not None:
+                try:
+                    await self._deliver(bot, broadcast)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Прогресс сохранён по пачкам — следующий круг продолжит с последней
+                    logger.error("Сбой рассылки %s, повторим через %s с: %s", broadcast.id, RETRY_DELAY, e)
+                    await self._pause(RETRY_DELAY)
+                continue
+            await self._pause(self.poll_interval)
+
+    async def _pause(self, seconds):
+        # Ждём таймаут или _wakeup: его поднимают launch() и stop()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,191 @@
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import secrets
+import threading
+import time
+
+from catalog_search import CATALOG_START
+from router import PAYLOAD_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Поля с именами людей и чатов — заменяются целиком
+_NAME_FIELDS = {"first_name": "Имя", "last_name": "Фамилия", "username": "user", "title": "Чат"}
+# Поля, которые в записи не нужны вовсе
+# (photo оставляем: у сообщений бота это фото каталога, и от них зависит, правится ли подпись или медиа)
+_DROP_FIELDS = {"contact", "location", "venue", "phone_number", "email", "shipping_address"}
+# Объекты, у которых id — это пользователь или чат
+_PEER_OBJECTS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+# Свободный текст: сообщения, подписи и инлайн-запросы (inline_query и chosen_inline_result)
+_TEXT_FIELDS = {"text", "caption", "query"}
+# Данные кнопок: в них бывают id пользователей (фильтр листания /orders: "o:<12:987654321")
+_DATA_FIELDS = {"data"}
+
+# Цифры подряд, в том числе через пробелы, дефисы и скобки, — длиннее любой цены: телефоны, номера карт
+_LONG_DIGITS = re.compile(r"\+?\d(?:[ ()\-]?\d){5,}")
+# Отдельное целое число: в аргументах команд и данных кнопок — это id пользователя или чата
+_ID_TOKEN = re.compile(r"(?<![\w])-?\d{5,}(?![\w])")
+# То же число отдельным словом аргументов команды: «/orders 987654321»
+_ID_WORD = re.compile(r"(?<!\S)(-?\d{5,})(?!\S)")
+# Аргументы команд, в которых нет ничего личного, — остаются как есть, чтобы воспроизведение шло теми же путями:
+# /start <данные кнопки каталога> из инлайн-поиска, /orders <категория, ключ товара или дата>
+_KEPT_ARGUMENTS = {
+    "/start": re.compile(rf"[A-Za-z][0-9a-z]{{{PAYLOAD_LENGTH - 1}}}|{CATALOG_START}"),
+    "/orders": re.compile(r"[a-z][a-z0-9_]*|\d{4}-\d{2}-\d{2}"),
+}
+
+
+def _mask_free_text(text):
+    """Буквы → x, длинные цифровые последовательности → 0, остальное как есть.
+
+    Длина, короткие числа (цены), эмодзи и пробелы сохраняются.
+    """
+    text = _LONG_DIGITS.sub(lambda match: re.sub(r"\d", "0", match.group()), text)
+    return "".join("x" if char.isalpha() else char for char in text)
+
+
+class Anonymizer:
+    """Заменяет id пользователей и чатов стабильными псевдонимами (HMAC с солью), имена и тексты — заглушками."""
+
+    def __init__(self, salt):
+        self.salt = salt.encode()
+
+    def _map_ids(self, text):
+        """Числа, похожие на id, → псевдонимы, как у id в from/chat: /orders <id> находит те же заказы."""
+        return _ID_TOKEN.sub(lambda match: str(self.pseudonym(int(match.group()))), text)
+
+    def mask_text(self, text):
+        """Команда в начале («/start», «/orders») остаётся читаемой, id в её аргументах — псевдонимы."""
+        if not text.startswith("/"):
+            return _mask_free_text(text)
+        command, _, text = text.partition(" ")
+        kept = _KEPT_ARGUMENTS.get(command.partition("@")[0])
+        if kept is not None and kept.fullmatch(text):
+            return f"{command} {text}"
+        command += " " if text else ""
+        # split с группой: на нечётных местах — сами числа-id, между ними — обычный текст
+        parts = _ID_WORD.split(text)
+        return command + "".join(
+            str(self.pseudonym(int(part))) if index % 2 else _mask_free_text(part) for index, part in enumerate(parts)
+        )
+
+    def pseudonym(self, peer_id):
+        digest = hmac.new(self.salt, str(abs(peer_id)).encode(), hashlib.sha256).digest()
+        # 6 байт — заведомо в пределах int64 Bot API; знак сохраняем: у групп id отрицательные
+        value = int.from_bytes(digest[:6], "big") or 1
+        return -value if peer_id < 0 else value
+
+    def __call__(self, value, key=None):
+        if isinstance(value, dict):
+            result = {}
+            for name, item in value.items():
+                if name in _DROP_FIELDS:
+                    continue
+                if name in _NAME_FIELDS and isinstance(item, str):
+                    result[name] = _NAME_FIELDS[name]
+                elif name == "id" and key in _PEER_OBJECTS and isinstance(item, int):
+                    result[name] = self.pseudonym(item)
+                elif name in _TEXT_FIELDS and isinstance(item, str):
+                    result[name] = self.mask_text(item)
+                elif name in _DATA_FIELDS and isinstance(item, str):
+                    result[name] = self._map_ids(item)
+                else:
+                    result[name] = self(item, name)
+            return result
+        if isinstance(value, list):
+            return [self(item, key) for item in value]
+        return value
+
+
+class UpdateCapture:
+    """Запись входящих апдейтов для benchmarks/replay.py: обезличенные, с временем прихода.
+
+    Файл только дописывается, по строке JSON на апдейт: {"t": время, "u": апдейт}.
+    Каждый запуск начинается строкой-заголовком {"session": ..., "manager_chat_id": ...}
+    с псевдонимом чата менеджера — иначе при воспроизведении команды менеджера
+    не узнают свой чат. Путь с .gz пишется в gzip (каждый запуск — отдельный
+    член архива, gzip.open читает их подряд).
+
+    Разбор, обезличивание и запись идут в отдельном потоке: приём вебхука
+    только передаёт туда тело запроса.
+    """
+
+    def __init__(self, filepath, salt=None, manager_chat_id=None):
+        self.filepath = filepath
+        # Без соли псевдонимы стабильны только в пределах одного запуска
+        self.anonymize = Anonymizer(salt or secrets.token_hex(16))
+        self.manager_chat_id = manager_chat_id
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self.recorded = 0
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+        # Дописать очередь до выхода процесса
+        atexit.register(self.close)
+
+    def _open(self):
+        if self.filepath.endswith(".gz"):
+            self._file = gzip.open(self.filepath, "at", encoding="utf-8")
+        else:
+            self._file = open(self.filepath, "a", encoding="utf-8", buffering=1 << 16)
+        manager = self.anonymize.pseudonym(self.manager_chat_id) if self.manager_chat_id is not None else None
+        self._write_line({"session": time.time(), "pid": os.getpid(), "manager_chat_id": manager})
+
+    def _write_line(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _record(self, received_at, body):
+        try:
+            if self._file is None:
+                self._open()
+            self._write_line({"t": round(received_at, 3), "u": self.anonymize(json.loads(body))})
+            self.recorded += 1
+        except (OSError, ValueError) as e:
+            logger.warning("Не удалось записать апдейт в %s: %s", self.filepath, e)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._record(*item)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def record(self, body):
+        """Ставит тело принятого апдейта в очередь на запись; не блокирует."""
+        self._queue.put((time.time(), body))
+
+    def close(self):
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        logger.info("Записано апдейтов в %s: %s", self.filepath, self.recorded)
+
+
+def read_capture(filepath):
+    """Записи файла по порядку: ("session", заголовок) и ("update", (время, апдейт))."""
+    opener = gzip.open if filepath.endswith(".gz") else open
+    with opener(filepath, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Оборванная последняя строка после падения процесса
+                continue
+            if "session" in entry:
+                yield "session", entry
+            else:
+                yield "update", (entry["t"], entry["u"])
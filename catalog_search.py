@@ -0,0 +1,156 @@
+import re
+from collections import OrderedDict, namedtuple
+
+from telegram import (
+    InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent,
+)
+
+from metrics import metrics
+
+# Запись поиска: что показать и куда ведёт «Заказать» (параметр /start)
+SearchEntry = namedtuple("SearchEntry", "id title description start_parameter")
+
+# Параметр /start для записей без своего шага (например, лент): просто каталог с начала
+CATALOG_START = "catalog"
+# Telegram показывает не больше 50 результатов на ответ
+MAX_RESULTS = 50
+# Сколько букв окончания отбрасывается от слова запроса при поиске по основе
+ENDING_LENGTH = 3
+# Короче этого основа не становится
+MIN_STEM = 4
+
+_WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    """Нижний регистр, ё → е, только слова: эмодзи, кавычки и знаки препинания не мешают поиску."""
+    return " ".join(_WORD.findall(text.lower().replace("ё", "е")))
+
+
+class CatalogSearch:
+    """Инлайн-поиск по каталогу: «@бот новогодний» прямо из любого чата.
+
+    Индекс собирается один раз из словарей каталога: каждый префикс каждого
+    слова названия → записи, в которых он встречается. Запрос разбирается на
+    слова, и запись подходит, если каждое слово запроса — префикс одного из её
+    слов. Падежи и роды («новогодний» — «новогодняя») покрываются тем, что
+    к совпадениям слова добавляются совпадения его основы — слова без
+    ENDING_LENGTH последних букв, но не короче MIN_STEM.
+
+    Готовые наборы InlineQueryResult лежат в LRU по нормализованному запросу:
+    PTB-объекты неизменяемы, поэтому один кортеж отдаётся всем. Кнопка
+    «Заказать» ведёт в личку с ботом с /start <данные кнопки из CallbackRouter>
+    — обработчик /start сразу открывает нужный шаг заказа. После правки
+    каталога вызовите rebuild().
+    """
+
+    def __init__(self, router, categories, fillings, set_fillings, set_filling_rules, ribbon_colors,
+                 cache_size=1024):
+        self.router = router
+        self._categories = categories
+        self._fillings = fillings
+        self._set_fillings = set_fillings
+        self._set_filling_rules = set_filling_rules
+        self._ribbon_colors = ribbon_colors
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.lookups = metrics.counter(
+            "inline_search_total", "Инлайн-запросы: ответ из кеша или собран заново", ("cache",)
+        )
+        self.rebuild()
+
+    def _entries(self):
+        """(запись, текст для индекса) по всему каталогу."""
+        to = self.router.payload
+        items = {}
+        for category_key, category in self._categories.items():
+            count = len(category["items"])
+            yield SearchEntry(
+                f"c:{category_key}", category["name"], f"Категория, позиций: {count}", to("category", category_key)
+            ), category["name"]
+            for item_key, name in category["items"].items():
+                items[item_key] = name
+                yield SearchEntry(
+                    f"i:{item_key}", name, category["name"], to("item", item_key)
+                ), f"{name} {category['name']}"
+
+        bouquets = self._categories.get("bouquets", {}).get("name", "")
+        for key, name in self._fillings.items():
+            # Наполнение букета выбирается после самого букета — ведём к списку букетов
+            yield SearchEntry(
+                f"f:{key}", name, "Наполнение для букетов — сначала выберите букет", to("category", "bouquets")
+            ), f"{name} {bouquets}"
+
+        sets = self._categories.get("sets", {})
+        for key, name in self._set_fillings.items():
+            # Те же правила, что у клавиатуры наполнений: набор без правила допускает любое
+            allowed = [
+                item_key for item_key in sets.get("items", {})
+                if key in self._set_filling_rules.get(item_key, self._set_fillings)
+            ]
+            # Если наполнение бывает только в одном наборе — сразу к нему
+            target = to("item", allowed[0]) if len(allowed) == 1 else to("category", "sets")
+            where = ", ".join(items[item_key] for item_key in allowed if item_key in items)
+            yield SearchEntry(
+                f"s:{key}", name, f"Наполнение набора: {where}" if where else "Наполнение набора", target
+            ), f"{name} {sets.get('name', '')}"
+
+        for key, name in self._ribbon_colors.items():
+            yield SearchEntry(
+                f"r:{key}", f"Лента: {name}", "Для любого букета или набора", CATALOG_START
+            ), f"лента {name}"
+
+    def rebuild(self):
+        self.entries = []
+        self._prefixes = {}
+        for index, (entry, text) in enumerate(self._entries()):
+            self.entries.append(entry)
+            for word in normalize(text).split():
+                for end in range(1, len(word) + 1):
+                    self._prefixes.setdefault(word[:end], set()).add(index)
+        self._cache.clear()
+
+    def _match_word(self, word):
+        # Слово целиком и его основа: «новогодний» и «новогодняя» обе дают «новогод»
+        stem = word[:max(MIN_STEM, len(word) - ENDING_LENGTH)]
+        return self._prefixes.get(word, set()) | self._prefixes.get(stem, set())
+
+    def search(self, query):
+        """Записи каталога по запросу, в порядке каталога; пустой запрос — категории и товары."""
+        words = normalize(query).split()
+        if not words:
+            return [entry for entry in self.entries if entry.id[0] in "ci"][:MAX_RESULTS]
+        found = None
+        for word in words:
+            matches = self._match_word(word)
+            found = matches if found is None else found & matches
+            if not found:
+                return []
+        return [self.entries[index] for index in sorted(found)][:MAX_RESULTS]
+
+    def results(self, query, bot_username):
+        """Готовые InlineQueryResult для запроса — из LRU или собранные заново."""
+        key = normalize(query)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.lookups.inc("hit")
+            return cached
+        self.lookups.inc("miss")
+
+        results = tuple(
+            InlineQueryResultArticle(
+                id=entry.id,
+                title=entry.title,
+                description=entry.description,
+                input_message_content=InputTextMessageContent(f"{entry.title}\n{entry.description}"),
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                    "Заказать", url=f"https://t.me/{bot_username}?start={entry.start_parameter}"
+                )]]),
+            )
+            for entry in self.search(query)
+        )
+        self._cache[key] = results
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return results
@@ -0,0 +1,273 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from multiprocessing.connection import wait as wait_for_any
+
+from tornado.httpserver import HTTPServer
+from tornado.web import HTTPError, RequestHandler
+from telegram import Update
+
+from metrics import metrics
+from server import (
+    check_webhook_request, ensure_webhook, json_loads, make_app, reject_not_ready, reject_saturated, run_application,
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать запуска воркеров и их мягкой остановки
+WORKER_START_TIMEOUT = 60
+WORKER_STOP_TIMEOUT = 30
+
+
+def update_owner(data):
+    """id пользователя (или чата, если пользователя нет) из сырого JSON апдейта.
+
+    Тот же ключ, что у PerUserUpdateProcessor: effective_user, затем effective_chat.
+    """
+    for key, value in data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if user:
+            return user["id"]
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+    return None
+
+
+def shard(owner, workers):
+    return 0 if owner is None else owner % workers
+
+
+# --- воркер ---
+
+async def _enqueue(application, body):
+    update = Update.de_json(json_loads(body), application.bot)
+    if update is not None:
+        await application.update_queue.put(update)
+
+
+def pipe_ingress(conn, ready, metrics_port=None, metrics_token=None, warm_up=None):
+    """Источник апдейтов воркера: входной процесс присылает их по каналу conn.
+
+    ready поднимается после warm_up(application): входной процесс ждёт его у всех воркеров.
+    """
+
+    @contextlib.asynccontextmanager
+    async def ingress(application, stop):
+        loop = asyncio.get_running_loop()
+
+        def pump():
+            # Поток ждёт следующий апдейт, пока предыдущий не встал в update_queue:
+            # если очередь полна, канал заполняется и притормаживает входной процесс
+            while True:
+                try:
+                    body = conn.recv_bytes()
+                except (EOFError, OSError):
+                    loop.call_soon_threadsafe(stop)
+                    return
+                try:
+                    asyncio.run_coroutine_threadsafe(_enqueue(application, body), loop).result()
+                except RuntimeError:
+                    # Цикл событий уже закрыт — бот останавливается
+                    return
+                except Exception as e:
+                    logger.error("Не удалось разобрать апдейт от входного процесса: %s", e)
+
+        # daemon: заблокированный recv_bytes не должен держать процесс при выходе
+        threading.Thread(target=pump, name="cluster-ingress", daemon=True).start()
+        server = None
+        if metrics_port:
+            server = HTTPServer(make_app(metrics_token=metrics_token))
+            server.listen(metrics_port)
+        if warm_up is not None:
+            await warm_up(application)
+        ready.set()
+        try:
+            yield
+        finally:
+            if server is not None:
+                server.stop()
+
+    return ingress
+
+
+def _worker_main(build_application, index, conn, ready, metrics_port, metrics_token, warm_up):
+    application = build_application(index)
+    asyncio.run(run_application(application, pipe_ingress(conn, ready, metrics_port, metrics_token, warm_up)))
+
+
+# --- входной процесс ---
+
+class _ForwardHandler(RequestHandler):
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, cluster, secret_token=None, capture=None, ready=None):
+        self.cluster = cluster
+        self.secret_token = secret_token
+        # Записываем во входном процессе: здесь видны апдейты всех воркеров
+        self.capture = capture
+        # Пока не прогреты все воркеры, апдейты возвращаются Telegram с 503
+        self.ready = ready
+
+    async def post(self):
+        check_webhook_request(self, self.secret_token)
+        if reject_not_ready(self, self.ready):
+            return
+        try:
+            data = json_loads(self.request.body)
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from e
+        worker = self.cluster.worker_for(data)
+        if worker.pending >= self.cluster.pending_limit:
+            reject_saturated(self)
+            return
+        try:
+            await self.cluster.forward(worker, self.request.body)
+        except OSError as e:
+            # Воркер упал: Telegram повторит апдейт, когда нас перезапустят
+            logger.error("Не удалось передать апдейт воркеру: %s", e)
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE) from e
+        if self.capture is not None:
+            self.capture.record(self.request.body)
+
+
+class _Worker:
+    def __init__(self, index, process, conn, ready):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.ready = ready
+        # Отправка в канал блокируется, когда воркер не успевает, — держим её вне цикла событий
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"cluster-send-{index}")
+        # Апдейты, ждущие отправки в канал
+        self.pending = 0
+
+
+class Cluster:
+    """Горизонтальное масштабирование: входной процесс и несколько воркеров с ботом.
+
+    Входной процесс принимает вебхук, достаёт из апдейта id пользователя и
+    передаёт апдейт воркеру user_id % workers. Все апдейты пользователя всегда
+    попадают в один процесс, поэтому ConversationHandler и user_data видят его
+    актуальное состояние, а общая база SQLite переживает перезапуск с другим
+    числом воркеров: состояние пользователя лениво поднимается новым владельцем.
+    """
+
+    def __init__(self, build_application, workers, metrics_port=None, metrics_token=None, warm_up=None,
+                 pending_limit=1000):
+        if workers < 1:
+            raise ValueError("workers must be a positive integer")
+        self.build_application = build_application
+        self.warm_up = warm_up
+        # Больше апдейтов на одного воркера не копим: сверх этого — 503, Telegram повторит
+        self.pending_limit = pending_limit
+        self.count = workers
+        self.metrics_port = metrics_port
+        self.metrics_token = metrics_token
+        self.workers = []
+        self.forwarded = metrics.counter("cluster_forwarded_total", "Апдейты, переданные воркерам", ("worker",))
+
+    def start_workers(self):
+        context = multiprocessing.get_context("spawn")
+        for index in range(self.count):
+            receiver, sender = context.Pipe(duplex=False)
+            ready = context.Event()
+            metrics_port = self.metrics_port + index if self.metrics_port else None
+            process = context.Process(
+                target=_worker_main,
+                args=(self.build_application, index, receiver, ready, metrics_port, self.metrics_token, self.warm_up),
+                name=f"bot-worker-{index}",
+            )
+            process.start()
+            receiver.close()
+            self.workers.append(_Worker(index, process, sender, ready))
+
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        return all(worker.ready.wait(max(0.0, deadline - time.monotonic())) for worker in self.workers)
+
+    def worker_for(self, data):
+        return self.workers[shard(update_owner(data), self.count)]
+
+    async def forward(self, worker, body):
+        worker.pending += 1
+        try:
+            await asyncio.get_running_loop().run_in_executor(worker.executor, worker.conn.send_bytes, body)
+        finally:
+            worker.pending -= 1
+        self.forwarded.inc(str(worker.index))
+
+    async def stop_workers(self):
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            # Конец канала — сигнал воркеру доработать очередь и выйти
+            worker.conn.close()
+            worker.executor.shutdown(wait=False)
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.process.join, WORKER_STOP_TIMEOUT)
+            if worker.process.is_alive():
+                logger.warning("Воркер %s не остановился вовремя, завершаем принудительно", worker.index)
+                worker.process.terminate()
+                await loop.run_in_executor(None, worker.process.join)
+
+    async def serve(self, bot, listen, port, url_path, webhook_url, metrics_token=None, extra_routes=(),
+                    secret_token=None, webhook_state_path=None, capture=None):
+        stopping = asyncio.Event()
+        ready = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            loop.add_signal_handler(sig, stopping.set)
+
+        self.start_workers()
+        sentinels = [worker.process.sentinel for worker in self.workers]
+        died = loop.run_in_executor(None, wait_for_any, sentinels)
+        server = HTTPServer(
+            make_app(url_path, _ForwardHandler,
+                     {"cluster": self, "secret_token": secret_token, "capture": capture, "ready": ready},
+                     metrics_token=metrics_token, extra_routes=extra_routes, ready=ready),
+            xheaders=True,
+        )
+        try:
+            started = time.perf_counter()
+            server.listen(port, listen)
+            # Вебхук регистрируем, только когда все воркеры прогреты и готовы принимать апдейты
+            if not await loop.run_in_executor(None, self.wait_ready, WORKER_START_TIMEOUT):
+                raise RuntimeError("воркеры не запустились вовремя")
+            async with bot:
+                await ensure_webhook(bot, webhook_url, secret_token, webhook_state_path)
+            ready.set()
+            logger.info("Вебхук слушает %s:%s, воркеров: %s, запуск занял %.2f с",
+                        listen, port, self.count, time.perf_counter() - started)
+
+            waiter = asyncio.ensure_future(stopping.wait())
+            await asyncio.wait({waiter, died}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if died.done():
+                logger.error("Воркер завершился, останавливаем все процессы")
+        finally:
+            server.stop()
+            await self.stop_workers()
+            await died
+
+
+def run_cluster(build_application, workers, bot, listen, port, url_path, webhook_url,
+                metrics_port=None, metrics_token=None, extra_routes=(), warm_up=None,
+                secret_token=None, webhook_state_path=None, pending_limit=1000, capture=None):
+    """Запуск в несколько процессов; build_application(index) и warm_up должны быть функциями уровня модуля.
+
+    extra_routes обслуживает входной процесс, рядом с вебхуком.
+    """
+    cluster = Cluster(build_application, workers, metrics_port=metrics_port, metrics_token=metrics_token,
+                      warm_up=warm_up, pending_limit=pending_limit)
+    asyncio.run(cluster.serve(
+        bot, listen, port, url_path, webhook_url, metrics_token, extra_routes, secret_token, webhook_state_path,
+        capture,
+    ))
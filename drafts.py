@@ -0,0 +1,31 @@
+class OrderDraft:
+    """Черновик заказа в user_data["draft"].
+
+    Хранит только ключи каталога и то, что пользователь ввёл сам: названия
+    берутся из каталога при показе, а не копируются в каждый черновик.
+    __slots__ убирает у объекта собственный __dict__, а pickle сохраняет
+    его кортежем значений — так компактнее и в памяти, и в базе.
+    """
+
+    __slots__ = ("category", "item_key", "wrap", "filling", "ribbon", "set_filling", "color_preferences", "price")
+
+    def __init__(self, category=None):
+        self.category = category
+        self.item_key = None
+        self.wrap = None
+        self.filling = None
+        self.ribbon = None
+        self.set_filling = None
+        self.color_preferences = None
+        self.price = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if getattr(self, name) is not None)
+        return f"OrderDraft({fields})"
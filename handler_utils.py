@@ -0,0 +1,84 @@
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+
+from logging_setup import log_context
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HandlerTimings:
+    """Время выполнения обработчиков: последние window замеров на каждый обработчик."""
+
+    def __init__(self, window=500):
+        self.window = window
+        self._samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._counts = defaultdict(int)
+        # Объект создаётся при импорте, то есть при запуске процесса
+        self.booted = time.monotonic()
+        self.first_response = None
+
+    def record(self, name, seconds):
+        self._samples[name].append(seconds)
+        self._counts[name] += 1
+        if self.first_response is None:
+            self.first_response = time.monotonic() - self.booted
+            logger.info("Первый ответ пользователю через %.2f с после запуска (%s)", self.first_response, name)
+
+    def summary(self):
+        rows = []
+        for name, samples in sorted(self._samples.items()):
+            ordered = sorted(samples)
+            rows.append({
+                "handler": name,
+                "count": self._counts[name],
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            })
+        return rows
+
+
+timings = HandlerTimings()
+
+
+def timed(func):
+    """Замеряет, сколько обработчик держит апдейт, и пишет это в timings и metrics."""
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        new_state = None
+        try:
+            with log_context(handler=func.__name__, state=metrics.handler_state(func.__name__)):
+                new_state = await func(update, context)
+            return new_state
+        finally:
+            seconds = time.perf_counter() - started
+            timings.record(func.__name__, seconds)
+            metrics.observe_handler(func.__name__, seconds, new_state, context)
+
+    return wrapper
+
+
+async def _logged(coroutine, description):
+    try:
+        await coroutine
+    except Exception as e:
+        logger.warning("Фоновый вызов «%s» не удался: %s", description, e)
+
+
+def run_in_background(context, coroutine, description):
+    """Запускает вызов Bot API, результат которого обработчику не нужен.
+
+    Задача создаётся через Application.create_task, поэтому при остановке бота
+    её дождутся, а ошибка попадёт в лог вместо того, чтобы уронить обработчик.
+    """
+    context.application.create_task(_logged(coroutine, description))
+
+
+def answer_in_background(context, query):
+    # Ответ на колбэк лишь убирает «часики» на кнопке — ждать его незачем
+    run_in_background(context, query.answer(), "ответ на колбэк")
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+
+from telegram.request import BaseRequest
+
+from metrics import InstrumentedRequest
+
+try:
+    import h2  # noqa: F401  HTTP/2 в httpx работает только с пакетом h2 (httpx[http2])
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+
+class RequestRouter(BaseRequest):
+    """Разводит вызовы Bot API по двум пулам соединений.
+
+    Загрузки файлов (фото с диска) идут через пул media, всё остальное —
+    через api. Фото в несколько мегабайт держит соединение секундами, и в
+    общем пуле короткие sendMessage и answerCallbackQuery ждали бы за ним.
+    Отправка по file_id — обычный короткий вызов и идёт через api.
+    """
+
+    def __init__(self, api, media):
+        self.api = api
+        self.media = media
+
+    @property
+    def read_timeout(self):
+        return self.api.read_timeout
+
+    async def initialize(self):
+        await asyncio.gather(self.api.initialize(), self.media.initialize())
+
+    async def shutdown(self):
+        await asyncio.gather(self.api.shutdown(), self.media.shutdown())
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        target = self.media if request_data is not None and request_data.contains_files else self.api
+        return await target.do_request(url, method, request_data, *args, **kwargs)
+
+
+def make_request(pool_size, media_pool_size, keepalive, connect_timeout, read_timeout, write_timeout,
+                 pool_timeout, media_write_timeout, http2=False):
+    """RequestRouter с двумя InstrumentedRequest по заданным настройкам."""
+    if http2 and h2 is None:
+        logger.warning("HTTP/2 недоступен: не установлен пакет h2 (pip install 'httpx[http2]'), работаем по HTTP/1.1")
+        http2 = False
+    common = {
+        "keepalive_expiry": keepalive,
+        "connect_timeout": connect_timeout,
+        "read_timeout": read_timeout,
+        "pool_timeout": pool_timeout,
+        "media_write_timeout": media_write_timeout,
+        "http_version": "2" if http2 else "1.1",
+    }
+    api = InstrumentedRequest("api", connection_pool_size=pool_size, write_timeout=write_timeout, **common)
+    media = InstrumentedRequest("media", connection_pool_size=media_pool_size, write_timeout=media_write_timeout, **common)
+    return RequestRouter(api, media)
+
+
+async def warm_connections(bot, count):
+    """Открывает до count соединений основного пула параллельными getMe.
+
+    Иначе TCP и TLS к api.telegram.org первым клиентам после деплоя пришлось
+    бы ждать самим. Соединения живут, пока не истечёт keep-alive.
+    """
+    results = await asyncio.gather(*(bot.get_me() for _ in range(count)), return_exceptions=True)
+    failed = [result for result in results if isinstance(result, Exception)]
+    if failed:
+        logger.warning("Не удалось заранее открыть %s соединений из %s: %s", len(failed), count, failed[0])
@@ -0,0 +1,89 @@
+from types import MappingProxyType
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+BACK_TO_CATEGORIES_TEXT = "← Назад к категориям"
+BACK_TO_BOUQUETS_TEXT = "← Назад к букетам"
+BACK_TO_SETS_TEXT = "← Назад к наборам"
+
+
+class KeyboardRegistry:
+    """Все клавиатуры бота, собранные один раз из словарей каталога.
+
+    InlineKeyboardMarkup в python-telegram-bot неизменяемы после создания,
+    поэтому один и тот же экземпляр можно безопасно отдавать всем обработчикам.
+    Данные кнопок берутся из CallbackRouter. После правки каталога достаточно
+    вызвать rebuild() — он пересоберёт и таблицу маршрутов.
+    """
+
+    def __init__(self, router, categories, wrap_colors, fillings, set_fillings, set_filling_rules, ribbon_colors):
+        self.router = router
+        self._categories = categories
+        self._wrap_colors = wrap_colors
+        self._fillings = fillings
+        self._set_fillings = set_fillings
+        self._set_filling_rules = set_filling_rules
+        self._ribbon_colors = ribbon_colors
+        self.rebuild()
+
+    def rebuild(self):
+        self.router.compile()
+        to = self.router.payload
+
+        back_to_categories = (InlineKeyboardButton(BACK_TO_CATEGORIES_TEXT, callback_data=to("back_to_categories")),)
+        back_to_bouquets = (InlineKeyboardButton(BACK_TO_BOUQUETS_TEXT, callback_data=to("back_to_bouquets")),)
+        back_to_sets = (InlineKeyboardButton(BACK_TO_SETS_TEXT, callback_data=to("back_to_sets")),)
+
+        self.categories = InlineKeyboardMarkup([
+            [InlineKeyboardButton(category["name"], callback_data=to("category", key))
+             for key, category in self._categories.items()]
+        ])
+
+        self._items = MappingProxyType({
+            category_key: InlineKeyboardMarkup(
+                [[InlineKeyboardButton(name, callback_data=to("item", key))]
+                 for key, name in category["items"].items()]
+                + [back_to_categories]
+            )
+            for category_key, category in self._categories.items()
+        })
+
+        self.wraps = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(name, callback_data=to("wrap", key))] for key, name in self._wrap_colors.items()]
+            + [back_to_bouquets]
+        )
+        self.fillings = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(name, callback_data=to("fillb", key))] for key, name in self._fillings.items()]
+            + [back_to_bouquets]
+        )
+        self.ribbons_bouquet = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(name, callback_data=to("ribbonb", key))] for key, name in self._ribbon_colors.items()]
+            + [back_to_bouquets]
+        )
+        self.ribbons_set = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(name, callback_data=to("ribbons", key))] for key, name in self._ribbon_colors.items()]
+            + [back_to_sets]
+        )
+
+        set_fillings = {}
+        for item_key in self._categories.get("sets", {}).get("items", {}):
+            allowed = self._set_filling_rules.get(item_key, list(self._set_fillings))
+            rows = [
+                [InlineKeyboardButton(self._set_fillings[key], callback_data=to("setfill", key))]
+                for key in allowed if key in self._set_fillings
+            ]
+            # Пустой набор наполнений — это ошибка каталога, а не клавиатура из одной кнопки «Назад»
+            if rows:
+                set_fillings[item_key] = InlineKeyboardMarkup(rows + [back_to_sets])
+        self._set_filling_markups = MappingProxyType(set_fillings)
+
+        self.confirm = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Да, всё верно", callback_data=to("confirm_final"))],
+            [InlineKeyboardButton("❌ Начать заново", callback_data=to("restart"))]
+        ])
+
+    def items(self, category_key):
+        return self._items[category_key]
+
+    def set_fillings(self, item_key):
+        return self._set_filling_markups.get(item_key)
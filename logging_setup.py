@@ -0,0 +1,152 @@
+import atexit
+import contextlib
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+# Поля текущего апдейта, которые попадают в каждую запись лога
+_context = contextvars.ContextVar("log_context", default={})
+CONTEXT_FIELDS = ("user_id", "state", "handler")
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Добавляет поля ко всем записям лога внутри блока, в том числе из порождённых задач."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    # Работает в потоке, который пишет запись, — пока contextvars ещё те, что у апдейта
+    def filter(self, record):
+        for name, value in _context.get().items():
+            setattr(record, name, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Ограничивает шумные логгеры: не больше limits[имя] записей одного шаблона за period секунд.
+
+    ERROR и выше проходят всегда. О пропущенных записях сообщает первая
+    запись следующего окна (поле suppressed).
+    """
+
+    def __init__(self, limits, period=60.0):
+        super().__init__()
+        self.limits = limits
+        self.period = period
+        # (логгер, шаблон сообщения) → [начало окна, записей в окне]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        limit = self.limits.get(record.name)
+        if limit is None or record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= self.period:
+                if window is not None and window[1] > limit:
+                    record.suppressed = window[1] - limit
+                self._windows[key] = [record.created, 1]
+                return True
+            window[1] += 1
+            return window[1] <= limit
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Стандартный prepare вклеивает трассировку в текст сообщения — оставляем её отдельным полем
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.processName,
+            "message": record.getMessage(),
+        }
+        for name in CONTEXT_FIELDS + ("suppressed",):
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Прежний текстовый формат; поля апдейта — в квадратных скобках в конце."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = [f"{name}={getattr(record, name)}" for name in CONTEXT_FIELDS + ("suppressed",)
+                  if getattr(record, name, None) is not None]
+        return f"{text} [{' '.join(fields)}]" if fields else text
+
+
+def parse_sampling(value):
+    """«handler_utils=20,media=5» → {"handler_utils": 20, "media": 5}."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, limit = item.partition("=")
+        limits[name.strip()] = int(limit)
+    return limits
+
+
+def _stop_listener(listener):
+    # Повторный stop() в Python 3.11 падает — например, если поток уже остановили вручную
+    with contextlib.suppress(AttributeError):
+        listener.stop()
+
+
+def setup_logging(level=logging.INFO, json_format=True, sampling=None, stream=None):
+    """Логи через очередь: вызов logger.* только кладёт запись в очередь, пишет её отдельный поток.
+
+    Запись в stderr (или stream) больше не блокирует цикл событий, даже если
+    вывод читают медленно. Возвращает запущенный QueueListener.
+    """
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    queue_handler.addFilter(ContextFilter())
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+
+    sink = logging.StreamHandler(stream or sys.stderr)
+    sink.setFormatter(JsonFormatter() if json_format else TextFormatter())
+    listener = logging.handlers.QueueListener(records, sink, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener.start()
+    # Дописать очередь до выхода процесса
+    atexit.register(_stop_listener, listener)
+    return listener
@@ -0,0 +1,300 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import InputMediaPhoto, Message
+from telegram.error import BadRequest
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# Фото в Telegram хранятся не больше 1280 пикселей по длинной стороне — больше слать незачем
+MAX_SIDE = 1280
+JPEG_QUALITY = 85
+
+# sha256 — исходного файла: по нему file_id из кеша остаётся верным и после смены настроек сжатия
+Photo = namedtuple("Photo", "data filename sha256 mtime_ns size")
+
+
+# Telegram не даёт отдельного кода ошибки — узнаём отвергнутый file_id по тексту.
+# Прочие ошибки про файл («file is too big») перезагрузкой не лечатся
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file id", "wrong type of the web page content")
+
+
+def _is_file_id_error(error):
+    message = str(error).lower()
+    return any(text in message for text in FILE_ID_ERRORS)
+
+
+def _optimize(data, filename, max_side, quality):
+    """Уменьшает фото до max_side по длинной стороне и пережимает в JPEG (нужен Pillow).
+
+    Возвращает (байты, имя файла); без Pillow или если выигрыша нет — исходные.
+    """
+    if Image is None:
+        return data, filename
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            image = ImageOps.exif_transpose(original)
+            oversized = max(image.size) > max_side
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+            if image.mode not in ("RGB", "L"):
+                # Прозрачность JPEG не поддерживает — подкладываем белый фон
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+                image = background
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=quality, optimize=True, progressive=True)
+    except (OSError, ValueError) as e:
+        logger.warning("Не удалось пережать %s, отправляем как есть: %s", filename, e)
+        return data, filename
+    optimized = buffer.getvalue()
+    if not oversized and len(optimized) >= len(data):
+        return data, filename
+    return optimized, os.path.splitext(filename)[0] + ".jpg"
+
+
+class MediaRegistry:
+    """Фото каталога в памяти; каждое загружается в Telegram один раз и дальше отправляется по file_id.
+
+    Файлы из directory читаются, уменьшаются и пережимаются один раз —
+    в start(), в отдельном потоке. Дальше каталог опрашивается в фоне, и
+    изменённые фото подменяются целиком, так что обработчики работают только
+    с байтами в памяти и к диску не обращаются.
+
+    Кеш file_id хранится в JSON-файле, поэтому после перезапуска повторной
+    загрузки не будет. Если содержимое файла изменилось (другой sha256) или
+    Telegram отверг file_id, фото загружается заново.
+    """
+
+    def __init__(self, cache_path, directory, max_side=MAX_SIDE, quality=JPEG_QUALITY):
+        self.cache_path = cache_path
+        self.directory = directory
+        self.max_side = max_side
+        self.quality = quality
+        self._entries = self._load()
+        self._photos = {}
+        self._locks = {}
+        # Запись кеша — в своём потоке и строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="media")
+        self._watch_task = None
+
+    # --- кеш file_id ---
+
+    def _load(self):
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Не удалось прочитать кеш медиа %s: %s", self.cache_path, e)
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, payload):
+        # Свой временный файл на процесс: в кластере кеш пишут несколько воркеров
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning("Не удалось сохранить кеш медиа %s: %s", self.cache_path, e)
+
+    def _save(self):
+        payload = json.dumps(self._entries, ensure_ascii=False, indent=2)
+        asyncio.get_running_loop().run_in_executor(self._executor, self._write, payload)
+
+    # --- фото на диске (в отдельном потоке) ---
+
+    def _read(self, path, st):
+        with open(path, "rb") as f:
+            data = f.read()
+        sha = hashlib.sha256(data).hexdigest()
+        data, filename = _optimize(data, os.path.basename(path), self.max_side, self.quality)
+        return Photo(data, filename, sha, st.st_mtime_ns, st.st_size)
+
+    def _scan(self, known):
+        """Изменения в каталоге относительно known {path: (mtime_ns, size)}: новые фото и исчезнувшие пути."""
+        changed = {}
+        seen = set()
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError as e:
+            logger.warning("Не удалось прочитать каталог фото %s: %s", self.directory, e)
+            return changed, set()
+        for entry in entries:
+            if not entry.name.lower().endswith(PHOTO_EXTENSIONS) or not entry.is_file():
+                continue
+            path = os.path.join(self.directory, entry.name)
+            seen.add(path)
+            try:
+                st = entry.stat()
+                if known.get(path) != (st.st_mtime_ns, st.st_size):
+                    changed[path] = self._read(path, st)
+            except OSError as e:
+                logger.warning("Не удалось прочитать фото %s: %s", path, e)
+        return changed, set(known) - seen
+
+    async def refresh(self):
+        """Перечитывает изменившиеся фото; возвращает, сколько путей обновлено или удалено."""
+        known = {path: (photo.mtime_ns, photo.size) for path, photo in self._photos.items()}
+        changed, removed = await asyncio.to_thread(self._scan, known)
+        for path, photo in changed.items():
+            previous = self._photos.get(path)
+            self._photos[path] = photo
+            logger.info("Фото %s загружено в память: %s КБ%s", path, len(photo.data) // 1024,
+                        " (файл изменился)" if previous else "")
+        for path in removed:
+            del self._photos[path]
+            logger.warning("Фото %s удалено из каталога", path)
+        return len(changed) + len(removed)
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("Не удалось обновить фото из %s: %s", self.directory, e)
+
+    async def start(self, poll_interval=None):
+        """Загружает все фото каталога и, если задан poll_interval, следит за изменениями."""
+        await self.refresh()
+        if Image is None:
+            logger.warning("Pillow не установлен (pip install -r requirements.txt): фото отправляются без уменьшения")
+        if poll_interval and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch(poll_interval))
+
+    async def stop(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
+        self._executor.shutdown(wait=True)
+
+    # --- отправка ---
+
+    def available(self, path):
+        return path in self._photos
+
+    def file_id(self, path):
+        entry = self._entries.get(path)
+        return entry["file_id"] if entry else None
+
+    def forget(self, path):
+        if self._entries.pop(path, None) is not None:
+            self._save()
+
+    def _cached_file_id(self, path, photo):
+        entry = self._entries.get(path)
+        return entry["file_id"] if entry and entry.get("sha256") == photo.sha256 else None
+
+    def shows(self, message, path):
+        """Уже ли в сообщении это фото — тогда шагу достаточно сменить подпись.
+
+        Сравнивается file_unique_id: file_id одного и того же файла у разных сообщений может отличаться.
+        """
+        photo = self._photos.get(path)
+        entry = self._entries.get(path)
+        if not message.photo or photo is None or entry is None or entry.get("sha256") != photo.sha256:
+            return False
+        return message.photo[-1].file_unique_id == entry.get("file_unique_id")
+
+    async def send_photo(self, bot, chat_id, path, **kwargs):
+        """Отправляет фото по file_id, при необходимости загружая его из памяти.
+
+        Возвращает None, если такого фото нет, — тогда вызывающий код
+        сам решает, чем его заменить. Ошибки, не связанные с file_id, пробрасываются наверх.
+        """
+        photo = self._photos.get(path)
+        if photo is None:
+            return None
+
+        file_id = self._cached_file_id(path, photo)
+        if file_id:
+            try:
+                return self._learn(path, photo, await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs))
+            except BadRequest as e:
+                # Ошибка не про file_id (подпись, разметка, чат) — file_id исправен, загрузка не поможет
+                if not _is_file_id_error(e):
+                    raise
+                logger.warning("Telegram отклонил file_id для %s, загружаем заново: %s", path, e)
+                self.forget(path)
+
+        # Один путь загружает только один запрос: остальные ждут и берут готовый file_id
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            file_id = self._cached_file_id(path, photo)
+            if file_id:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+
+            message = await bot.send_photo(chat_id=chat_id, photo=photo.data, filename=photo.filename, **kwargs)
+            self._remember(path, photo, message)
+            return message
+
+    def _remember(self, path, photo, message):
+        if isinstance(message, Message) and message.photo:
+            size = message.photo[-1]
+            self._entries[path] = {
+                "sha256": photo.sha256, "file_id": size.file_id, "file_unique_id": size.file_unique_id,
+            }
+            self._save()
+
+    def _learn(self, path, photo, message):
+        # Записи кеша до появления file_unique_id дополняются при первой же отправке по file_id
+        if "file_unique_id" not in self._entries.get(path, {}):
+            self._remember(path, photo, message)
+        return message
+
+    async def edit_photo(self, message, path, caption=None, reply_markup=None, **kwargs):
+        """Заменяет фото в существующем сообщении, по file_id или загрузкой из памяти.
+
+        Возвращает None, если такого фото нет. Ошибки редактирования, не
+        связанные с file_id (например, сообщение без фото), пробрасываются наверх.
+        """
+        photo = self._photos.get(path)
+        if photo is None:
+            return None
+
+        file_id = self._cached_file_id(path, photo)
+        if file_id:
+            try:
+                result = await message.edit_media(
+                    InputMediaPhoto(file_id, caption=caption, **kwargs), reply_markup=reply_markup
+                )
+                return self._learn(path, photo, result)
+            except BadRequest as e:
+                if not _is_file_id_error(e):
+                    raise
+                logger.warning("Telegram отклонил file_id для %s, загружаем заново: %s", path, e)
+                self.forget(path)
+
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            file_id = self._cached_file_id(path, photo)
+            if file_id:
+                return await message.edit_media(
+                    InputMediaPhoto(file_id, caption=caption, **kwargs), reply_markup=reply_markup
+                )
+
+            result = await message.edit_media(
+                InputMediaPhoto(photo.data, caption=caption, filename=photo.filename, **kwargs),
+                reply_markup=reply_markup,
+            )
+            self._remember(path, photo, result)
+            return result
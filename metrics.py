@@ -0,0 +1,263 @@
+import bisect
+import contextvars
+import time
+from collections import defaultdict
+
+import httpx
+from telegram.request import HTTPXRequest
+
+# Границы корзин гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = defaultdict(int)
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] += amount
+
+    def total(self):
+        return sum(self._values.values())
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} counter"
+        for label_values, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.label_names, label_values)} {_number(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        # На каждый набор меток: счётчики корзин (последняя — +Inf), сумма
+        self._series = {}
+
+    def observe(self, seconds, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        series[1] += seconds
+
+    def count(self):
+        return sum(sum(counts) for counts, _ in self._series.values())
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} histogram"
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.label_names, label_values, (le,))} {cumulative}"
+            labels = _labels(self.label_names, label_values)
+            yield f"{self.name}_sum{labels} {_number(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """Значение снимается в момент запроса /metrics вызовом функции."""
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {_number(self.read())}"
+
+
+# Ключ user_data с состояниями, до которых пользователь уже дошёл в текущем заказе
+FUNNEL_KEY = "funnel"
+
+
+class Metrics:
+    """Метрики бота в текстовом формате Prometheus.
+
+    Обновление — запись в словарь без блокировок: всё происходит в одном
+    цикле событий. Gauge-метрики ничего не хранят и считаются при выдаче.
+    """
+
+    def __init__(self, prefix="marmeladysh"):
+        self.prefix = prefix
+        self._metrics = []
+        # Имя функции-обработчика → состояние диалога, номер состояния → имя
+        self._handler_states = {}
+        self._state_names = {}
+
+        self.handler_latency = self.histogram(
+            "handler_duration_seconds", "Время обработчика диалога по состояниям", ("state", "handler")
+        )
+        self.funnel = self.counter(
+            "funnel_entries_total", "Пользователи, дошедшие до состояния диалога (каждый — раз за заказ)", ("state",)
+        )
+        self.orders = self.counter("orders_confirmed_total", "Подтверждённые заказы")
+        self.api_calls = self.counter("bot_api_requests_total", "Вызовы Bot API", ("method", "status"))
+        self.api_latency = self.histogram("bot_api_request_duration_seconds", "Время вызова Bot API", ("method",))
+        self.pool_wait = self.histogram(
+            "http_pool_wait_seconds", "Ожидание свободного соединения в пуле HTTP-клиента", ("pool",)
+        )
+        self.pool_requests = self.counter(
+            "http_pool_requests_total", "Запросы по пулам: на новом соединении или на уже открытом",
+            ("pool", "connection"),
+        )
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(f"{self.prefix}_{name}", help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labels=()):
+        metric = Histogram(f"{self.prefix}_{name}", help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, read):
+        metric = Gauge(f"{self.prefix}_{name}", help_text, read)
+        self._metrics.append(metric)
+        return metric
+
+    def register_conversation(self, conversation, state_names):
+        """Запоминает, какой обработчик какому состоянию ConversationHandler принадлежит."""
+        self._state_names.update(state_names)
+        for handler in conversation.entry_points:
+            self._handler_states[handler.callback.__name__] = "ENTRY"
+        for state, handlers in conversation.states.items():
+            for handler in handlers:
+                self._handler_states[handler.callback.__name__] = state_names.get(state, str(state))
+        for handler in conversation.fallbacks:
+            self._handler_states[handler.callback.__name__] = "FALLBACK"
+
+    def handler_state(self, name):
+        return self._handler_states.get(name, "OTHER")
+
+    def observe_handler(self, name, seconds, new_state=None, context=None):
+        state = self.handler_state(name)
+        self.handler_latency.observe(seconds, state, name)
+        # В воронку попадают только переходы: повтор того же шага — не новый этап
+        new_name = self._state_names.get(new_state)
+        if new_name is None or new_name == state:
+            return
+        # Пользователь считается в состоянии один раз за заказ: возвраты «назад» и повторные проходы
+        # воронку не раздувают. Отметки живут в user_data и сбрасываются вместе с ним на /start
+        user_data = context.user_data if context is not None else None
+        if user_data is not None:
+            reached = user_data.setdefault(FUNNEL_KEY, set())
+            if new_name in reached:
+                return
+            reached.add(new_name)
+        self.funnel.inc(new_name)
+
+    def observe_api_call(self, method, status, seconds):
+        self.api_calls.inc(method, status)
+        self.api_latency.observe(seconds, method)
+
+    def calls_per_update(self):
+        """Сколько вызовов Bot API в среднем приходится на апдейт, дошедший до обработчика."""
+        handled = self.handler_latency.count()
+        return self.api_calls.total() / handled if handled else 0.0
+
+    def observe_pool(self, pool, seconds, reused):
+        self.pool_wait.observe(seconds, pool)
+        self.pool_requests.inc(pool, "reused" if reused else "new")
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+# Когда запрос встал в очередь за соединением; None — свободное соединение было сразу
+_pool_queued_at = contextvars.ContextVar("pool_queued_at", default=None)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API и их время по методам.
+
+    Кроме того, замеряет, сколько запрос ждал соединения в пуле pool, и через
+    trace-расширение httpcore — было ли соединение новым или уже открытым.
+    Ждут только запросы сверх connection_pool_size одновременных: остальным
+    ожидание записывается нулём, иначе в метрику попала бы задержка цикла
+    событий, и по ней пул растили бы без толку.
+    keepalive_expiry — сколько секунд простаивающее соединение держится открытым.
+    """
+
+    def __init__(self, pool="api", keepalive_expiry=5.0, connection_pool_size=256, httpx_kwargs=None, **kwargs):
+        self.pool = pool
+        self.max_connections = connection_pool_size
+        self._in_flight = 0
+        httpx_kwargs = {
+            "limits": httpx.Limits(
+                max_connections=connection_pool_size,
+                max_keepalive_connections=connection_pool_size,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            **(httpx_kwargs or {}),
+            "event_hooks": {"request": [self._trace_pool]},
+        }
+        super().__init__(connection_pool_size=connection_pool_size, httpx_kwargs=httpx_kwargs, **kwargs)
+
+    async def _trace_pool(self, request):
+        queued = _pool_queued_at.get()
+        waiting = True
+
+        async def trace(event, info):
+            nonlocal waiting
+            # Первое событие после выдачи соединения: либо открываем новое, либо сразу шлём заголовки
+            if not waiting:
+                return
+            if event == "connection.connect_tcp.started":
+                reused = False
+            elif event.endswith(".send_request_headers.started"):
+                reused = True
+            else:
+                return
+            waiting = False
+            metrics.observe_pool(self.pool, time.perf_counter() - queued if queued is not None else 0.0, reused)
+
+        request.extensions["trace"] = trace
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        status = "error"
+        # Хук запроса httpx выполняется в той же задаче и видит эту отметку
+        token = _pool_queued_at.set(started if self._in_flight >= self.max_connections else None)
+        self._in_flight += 1
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            self._in_flight -= 1
+            _pool_queued_at.reset(token)
+            metrics.observe_api_call(api_method, status, time.perf_counter() - started)
@@ -0,0 +1,238 @@
+import asyncio
+import csv
+import io
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from tornado.web import HTTPError, RequestHandler
+
+from server import has_bearer_token
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    user_id INTEGER NOT NULL,
+    username TEXT,
+    full_name TEXT,
+    category TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    item_name TEXT NOT NULL,
+    wrap_color TEXT,
+    filling TEXT,
+    set_filling TEXT,
+    ribbon_color TEXT,
+    color_preferences TEXT,
+    price TEXT
+);
+-- id в конце индекса: постраничная выборка «id < ? ORDER BY id DESC» идёт прямо по нему
+CREATE INDEX IF NOT EXISTS orders_user_id ON orders (user_id, id);
+CREATE INDEX IF NOT EXISTS orders_created_at ON orders (created_at);
+CREATE INDEX IF NOT EXISTS orders_category ON orders (category, id);
+CREATE INDEX IF NOT EXISTS orders_item_key ON orders (item_key, id);
+CREATE TRIGGER IF NOT EXISTS orders_no_update BEFORE UPDATE ON orders
+BEGIN SELECT RAISE(ABORT, 'orders are append-only'); END;
+CREATE TRIGGER IF NOT EXISTS orders_no_delete BEFORE DELETE ON orders
+BEGIN SELECT RAISE(ABORT, 'orders are append-only'); END;
+"""
+
+COLUMNS = (
+    "id", "created_at", "user_id", "username", "full_name", "category", "item_key", "item_name",
+    "wrap_color", "filling", "set_filling", "ribbon_color", "color_preferences", "price",
+)
+Order = namedtuple("Order", COLUMNS)
+
+# Поля заказа, которые записываются как есть
+_ORDER_FIELDS = COLUMNS[5:]
+
+# Условия фильтров; у каждого есть подходящий индекс
+_FILTERS = {
+    "category": "category = ?",
+    "item_key": "item_key = ?",
+    "user_id": "user_id = ?",
+    "since": "created_at >= ?",
+    "until": "created_at < ?",
+}
+
+# Заказы одной страницей /orders и одним куском выгрузки CSV
+PAGE_SIZE = 10
+EXPORT_CHUNK = 500
+
+
+def _where(filters, *extra):
+    clauses = [_FILTERS[name] for name in _FILTERS if filters.get(name) is not None]
+    params = [filters[name] for name in _FILTERS if filters.get(name) is not None]
+    for clause, param in extra:
+        clauses.append(clause)
+        params.append(param)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+class OrderStore:
+    """Журнал подтверждённых заказов в SQLite, только на добавление.
+
+    Изменить или удалить строку не дают триггеры. Выборки постраничные по id
+    (keyset): страница — это «id меньше последнего показанного», без OFFSET,
+    поэтому листание и выгрузка стоят одинаково на любой глубине истории.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="orders")
+        self._conn = None
+
+    # --- работа с базой (в отдельном потоке) ---
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _insert(self, values):
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" * len(values))
+        cursor = self._connect().execute(
+            f"INSERT INTO orders ({columns}) VALUES ({placeholders})", tuple(values.values())
+        )
+        return cursor.lastrowid
+
+    def _select(self, filters, extra, order, limit):
+        where, params = _where(filters, *extra)
+        rows = self._connect().execute(
+            f"SELECT {', '.join(COLUMNS)} FROM orders{where} ORDER BY id {order} LIMIT ?", (*params, limit)
+        ).fetchall()
+        return [Order(*row) for row in rows]
+
+    def _max_id(self):
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+
+    def _customers(self, after, limit):
+        # DISTINCT по возрастанию user_id идёт прямо по индексу orders_user_id
+        rows = self._connect().execute(
+            "SELECT DISTINCT user_id FROM orders WHERE user_id > ? ORDER BY user_id LIMIT ?", (after, limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _customer_count(self):
+        return self._connect().execute("SELECT COUNT(DISTINCT user_id) FROM orders").fetchone()[0]
+
+    # --- публичный интерфейс ---
+
+    async def add(self, user, order):
+        values = {
+            "created_at": time.time(),
+            "user_id": user.id,
+            "username": user.username,
+            "full_name": user.full_name,
+            **{field: order.get(field) for field in _ORDER_FIELDS},
+        }
+        return await self._run(self._insert, values)
+
+    async def page(self, filters, before=None, after=None, limit=PAGE_SIZE):
+        """Страница заказов от новых к старым и признаки «есть новее» / «есть старше».
+
+        before — показать заказы старше этого id, after — новее этого id.
+        """
+        if after is not None:
+            rows = await self._run(self._select, filters, [("id > ?", after)], "ASC", limit + 1)
+            has_newer = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_older = bool(rows) and bool(
+                await self._run(self._select, filters, [("id < ?", rows[-1].id)], "DESC", 1)
+            )
+            return rows, has_newer, has_older
+
+        extra = [("id < ?", before)] if before is not None else []
+        rows = await self._run(self._select, filters, extra, "DESC", limit + 1)
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = before is not None and bool(rows) and bool(
+            await self._run(self._select, filters, [("id > ?", rows[0].id)], "ASC", 1)
+        )
+        return rows, has_newer, has_older
+
+    async def customers(self, after=0, limit=EXPORT_CHUNK):
+        """id заказывавших пользователей по возрастанию, начиная после after: для рассылки пачками."""
+        return await self._run(self._customers, after, limit)
+
+    async def customer_count(self):
+        return await self._run(self._customer_count)
+
+    async def iter_csv(self, filters, chunk_size=EXPORT_CHUNK):
+        """CSV по кускам из chunk_size строк: в памяти никогда не больше одного куска.
+
+        Выгружаются заказы, существовавшие на момент начала выгрузки.
+        """
+        last_id = await self._run(self._max_id)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM — чтобы Excel сразу открыл кириллицу в UTF-8
+        buffer.write("\ufeff")
+        writer.writerow(COLUMNS)
+        after = 0
+        while True:
+            extra = [("id > ?", after), ("id <= ?", last_id)]
+            rows = await self._run(self._select, filters, extra, "ASC", chunk_size)
+            for row in rows:
+                created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row.created_at))
+                writer.writerow(row._replace(created_at=created_at))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1].id
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+class OrdersCsvHandler(RequestHandler):
+    """GET /orders.csv?category=&item_key=&user_id=&since=&until= — потоковая выгрузка заказов.
+
+    Доступна только с заголовком «Authorization: Bearer <token>»; без токена
+    в настройках выгрузка выключена. since и until — даты ГГГГ-ММ-ДД.
+    """
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def initialize(self, store, token):
+        self.store = store
+        self.token = token
+
+    def _filters(self):
+        filters = {}
+        try:
+            for name in ("category", "item_key"):
+                filters[name] = self.get_query_argument(name, None)
+            user_id = self.get_query_argument("user_id", None)
+            filters["user_id"] = int(user_id) if user_id else None
+            for name in ("since", "until"):
+                value = self.get_query_argument(name, None)
+                filters[name] = time.mktime(time.strptime(value, "%Y-%m-%d")) if value else None
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from e
+        return filters
+
+    async def get(self):
+        if not self.token:
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        if not has_bearer_token(self, self.token):
+            raise HTTPError(HTTPStatus.UNAUTHORIZED)
+        filters = self._filters()
+        self.set_header("Content-Type", "text/csv; charset=utf-8")
+        self.set_header("Content-Disposition", 'attachment; filename="orders.csv"')
+        async for chunk in self.store.iter_csv(filters):
+            self.write(chunk)
+            await self.flush()
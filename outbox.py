@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    parse_mode TEXT,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_next_attempt_at ON outbox (next_attempt_at);
+"""
+
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after бывает и int, и timedelta — в зависимости от настроек PTB."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class TokenBucket:
+    """Простой token bucket: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds):
+        """Полностью останавливает выдачу токенов, например после RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Outbox:
+    """Надёжная очередь исходящих сообщений (например, заказов менеджеру).
+
+    put() сначала записывает сообщение в SQLite, а фоновая задача отправляет
+    очередь с ограничением скорости. При сетевых ошибках сообщение остаётся в
+    очереди и повторяется с экспоненциальной задержкой; RetryAfter от Telegram
+    приостанавливает всю отправку на указанное время. Сообщения не удаляются,
+    пока Telegram не подтвердит доставку.
+
+    Если в одну базу пишут несколько процессов, отправляет очередь только один
+    из них (start(bot, drain=True)) и раз в poll_interval секунд перечитывает
+    таблицу: о чужих put() ему никто не сообщит.
+    """
+
+    def __init__(self, filepath, rate_per_minute=20, max_backoff=300, poll_interval=None):
+        self.filepath = filepath
+        self.bucket = TokenBucket(rate_per_minute / 60)
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox")
+        self._conn = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._depth = 0
+        self._latencies = deque(maxlen=100)
+        self.delivered = 0
+        self.failed_attempts = 0
+
+    # --- работа с базой (в отдельном потоке) ---
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _insert(self, chat_id, text, parse_mode, now):
+        self._connect().execute(
+            "INSERT INTO outbox (chat_id, text, parse_mode, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, text, parse_mode, now, now),
+        )
+
+    def _count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def _next(self):
+        return self._connect().execute(
+            "SELECT id, chat_id, text, parse_mode, created_at, attempts, next_attempt_at "
+            "FROM outbox ORDER BY next_attempt_at, id LIMIT 1"
+        ).fetchone()
+
+    def _delete(self, row_id):
+        self._connect().execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+    def _reschedule(self, row_id, attempts, next_attempt_at, parse_mode):
+        self._connect().execute(
+            "UPDATE outbox SET attempts = ?, next_attempt_at = ?, parse_mode = ? WHERE id = ?",
+            (attempts, next_attempt_at, parse_mode, row_id),
+        )
+
+    # --- публичный интерфейс ---
+
+    async def put(self, chat_id, text, parse_mode=None):
+        await self._run(self._insert, chat_id, text, parse_mode, time.time())
+        self._depth += 1
+        self._wakeup.set()
+
+    @property
+    def depth(self):
+        return self._depth
+
+    async def refresh_depth(self):
+        # Точная длина очереди из базы, включая сообщения других процессов
+        self._depth = await self._run(self._count)
+        return self._depth
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            "depth": self._depth,
+            "delivered": self.delivered,
+            "failed_attempts": self.failed_attempts,
+            "latency_last": self._latencies[-1] if self._latencies else None,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+            "latency_max": latencies[-1] if latencies else None,
+        }
+
+    async def start(self, bot, drain=True):
+        await self.refresh_depth()
+        if not drain:
+            return
+        if self._depth:
+            logger.info("В очереди уведомлений %s неотправленных сообщений", self._depth)
+        self._task = asyncio.get_running_loop().create_task(self._drain(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    # --- фоновая отправка ---
+
+    def _backoff(self, attempts):
+        delay = min(self.max_backoff, 2 ** attempts)
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _sleep(self, timeout):
+        if self.poll_interval is not None:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _drain(self, bot):
+        while True:
+            self._wakeup.clear()
+            row = await self._run(self._next)
+            if row is None:
+                await self._sleep(None)
+                if self.poll_interval is not None:
+                    await self.refresh_depth()
+                continue
+
+            row_id, chat_id, text, parse_mode, created_at, attempts, next_attempt_at = row
+            delay = next_attempt_at - time.time()
+            if delay > 0:
+                await self._sleep(delay)
+                continue
+
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            except RetryAfter as e:
+                retry_after = retry_after_seconds(e)
+                logger.warning("Лимит Telegram для чата %s, пауза %s с", chat_id, retry_after)
+                self.bucket.pause(retry_after)
+                continue
+            except BadRequest as e:
+                self.failed_attempts += 1
+                if parse_mode:
+                    # Разметку сломал текст пользователя — лучше доставить без форматирования
+                    logger.error("Сообщение %s не прошло с разметкой, отправим без неё: %s", row_id, e)
+                    await self._run(self._reschedule, row_id, attempts + 1, time.time(), None)
+                else:
+                    logger.error("Сообщение %s отклонено Telegram (попытка %s): %s", row_id, attempts + 1, e)
+                    await self._run(
+                        self._reschedule, row_id, attempts + 1, time.time() + self._backoff(attempts + 1), None
+                    )
+                continue
+            except Exception as e:
+                self.failed_attempts += 1
+                logger.warning("Не удалось отправить сообщение %s (попытка %s): %s", row_id, attempts + 1, e)
+                await self._run(
+                    self._reschedule, row_id, attempts + 1, time.time() + self._backoff(attempts + 1), parse_mode
+                )
+                continue
+
+            await self._run(self._delete, row_id)
+            self._depth -= 1
+            self.delivered += 1
+            self._latencies.append(time.time() - created_at)
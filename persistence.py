@@ -0,0 +1,307 @@
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# Группа раньше всех остальных обработчиков: состояние пользователя должно
+# быть в памяти до того, как ConversationHandler начнёт проверять апдейт
+PRELOAD_GROUP = -100
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL,
+    updated_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    state BLOB NOT NULL,
+    updated_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, key)
+);
+"""
+
+# Индексы создаются после миграции: в старых базах колонки updated_at ещё нет
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS conversations_user_id ON conversations (user_id);
+CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at);
+CREATE INDEX IF NOT EXISTS user_data_updated_at ON user_data (updated_at);
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """Хранит user_data и состояния диалогов в SQLite (WAL), по строке на пользователя.
+
+    Данные подгружаются лениво: при старте ничего не читается, а строки
+    пользователя загружаются при первом его апдейте (см. preload_handler).
+    Изменения копятся в памяти и пишутся одной транзакцией на каждый прогон
+    Application.update_persistence, то есть раз в update_interval секунд.
+
+    Ключи диалогов должны заканчиваться на id пользователя (per_user=True).
+
+    С ttl пользователи, от которых не было апдейтов дольше ttl секунд,
+    вытесняются: их диалоги и user_data удаляются из памяти и из базы
+    (см. start_eviction). JobQueue для этого не нужен.
+    """
+
+    def __init__(self, filepath, update_interval=60, ttl=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.filepath = filepath
+        # Один поток на все запросы: sqlite3-соединение не любит конкурентный доступ
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-persistence")
+        self._conn = None
+        self._loaded_user_data = set()
+        self._loaded_conversations = set()
+        self._pending_user_data = {}
+        self._pending_conversations = {}
+        self._write_task = None
+        self.ttl = ttl
+        self._last_seen = {}
+        self._eviction_task = None
+
+    # --- работа с базой (в отдельном потоке) ---
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            for table in ("user_data", "conversations"):
+                columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+                if "updated_at" not in columns:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+            self._conn.executescript(_INDEXES)
+        return self._conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _select_user_data(self, user_id):
+        row = self._connect().execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _select_conversations(self, user_id):
+        rows = self._connect().execute(
+            "SELECT name, key, state FROM conversations WHERE user_id = ?", (user_id,)
+        ).fetchall()
+        return [(name, tuple(json.loads(key)), pickle.loads(state)) for name, key, state in rows]
+
+    def _write_batch(self, user_data, conversations):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            # IMMEDIATE: в кластере в базу пишут несколько процессов, блокировку берём сразу
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR REPLACE INTO user_data (user_id, data, updated_at) VALUES (?, ?, ?)",
+                [(user_id, blob, now) for user_id, blob in user_data.items() if blob is not None],
+            )
+            conn.executemany(
+                "DELETE FROM user_data WHERE user_id = ?",
+                [(user_id,) for user_id, blob in user_data.items() if blob is None],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, user_id, state, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (name, json.dumps(list(key)), key[-1], blob, now)
+                    for (name, key), blob in conversations.items() if blob is not None
+                ],
+            )
+            conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND key = ?",
+                [(name, json.dumps(list(key))) for (name, key), blob in conversations.items() if blob is None],
+            )
+
+    def _delete_expired(self, cutoff):
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conversations = conn.execute("DELETE FROM conversations WHERE updated_at < ?", (cutoff,)).rowcount
+            user_data = conn.execute("DELETE FROM user_data WHERE updated_at < ?", (cutoff,)).rowcount
+        return conversations, user_data
+
+    # --- пакетная запись ---
+
+    def _schedule_write(self):
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        # Application.update_persistence вызывает update_* пачкой через gather:
+        # даём им всем отработать и пишем всё одной транзакцией
+        await asyncio.sleep(0)
+        while self._pending_user_data or self._pending_conversations:
+            user_data, self._pending_user_data = self._pending_user_data, {}
+            conversations, self._pending_conversations = self._pending_conversations, {}
+            try:
+                await self._run(self._write_batch, user_data, conversations)
+            except sqlite3.Error as e:
+                logger.error("Ошибка записи состояния в SQLite: %s", e)
+                # Возвращаем несохранённое, не затирая более свежие изменения
+                self._pending_user_data = {**user_data, **self._pending_user_data}
+                self._pending_conversations = {**conversations, **self._pending_conversations}
+                return
+
+    # --- ленивая загрузка ---
+
+    async def _preload(self, update, context):
+        user = update.effective_user
+        if user is None:
+            return
+        if self.ttl is not None:
+            self._last_seen[user.id] = time.monotonic()
+        if user.id in self._loaded_conversations:
+            return
+        self._loaded_conversations.add(user.id)
+        rows = await self._run(self._select_conversations, user.id)
+        # Application хранит живые словари диалогов только в приватном атрибуте
+        conversations = context.application._conversation_handler_conversations
+        for name, key, state in rows:
+            # Неотправленное в базу изменение новее строки из базы
+            if (name, key) in self._pending_conversations:
+                continue
+            if name in conversations and key not in conversations[name]:
+                conversations[name].update_no_track({key: state})
+
+    def preload_handler(self):
+        """Обработчик для группы PRELOAD_GROUP, поднимающий состояние пользователя из базы."""
+        return TypeHandler(Update, self._preload)
+
+    # --- вытеснение простаивающих пользователей ---
+
+    def evict_idle(self, application, now=None):
+        """Забывает пользователей, от которых не было апдейтов дольше ttl. Возвращает их число."""
+        deadline = (time.monotonic() if now is None else now) - self.ttl
+        expired = {user_id for user_id, seen in self._last_seen.items() if seen < deadline}
+        if not expired:
+            return 0
+
+        for name, conversations in application._conversation_handler_conversations.items():
+            for key in [key for key in conversations if key[-1] in expired]:
+                del conversations[key]
+                # Удаление пишем сразу: вернувшийся пользователь не должен поднять из базы старый шаг
+                self._pending_conversations[(name, key)] = None
+        for user_id in expired:
+            application.drop_user_data(user_id)
+            self._pending_user_data[user_id] = None
+            del self._last_seen[user_id]
+            self._loaded_user_data.discard(user_id)
+            self._loaded_conversations.discard(user_id)
+        self._schedule_write()
+        return len(expired)
+
+    async def _evict_periodically(self, application, interval):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle(application)
+            # В базе остаются и те, кого нет в памяти (например, после перезапуска);
+            # запас в update_interval — на ещё не записанные изменения активных пользователей
+            try:
+                conversations, user_data = await self._run(
+                    self._delete_expired, time.time() - self.ttl - self.update_interval
+                )
+            except sqlite3.Error as e:
+                logger.error("Ошибка очистки устаревших диалогов в SQLite: %s", e)
+                continue
+            if evicted or conversations or user_data:
+                logger.info(
+                    "Вытеснено простаивающих пользователей: %s в памяти, %s диалогов и %s user_data в базе",
+                    evicted, conversations, user_data,
+                )
+
+    def start_eviction(self, application, interval=None):
+        if self.ttl is None:
+            return
+        interval = interval or min(60.0, self.ttl / 4)
+        self._eviction_task = asyncio.get_running_loop().create_task(self._evict_periodically(application, interval))
+
+    async def stop_eviction(self):
+        if self._eviction_task is not None:
+            self._eviction_task.cancel()
+            try:
+                await self._eviction_task
+            except asyncio.CancelledError:
+                pass
+            self._eviction_task = None
+
+    # --- интерфейс BasePersistence ---
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_user_data:
+            return
+        self._loaded_user_data.add(user_id)
+        if user_id in self._pending_user_data:
+            return
+        stored = await self._run(self._select_user_data, user_id)
+        if stored:
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        self._pending_user_data[user_id] = pickle.dumps(data)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._pending_user_data[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, key)] = None if new_state is None else pickle.dumps(new_state)
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        if self._write_task is not None:
+            await self._write_task
+        if self._pending_user_data or self._pending_conversations:
+            await self._write_pending()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,112 @@
+import json
+import zlib
+from collections import namedtuple
+
+# Маршрут, в который превращается callback_data кнопки
+Route = namedtuple("Route", "action key name parent")
+
+# Однобуквенные коды действий. Действия с записью каталога — строчные,
+# без неё (навигация, подтверждение) — заглавные.
+ACTION_CODES = {
+    "category": "c",
+    "item": "i",
+    "wrap": "w",
+    "fillb": "f",
+    "ribbonb": "r",
+    "setfill": "s",
+    "ribbons": "t",
+    "back_to_categories": "C",
+    "back_to_bouquets": "B",
+    "back_to_sets": "S",
+    "confirm_final": "Y",
+    "restart": "N",
+}
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+INDEX_WIDTH = 2
+# Весь crc32 (до 36**7): с двумя знаками примерно одна правка каталога из 1296 сохраняла версию,
+# и старые кнопки молча попадали в новые записи с тем же номером
+VERSION_WIDTH = 7
+PAYLOAD_LENGTH = 1 + INDEX_WIDTH + VERSION_WIDTH
+
+
+def _base36(number, width):
+    digits = []
+    for _ in range(width):
+        number, digit = divmod(number, 36)
+        digits.append(_DIGITS[digit])
+    if number:
+        raise ValueError("number does not fit into the fixed width")
+    return "".join(reversed(digits))
+
+
+class CallbackRouter:
+    """Единая таблица «callback_data → Route», собранная из каталога.
+
+    Данные кнопки имеют фиксированную длину PAYLOAD_LENGTH байт: код действия,
+    номер записи в base36 и отпечаток версии каталога. Разбор нажатия — один
+    поиск в словаре. Кнопки, оставшиеся от прежней версии каталога, не
+    совпадут по отпечатку и будут отклонены, а не перепутаны с новыми записями.
+
+    Кнопки других частей бота (например, листание /orders) не входят в
+    каталог — их префиксы объявляются через reserve(), чтобы их не сочли устаревшими.
+    """
+
+    def __init__(self, categories, wrap_colors, fillings, set_fillings, ribbon_colors):
+        self._categories = categories
+        self._wrap_colors = wrap_colors
+        self._fillings = fillings
+        self._set_fillings = set_fillings
+        self._ribbon_colors = ribbon_colors
+        self._reserved = ()
+        self.compile()
+
+    def _entries(self):
+        yield "category", [(key, category["name"], None) for key, category in self._categories.items()]
+        yield "item", [
+            (item_key, name, category_key)
+            for category_key, category in self._categories.items()
+            for item_key, name in category["items"].items()
+        ]
+        yield "wrap", [(key, name, None) for key, name in self._wrap_colors.items()]
+        yield "fillb", [(key, name, None) for key, name in self._fillings.items()]
+        yield "ribbonb", [(key, name, None) for key, name in self._ribbon_colors.items()]
+        yield "setfill", [(key, name, None) for key, name in self._set_fillings.items()]
+        yield "ribbons", [(key, name, None) for key, name in self._ribbon_colors.items()]
+
+    def compile(self):
+        entries = list(self._entries())
+        fingerprint = zlib.crc32(json.dumps(entries, ensure_ascii=False).encode())
+        self.version = _base36(fingerprint % 36 ** VERSION_WIDTH, VERSION_WIDTH)
+
+        table = {}
+        payloads = {}
+        for action, rows in entries:
+            code = ACTION_CODES[action]
+            for index, (key, name, parent) in enumerate(rows):
+                payload = f"{code}{_base36(index, INDEX_WIDTH)}{self.version}"
+                table[payload] = Route(action, key, name, parent)
+                payloads[(action, key)] = payload
+        for action, code in ACTION_CODES.items():
+            if code.isupper():
+                payload = f"{code}{'0' * INDEX_WIDTH}{self.version}"
+                table[payload] = Route(action, None, None, None)
+                payloads[(action, None)] = payload
+
+        self._table = table
+        self._payloads = payloads
+
+    def payload(self, action, key=None):
+        return self._payloads[(action, key)]
+
+    def resolve(self, data):
+        """Route для callback_data или None, если кнопка неизвестна или устарела."""
+        return self._table.get(data)
+
+    def reserve(self, prefix):
+        if any(payload.startswith(prefix) for payload in self._table):
+            raise ValueError(f"prefix {prefix!r} clashes with catalog payloads")
+        self._reserved += (prefix,)
+
+    def is_stale(self, data):
+        return data not in self._table and not data.startswith(self._reserved)
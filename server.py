@@ -0,0 +1,268 @@
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import json
+import logging
+import os
+import signal
+import time
+from http import HTTPStatus
+
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as TornadoApplication, HTTPError, RequestHandler
+from telegram import Update
+
+from metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Разбор тела апдейта: orjson в несколько раз быстрее json, но необязателен
+json_loads = orjson.loads if orjson is not None else json.loads
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Через сколько секунд просить повторить апдейт, когда очередь полна
+RETRY_AFTER = 1
+
+webhook_rejected = metrics.counter("webhook_rejected_total", "Запросы вебхука, отклонённые до очереди", ("reason",))
+
+
+def check_webhook_request(handler, secret_token):
+    """Общие проверки входящего апдейта: секрет от Telegram и тип тела."""
+    if secret_token is not None:
+        received = handler.request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(received.encode(), secret_token.encode()):
+            webhook_rejected.inc("secret")
+            raise HTTPError(HTTPStatus.FORBIDDEN)
+    if handler.request.headers.get("Content-Type") != "application/json":
+        webhook_rejected.inc("content_type")
+        raise HTTPError(HTTPStatus.FORBIDDEN)
+
+
+def has_bearer_token(handler, token):
+    """Заголовок «Authorization: Bearer <token>»; сравнение за постоянное время, как и у секрета вебхука."""
+    received = handler.request.headers.get("Authorization", "")
+    return hmac.compare_digest(received.encode(), f"Bearer {token}".encode())
+
+
+def reject_saturated(handler, reason="saturated"):
+    # Telegram повторит апдейт сам; send_error сбросил бы заголовок Retry-After, поэтому ответ собираем вручную
+    webhook_rejected.inc(reason)
+    handler.set_status(HTTPStatus.SERVICE_UNAVAILABLE)
+    handler.set_header("Retry-After", str(RETRY_AFTER))
+    handler.finish()
+
+
+def reject_not_ready(handler, ready):
+    """503, пока бот не прогрет: Telegram шлёт апдейты на старый вебхук сразу, а /ready он не проверяет."""
+    if ready is not None and not ready.is_set():
+        reject_saturated(handler, "warming_up")
+        return True
+    return False
+
+
+class WebhookHandler(RequestHandler):
+    """Принимает апдейты от Telegram и кладёт их в update_queue бота.
+
+    Очередь ограничена: когда она полна, запрос не ждёт места, а сразу
+    получает 503 — Telegram повторит апдейт позже, а память не растёт. Так же
+    отклоняется всё, что пришло до ready: иначе первые клиенты после
+    перезапуска увидели бы шаги без ещё не загруженных фото.
+    С secret_token принимаются только запросы с этим секретом в заголовке,
+    с capture (capture.UpdateCapture) принятые апдейты ещё и записываются.
+    """
+
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, bot_application, secret_token=None, capture=None, ready=None):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+        self.capture = capture
+        self.ready = ready
+
+    def post(self):
+        check_webhook_request(self, self.secret_token)
+        if reject_not_ready(self, self.ready):
+            return
+        try:
+            update = Update.de_json(json_loads(self.request.body), self.bot_application.bot)
+        except Exception as e:
+            logger.error("Не удалось разобрать апдейт из вебхука: %s", e)
+            webhook_rejected.inc("malformed")
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from e
+        if update is None:
+            return
+        try:
+            self.bot_application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            reject_saturated(self)
+            return
+        if self.capture is not None:
+            self.capture.record(self.request.body)
+
+
+class MetricsHandler(RequestHandler):
+    SUPPORTED_METHODS = ("GET",)
+
+    def initialize(self, token):
+        self.token = token
+
+    def get(self):
+        if self.token and not has_bearer_token(self, self.token):
+            raise HTTPError(HTTPStatus.UNAUTHORIZED)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+
+class ReadyHandler(RequestHandler):
+    """GET /ready: 200, когда бот прогрет и вебхук зарегистрирован, до этого 503."""
+
+    SUPPORTED_METHODS = ("GET",)
+
+    def initialize(self, ready):
+        self.ready = ready
+
+    def get(self):
+        if not self.ready.is_set():
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+        self.write("ok")
+
+
+def _log_request(handler):
+    # Журнал доступа Tornado на каждый апдейт забил бы лог — оставляем только отладку
+    logger.debug("%d %s %.1f мс", handler.get_status(), handler.request.method, handler.request.request_time() * 1000)
+
+
+def make_app(url_path=None, webhook_handler=WebhookHandler, webhook_kwargs=None,
+             metrics_path="/metrics", metrics_token=None, extra_routes=(), ready=None):
+    """Tornado-приложение: вебхук на url_path (если задан), /metrics, /ready (если передан ready) и extra_routes."""
+    routes = [(metrics_path, MetricsHandler, {"token": metrics_token}), *extra_routes]
+    if ready is not None:
+        routes.append((r"/ready", ReadyHandler, {"ready": ready}))
+    if url_path is not None:
+        routes.insert(0, (rf"/{url_path.strip('/')}/?", webhook_handler, webhook_kwargs or {}))
+    return TornadoApplication(routes, log_function=_log_request)
+
+
+def _read_secret_fingerprint(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("Не удалось прочитать состояние вебхука %s: %s", path, e)
+        return None
+
+
+def _write_secret_fingerprint(path, fingerprint):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(fingerprint or "")
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Не удалось сохранить состояние вебхука %s: %s", path, e)
+
+
+async def ensure_webhook(bot, webhook_url, secret_token=None, state_path=None):
+    """Вызывает setWebhook, только если Telegram знает другой адрес или сменился секрет.
+
+    Секрет getWebhookInfo не возвращает, поэтому отпечаток (sha256) последнего
+    установленного секрета хранится в state_path. Без state_path вебхук с
+    секретом переустанавливается при каждом запуске. Возвращает True, если
+    вебхук пришлось установить.
+    """
+    fingerprint = hashlib.sha256(secret_token.encode()).hexdigest() if secret_token else None
+    info = await bot.get_webhook_info()
+    known = _read_secret_fingerprint(state_path) if state_path else None
+    if info.url == webhook_url and fingerprint == known:
+        logger.info("Вебхук уже зарегистрирован, setWebhook пропущен")
+        return False
+    await bot.set_webhook(webhook_url, secret_token=secret_token)
+    if state_path:
+        _write_secret_fingerprint(state_path, fingerprint)
+    logger.info("Вебхук зарегистрирован заново")
+    return True
+
+
+def webhook_ingress(listen, port, url_path, webhook_url, metrics_token=None, extra_routes=(),
+                    warm_up=None, secret_token=None, webhook_state_path=None, capture=None):
+    """Источник апдейтов для run_application: свой HTTP-сервер и регистрация вебхука.
+
+    Сервер начинает слушать сразу, но /ready отвечает 200, а вебхук принимает
+    апдейты только после warm_up(application) и ensure_webhook.
+    """
+
+    @contextlib.asynccontextmanager
+    async def ingress(application, stop):
+        ready = asyncio.Event()
+        app = make_app(
+            url_path,
+            webhook_kwargs={
+                "bot_application": application, "secret_token": secret_token, "capture": capture, "ready": ready,
+            },
+            metrics_token=metrics_token, extra_routes=extra_routes, ready=ready,
+        )
+        server = HTTPServer(app, xheaders=True)
+        server.listen(port, listen)
+        try:
+            started = time.perf_counter()
+            if warm_up is not None:
+                await warm_up(application)
+            await ensure_webhook(application.bot, webhook_url, secret_token, webhook_state_path)
+            ready.set()
+            logger.info("Вебхук и /metrics слушают %s:%s, прогрев занял %.2f с",
+                        listen, port, time.perf_counter() - started)
+            yield
+        finally:
+            server.stop()
+
+    return ingress
+
+
+async def run_application(application, ingress):
+    """Жизненный цикл бота как у Application.run_webhook, но с произвольным источником апдейтов.
+
+    ingress(application, stop) — асинхронный контекстный менеджер, который
+    подаёт апдейты в update_queue, пока открыт; stop() завершает работу.
+    Порядок хуков повторяет PTB: post_init после initialize, post_stop после
+    stop, post_shutdown после shutdown.
+    """
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        loop.add_signal_handler(sig, stopping.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+
+        await application.start()
+        try:
+            async with ingress(application, stopping.set):
+                await stopping.wait()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application, listen, port, url_path, webhook_url, metrics_token=None, extra_routes=(),
+                warm_up=None, secret_token=None, webhook_state_path=None, capture=None):
+    """То же, что Application.run_webhook, но на своём сервере: рядом с вебхуком живут /metrics и /ready."""
+    ingress = webhook_ingress(
+        listen, port, url_path, webhook_url, metrics_token, extra_routes, warm_up, secret_token, webhook_state_path,
+        capture,
+    )
+    asyncio.run(run_application(application, ingress))
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from logging_setup import log_context
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов разных пользователей с сохранением порядка для каждого.
+
+    Для PTB процессор объявляет max_concurrent_updates=1, поэтому Application
+    ждёт do_process_update прямо в цикле чтения очереди. do_process_update
+    занимает один из limit слотов и запускает обработку фоновой задачей, так что
+    при limit апдейтах в работе чтение update_queue останавливается — очередь
+    (если она ограничена) заполняется, и давление доходит до приёма вебхуков.
+
+    Апдейты одного пользователя выстраиваются в цепочку: следующий стартует
+    только после завершения предыдущего, и ConversationHandler не гоняется сам с собой.
+    """
+
+    def __init__(self, limit):
+        super().__init__(max_concurrent_updates=1)
+        if limit < 1:
+            raise ValueError("limit must be a positive integer")
+        self.limit = limit
+        self.application = None
+        self._slots = None
+        self._in_flight = 0
+        self._tails = {}
+        self._tasks = set()
+
+    def bind(self, application):
+        # Задачи запускаем через Application.create_task: тогда stop() дождётся их
+        # до финальной записи persistence, а ошибки уйдут в обработчики ошибок
+        self.application = application
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def waiting_users(self):
+        return len(self._tails)
+
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.limit)
+
+    async def shutdown(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def do_process_update(self, update, coroutine):
+        await self._slots.acquire()
+        self._in_flight += 1
+
+        key = self._key(update)
+        previous = None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            previous = self._tails.get(key)
+            self._tails[key] = done
+
+        runner = self._run(key, previous, done, coroutine)
+        if self.application is not None:
+            self.application.create_task(runner, update=update)
+        else:
+            task = asyncio.get_running_loop().create_task(runner)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, previous, done, coroutine):
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            # Все записи лога за время обработки апдейта помечены пользователем
+            with log_context(user_id=key):
+                await coroutine
+        except asyncio.CancelledError:
+            coroutine.close()
+            raise
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+            if previous is not None and not previous.done():
+                # Нас отменили раньше предшественника: следующий должен ждать его, а не нас
+                previous.add_done_callback(lambda _: done.done() or done.set_result(None))
+            elif not done.done():
+                done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]